@@ -0,0 +1,86 @@
+'''Compare scope download via archive endpoint with per-object fetches
+
+Runs against already started server, for example one from
+`docker-compose up`:
+
+    python benchmarks/archive.py --url http://localhost:8000 --objects 2000
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def _report(name: str, elapsed: float, count: int, size: int):
+    print(f'{name:<24} {elapsed:8.2f}s {count / elapsed:10.1f} obj/s '
+          f'{size / elapsed / 2**20:8.2f} MiB/s')
+
+
+def prepare(session: requests.Session, base: str, args) -> int:
+    session.post(base).raise_for_status()
+    objects = {}
+    for i in range(args.objects):
+        resp = session.post(
+            f'{args.url}/upload',
+            files={'obj': os.urandom(args.size)},
+        )
+        resp.raise_for_status()
+        objects[f'file{i:06}'] = resp.json()['sid']
+    session.post(f'{base}/bench', json={'objects': objects})\
+        .raise_for_status()
+    return len(objects)
+
+
+def per_object(session: requests.Session, base: str, workers: int):
+    keys = [o['key'] for o in session.get(f'{base}/bench').json()]
+
+    def fetch(key: str) -> int:
+        return len(session.get(f'{base}/bench/{key}/data').content)
+
+    with ThreadPoolExecutor(workers) as pool:
+        return len(keys), sum(pool.map(fetch, keys))
+
+
+def archive(session: requests.Session, base: str, compression):
+    params = {'compression': compression} if compression else {}
+    size = 0
+    with session.get(f'{base}/bench/archive', params=params,
+                     stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(2**16):
+            size += len(chunk)
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--objects', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.auth = (args.user, '')
+    base = f'{args.url}/{args.user}/bench-archive-{int(time.time())}'
+    try:
+        count = prepare(session, base, args)
+        for workers in (1, args.workers):
+            start = time.perf_counter()
+            count, size = per_object(session, base, workers)
+            _report(f'per-object x{workers}', time.perf_counter() - start,
+                    count, size)
+        for compression in (None, 'zstd'):
+            start = time.perf_counter()
+            size = archive(session, base, compression)
+            _report(f'archive {compression or "tar"}',
+                    time.perf_counter() - start, count, size)
+    finally:
+        session.delete(base)
+
+
+if __name__ == '__main__':
+    main()
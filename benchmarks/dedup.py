@@ -0,0 +1,135 @@
+'''Measure deduplication of content-defined chunking on versioned data
+
+Every version is the previous one with a few random edits: inserts,
+deletes and overwrites of short spans. Reports how much of data is new
+for chunk store and how fast data is split.
+
+    python benchmarks/dedup.py --size 16M --versions 5 --edits 3
+
+With `--url` versions are also uploaded to running server, only missing
+chunks are sent:
+
+    python benchmarks/dedup.py --url http://localhost:8000
+'''
+import argparse
+import hashlib
+import io
+import json
+import random
+import time
+from typing import Optional
+
+import requests
+
+from sdpremote.utils.chunking import chunk_checksum, split
+
+
+def parse_size(value: str) -> int:
+    suffixes = {'k': 2**10, 'K': 2**10, 'M': 2**20, 'G': 2**30}
+    if value[-1] in suffixes:
+        return int(float(value[:-1]) * suffixes[value[-1]])
+    return int(value)
+
+
+def edit(data: bytes, edits: int, rnd: random.Random) -> bytes:
+    for _ in range(edits):
+        pos = rnd.randrange(len(data))
+        span = rnd.randrange(1, 4096)
+        kind = rnd.choice(('insert', 'delete', 'overwrite'))
+        if kind == 'insert':
+            data = data[:pos] + rnd.randbytes(span) + data[pos:]
+        elif kind == 'delete':
+            data = data[:pos] + data[pos + span:]
+        else:
+            data = data[:pos] + rnd.randbytes(span) + data[pos + span:]
+    return data
+
+
+def upload(session: requests.Session, url: str, chunks: list[bytes]) -> int:
+    '''Uploads version through chunk API, returns bytes sent'''
+    sums = [chunk_checksum(chunk) for chunk in chunks]
+    missing = set()
+    for i in range(0, len(sums), 10000):
+        resp = session.post(f'{url}/.upload/chunks/missing',
+                            json={'checksums': sums[i:i + 10000]})
+        resp.raise_for_status()
+        missing.update(resp.json())
+    sent = 0
+    for checksum, chunk in zip(sums, chunks):
+        if checksum in missing:
+            session.put(f'{url}/.upload/chunks/{checksum}', data=chunk)\
+                .raise_for_status()
+            missing.discard(checksum)
+            sent += len(chunk)
+    session.post(f'{url}/.upload/manifest', json={'chunks': sums})\
+        .raise_for_status()
+    return sent
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='16M', help='size of first version')
+    parser.add_argument('--versions', type=int, default=5)
+    parser.add_argument('--edits', type=int, default=3,
+                        help='random edits between versions')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--url', help='also upload versions to server')
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--output', help='save results as JSON')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    data = rnd.randbytes(parse_size(args.size))
+    session: Optional[requests.Session] = None
+    if args.url:
+        session = requests.Session()
+        session.auth = (args.user, '')
+
+    seen: set[str] = set()
+    results = []
+    print(f'{"version":>7} {"size":>12} {"chunks":>7} {"new":>12} '
+          f'{"split":>12} {"sent":>12} {"upload":>12}')
+    for version in range(args.versions):
+        if version:
+            data = edit(data, args.edits, rnd)
+        start = time.perf_counter()
+        chunks = list(split(io.BytesIO(data)))
+        elapsed = time.perf_counter() - start
+        new = 0
+        for chunk in chunks:
+            checksum = chunk_checksum(chunk)
+            if checksum not in seen:
+                seen.add(checksum)
+                new += len(chunk)
+        result = dict(
+            version=version,
+            size=len(data),
+            chunks=len(chunks),
+            new=new,
+            split_seconds=elapsed,
+            checksum=hashlib.sha256(data).hexdigest(),
+        )
+        line = (f'{version:>7} {len(data):>12} {len(chunks):>7} {new:>12} '
+                f'{len(data) / elapsed / 2**20:>7.2f}MiB/s')
+        if session is not None:
+            start = time.perf_counter()
+            sent = upload(session, args.url, chunks)
+            elapsed = time.perf_counter() - start
+            result.update(sent=sent, upload_seconds=elapsed)
+            line += (f' {sent:>12} '
+                     f'{len(data) / elapsed / 2**20:>7.2f}MiB/s')
+        print(line)
+        results.append(result)
+
+    total = sum(r['size'] for r in results)
+    unique = sum(r['new'] for r in results)
+    print(f'logical {total} bytes, unique {unique} bytes, '
+          f'dedup ratio {total / unique:.2f}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+'''Thundering herd of identical reads, as after release is published
+
+Creates scope with --objects objects, then sends --waves waves of
+--clients concurrent identical requests to list_objects, list_scopes and
+get_data. Reports latency and number of connections taken from pool,
+which is what coalescing saves. Compare with coalescing turned off:
+
+    python benchmarks/herd.py --clients 200
+    SDP_REMOTE_COALESCE__ENABLED=false python benchmarks/herd.py --clients 200
+
+Application runs in-process, so it needs the same environment as server,
+use --url to load already started server instead.
+'''
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import time
+
+import httpx
+
+
+async def stats(client: httpx.AsyncClient) -> tuple[float, float]:
+    '''Pool checkouts and coalesced requests so far'''
+    checkouts = (await client.get('/pool')).json()['checkouts']
+    metrics = (await client.get('/metrics')).text
+    coalesced = sum(
+        float(v) for v in re.findall(
+            r'^sdpremote_coalesced_requests_total\{.*\} (\S+)$', metrics,
+            re.M))
+    return checkouts, coalesced
+
+
+async def run(client: httpx.AsyncClient, args) -> dict:
+    base = f'/{args.user}/bench-herd-{int(time.time())}'
+    (await client.post(base)).raise_for_status()
+    try:
+        sid = (await client.post(
+            '/upload', files={'obj': os.urandom(1024)})).json()['sid']
+        (await client.post(f'{base}/release', json={
+            'objects': {f'file-{i:06}': sid for i in range(args.objects)}
+        })).raise_for_status()
+        targets = {
+            'list_objects': f'{base}/release',
+            'list_scopes': base,
+            'get_data': f'{base}/release/file-000000/data',
+        }
+        result = {}
+        for name, url in targets.items():
+            latencies: list[float] = []
+
+            async def get():
+                start = time.perf_counter()
+                resp = await client.get(url, follow_redirects=False)
+                latencies.append(time.perf_counter() - start)
+                assert resp.status_code < 400, resp.status_code
+
+            before = await stats(client)
+            start = time.perf_counter()
+            for _ in range(args.waves):
+                await asyncio.gather(*(get() for _ in range(args.clients)))
+            elapsed = time.perf_counter() - start
+            after = await stats(client)
+            latencies.sort()
+            result[name] = dict(
+                requests=len(latencies),
+                elapsed=elapsed,
+                p50=statistics.median(latencies),
+                p95=latencies[int(len(latencies) * .95)],
+                checkouts=after[0] - before[0],
+                coalesced=after[1] - before[1],
+            )
+        return result
+    finally:
+        await client.delete(base)
+
+
+async def main_async(args) -> dict:
+    auth = (args.user, '')
+    limits = httpx.Limits(max_connections=args.clients)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, auth=auth,
+                                   limits=limits, timeout=120)
+        app = None
+    else:
+        from sdpremote.app import app
+        await app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                   base_url='http://sdpremote', auth=auth,
+                                   limits=limits, timeout=120)
+    try:
+        return await run(client, args)
+    finally:
+        await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--waves', type=int, default=5)
+    parser.add_argument('--objects', type=int, default=1000)
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--url', help='load running server instead')
+    parser.add_argument('--output', help='save results as JSON')
+    args = parser.parse_args()
+
+    result = asyncio.run(main_async(args))
+    print(f'{"route":<14} {"requests":>9} {"req/s":>9} {"p50 ms":>9} '
+          f'{"p95 ms":>9} {"checkouts":>10} {"coalesced":>10}')
+    for name, r in result.items():
+        print(f'{name:<14} {r["requests"]:>9} '
+              f'{r["requests"] / r["elapsed"]:>9.1f} {r["p50"] * 1e3:>9.2f} '
+              f'{r["p95"] * 1e3:>9.2f} {r["checkouts"]:>10.0f} '
+              f'{r["coalesced"]:>10.0f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
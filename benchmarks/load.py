@@ -0,0 +1,243 @@
+'''End-to-end load benchmark of main SDP workflow
+
+Each worker repeats upload -> create scope -> patch -> list -> get_data for
+its own scopes and latency of each request is recorded per endpoint.
+Application runs in-process, so it needs the same environment as server
+(SDP_REMOTE_* variables) pointing to local Postgres with applied
+migrations and local S3, for example from `docker-compose up postgres
+minio`. Use --url to load already started server instead.
+
+    python benchmarks/load.py --scale small
+    python benchmarks/load.py --scale medium --compare results/old.json
+
+Results are saved to benchmarks/results as JSON. With --compare run fails
+when p95 of any endpoint is worse than --tolerance of previous run.
+'''
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional
+
+import httpx
+
+
+@dataclass(frozen=True)
+class Scale:
+    scopes: int
+    objects: int  # per scope
+    blobs: int  # distinct uploaded blobs, shared between objects
+    blob_size: int
+    patch: float  # share of keys changed by patch
+    reads: int  # get_data calls per scope
+
+
+SCALES = {
+    'small': Scale(scopes=8, objects=100, blobs=20, blob_size=1024,
+                   patch=.1, reads=20),
+    'medium': Scale(scopes=32, objects=1000, blobs=100, blob_size=16384,
+                    patch=.05, reads=100),
+    'large': Scale(scopes=64, objects=10000, blobs=200, blob_size=65536,
+                   patch=.01, reads=200),
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.errors: defaultdict[str, int] = defaultdict(int)
+
+    async def request(self, client: httpx.AsyncClient, endpoint: str,
+                      method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        resp = await client.request(method, url, **kwargs)
+        self.latencies[endpoint].append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            self.errors[endpoint] += 1
+        return resp
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scope(client: httpx.AsyncClient, rec: Recorder, base: str,
+                    name: str, scale: Scale, sids: list[int]):
+    objects = {
+        f'obj-{i:06}': random.choice(sids)
+        for i in range(scale.objects)
+    }
+    resp = await rec.request(client, 'create_scope', 'POST',
+                             f'{base}/{name}', json={'objects': objects})
+    checksum = resp.json().get('checksum')
+
+    changed = random.sample(list(objects),
+                            max(1, int(scale.patch * scale.objects)))
+    resp = await rec.request(
+        client, 'patch_scope', 'PATCH', f'{base}/{name}',
+        params={'checksum': checksum} if checksum else {},
+        json={'objects': {key: random.choice(sids)
+                          for key in changed}})
+
+    await rec.request(client, 'list_scopes', 'GET', base,
+                      params={'scope': name, 'is_prefix': False})
+    await rec.request(client, 'list_objects', 'GET', f'{base}/{name}')
+    for key in random.sample(list(objects), min(scale.reads, len(objects))):
+        await rec.request(client, 'get_data', 'GET',
+                          f'{base}/{name}/{key}/data')
+
+
+async def run(client: httpx.AsyncClient, args, scale: Scale) -> Recorder:
+    rec = Recorder()
+    base = f'/{args.user}/bench-load-{int(time.time())}'
+    resp = await client.post(base)
+    resp.raise_for_status()
+    try:
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def upload() -> int:
+            async with sem:
+                resp = await rec.request(
+                    client, 'upload', 'POST', '/upload',
+                    files={'obj': os.urandom(scale.blob_size)})
+                return resp.json()['sid']
+
+        sids = await asyncio.gather(*(upload() for _ in range(scale.blobs)))
+
+        async def scope(i: int):
+            async with sem:
+                await run_scope(client, rec, base, f'scope-{i:04}', scale,
+                                sids)
+
+        await asyncio.gather(*(scope(i) for i in range(scale.scopes)))
+    finally:
+        await client.delete(base)
+    return rec
+
+
+def summarize(rec: Recorder, elapsed: float) -> dict[str, dict[str, float]]:
+    return {
+        endpoint: {
+            'count': len(values),
+            'errors': rec.errors[endpoint],
+            'ops_per_sec': len(values) / elapsed,
+            'p50': percentile(values, .5),
+            'p95': percentile(values, .95),
+            'p99': percentile(values, .99),
+        }
+        for endpoint, values in sorted(rec.latencies.items())
+    }
+
+
+def print_report(summary: dict, previous: Optional[dict]):
+    print(f'{"endpoint":<14} {"count":>7} {"err":>5} {"ops/s":>9} '
+          f'{"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"p95 diff":>9}')
+    for endpoint, s in summary.items():
+        diff = ''
+        if previous and endpoint in previous:
+            old = previous[endpoint]['p95']
+            diff = f'{(s["p95"] - old) / old:+.1%}'
+        print(f'{endpoint:<14} {s["count"]:>7} {s["errors"]:>5} '
+              f'{s["ops_per_sec"]:>9.1f} {s["p50"] * 1e3:>9.2f} '
+              f'{s["p95"] * 1e3:>9.2f} {s["p99"] * 1e3:>9.2f} {diff:>9}')
+
+
+def regressions(summary: dict, previous: dict,
+                tolerance: float) -> list[str]:
+    return [
+        endpoint for endpoint, s in summary.items()
+        if endpoint in previous
+        and s['p95'] > previous[endpoint]['p95'] * (1 + tolerance)
+    ]
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def main_async(args) -> dict:
+    scale = SCALES[args.scale]
+    auth = (args.user, '')
+    limits = httpx.Limits(max_connections=args.concurrency)
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, auth=auth,
+                                   limits=limits, timeout=60)
+        app = None
+    else:
+        from sdpremote.app import app
+        await app.router.startup()
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                   base_url='http://sdpremote', auth=auth,
+                                   limits=limits, timeout=60)
+    try:
+        start = time.perf_counter()
+        rec = await run(client, args, scale)
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.aclose()
+        if app is not None:
+            await app.router.shutdown()
+    return {
+        'revision': revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'scale': args.scale,
+        'concurrency': args.concurrency,
+        'elapsed': elapsed,
+        'endpoints': summarize(rec, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--user', default='bench')
+    parser.add_argument('--url', help='load running server instead')
+    parser.add_argument('--output', default=os.path.join(
+        os.path.dirname(__file__), 'results'))
+    parser.add_argument('--compare', help='previous result file')
+    parser.add_argument('--tolerance', type=float, default=.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    result = asyncio.run(main_async(args))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['endpoints']
+    print(f'{args.scale}: {result["elapsed"]:.2f}s '
+          f'at concurrency {args.concurrency}')
+    print_report(result['endpoints'], previous)
+
+    os.makedirs(args.output, exist_ok=True)
+    path = os.path.join(
+        args.output,
+        f'{time.strftime("%Y%m%d-%H%M%S")}-{args.scale}.json',
+    )
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f'saved to {path}')
+
+    if previous is not None:
+        worse = regressions(result['endpoints'], previous, args.tolerance)
+        if worse:
+            print(f'p95 regression: {", ".join(worse)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+'''Microbenchmarks of per-request and per-key hot paths
+
+Covers checksum calculation, Basic authorization parsing, construction of
+response models from database rows, hashing reader used by uploads and
+content-defined chunking.
+Nothing is started, but modules read settings on import, so the same
+SDP_REMOTE_* environment as for server is required.
+
+    python benchmarks/micro.py
+    python benchmarks/micro.py --keys 10,10k,10M --sizes 16,1M,1G checksum reader
+
+Scales accept k/M/G suffixes (powers of 1000 for keys, 1024 for sizes).
+'''
+import argparse
+import hashlib
+import json
+import os
+import time
+from base64 import b64encode
+from datetime import datetime
+from tempfile import SpooledTemporaryFile
+from typing import Callable
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from sdpremote.entities.object import Object
+from sdpremote.entities.scope import Scope
+from sdpremote.storage import ObjectReader
+from sdpremote.utils.checksum import calc_checksum
+from sdpremote.utils.chunking import split
+from sdpremote.utils.listing import rows_response
+from sdpremote.utils.user import _user_header
+
+# minio puts objects smaller than minimal part in one read
+_PART_SIZE = 5 * 2**20
+
+
+def parse_scale(value: str, base: int) -> int:
+    suffixes = {'k': base, 'K': base, 'M': base**2, 'G': base**3}
+    if value[-1] in suffixes:
+        return int(float(value[:-1]) * suffixes[value[-1]])
+    return int(float(value))
+
+
+def measure(fn: Callable[[], object], budget: float) -> tuple[float, int]:
+    '''Best time of one call over repeats, which fit in budget seconds'''
+    best = float('inf')
+    runs = 0
+    deadline = time.perf_counter() + budget
+    while runs < 3 or time.perf_counter() < deadline:
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+        runs += 1
+    return best, runs
+
+
+def _rows(n: int) -> list[dict]:
+    timestamp = datetime.utcnow()
+    return [
+        dict(
+            key=f'dir{i % 100:02}/file{i:08}',
+            checksum=hashlib.sha256(str(i).encode()).hexdigest(),
+            creator='bench',
+            timestamp=timestamp,
+        ) for i in range(n)
+    ]
+
+
+def bench_checksum(n: int) -> Callable[[], object]:
+    checksums = {row['key']: row['checksum'] for row in _rows(n)}
+    return lambda: calc_checksum(checksums)
+
+
+def bench_user_header(n: int) -> Callable[[], object]:
+    headers = [
+        'Basic ' + b64encode(f'user{i}:'.encode()).decode()
+        for i in range(n)
+    ]
+    return lambda: [_user_header(h) for h in headers]
+
+
+def bench_object(n: int) -> Callable[[], object]:
+    rows = _rows(n)
+    return lambda: [Object(**d) for d in rows]
+
+
+def bench_object_construct(n: int) -> Callable[[], object]:
+    # lower bound for models built without validation
+    rows = _rows(n)
+    return lambda: [Object.construct(**d) for d in rows]
+
+
+def bench_listing_models(n: int) -> Callable[[], object]:
+    # what FastAPI does with list of models returned from route
+    rows = _rows(n)
+    return lambda: JSONResponse(jsonable_encoder([Object(**d) for d in rows]))
+
+
+def bench_listing_rows(n: int) -> Callable[[], object]:
+    keys = ('key', 'checksum', 'creator', 'timestamp')
+    rows = [tuple(d.values()) for d in _rows(n)]
+    return lambda: rows_response(keys, rows)
+
+
+def bench_scope(n: int) -> Callable[[], object]:
+    rows = [
+        dict(name=row['key'], checksum=row['checksum'],
+             creator=row['creator'], timestamp=row['timestamp'])
+        for row in _rows(n)
+    ]
+    return lambda: [Scope(**d) for d in rows]
+
+
+def bench_reader(size: int) -> Callable[[], object]:
+    # same spooling as starlette uses for uploaded files
+    f = SpooledTemporaryFile(max_size=1024 * 1024)
+    chunk = os.urandom(min(size, 2**20))
+    written = 0
+    while written < size:
+        written += f.write(chunk[:size - written])
+
+    def run():
+        reader = ObjectReader(f)  # type: ignore
+        while reader.read(_PART_SIZE):
+            pass
+        return reader.hash
+
+    return run
+
+
+def bench_chunking(size: int) -> Callable[[], object]:
+    # content-defined chunking of upload stored with chunked=true
+    f = SpooledTemporaryFile(max_size=1024 * 1024)
+    f.write(os.urandom(size))
+
+    def run():
+        f.seek(0)
+        return sum(1 for _ in split(f))  # type: ignore
+
+    return run
+
+
+# name -> (benchmark factory, scale kind)
+BENCHMARKS = {
+    'checksum': (bench_checksum, 'keys'),
+    'user_header': (bench_user_header, 'keys'),
+    'object': (bench_object, 'keys'),
+    'object_construct': (bench_object_construct, 'keys'),
+    'scope': (bench_scope, 'keys'),
+    'listing_models': (bench_listing_models, 'keys'),
+    'listing_rows': (bench_listing_rows, 'keys'),
+    'reader': (bench_reader, 'sizes'),
+    'chunking': (bench_chunking, 'sizes'),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help=f'benchmarks to run from {", ".join(BENCHMARKS)}'
+                        ', all by default')
+    parser.add_argument('--keys', default='10,1k,100k')
+    parser.add_argument('--sizes', default='16,64k,16M')
+    parser.add_argument('--budget', type=float, default=1.,
+                        help='seconds spent on repeats of each case')
+    parser.add_argument('--output', help='save results as JSON')
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}')
+
+    scales = {
+        'keys': [parse_scale(v, 1000) for v in args.keys.split(',')],
+        'sizes': [parse_scale(v, 1024) for v in args.sizes.split(',')],
+    }
+    results = []
+    print(f'{"benchmark":<18} {"scale":>12} {"runs":>6} {"time":>12} '
+          f'{"per unit":>12} {"throughput":>16}')
+    for name in args.names or BENCHMARKS:
+        factory, kind = BENCHMARKS[name]
+        for scale in scales[kind]:
+            elapsed, runs = measure(factory(scale), args.budget)
+            unit = 'B/s' if kind == 'sizes' else 'keys/s'
+            print(f'{name:<18} {scale:>12} {runs:>6} {elapsed:>11.6f}s '
+                  f'{elapsed / scale * 1e9:>10.1f}ns '
+                  f'{scale / elapsed:>12.4g} {unit}')
+            results.append(dict(name=name, scale=scale, runs=runs,
+                                seconds=elapsed))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+'''Compare plain and hash partitioned objects table at scale
+
+Fills two tables in schema sdpremote_bench with the same generated rows,
+--repos repos with --scopes scopes of --keys objects each, and times
+statements which list_objects, patch_scope and delete_scope run against
+one scope. Vacuum of plain table is compared with vacuum of one partition.
+
+    python benchmarks/partitioning.py --repos 100 --scopes 10 --keys 1000
+
+Also checks with EXPLAIN that route queries read one partition of objects
+table of server database. Uses the same SDP_REMOTE_* environment as
+server, schema is dropped at the end unless --keep is given.
+'''
+import argparse
+import json
+import random
+import re
+import statistics
+import time
+from typing import Any, Callable
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from sdpremote.config import settings
+from sdpremote.routes.object import _data_query, _head_query, _objects_query
+from sdpremote.utils.tree import _walk
+
+SCHEMA = 'sdpremote_bench'
+
+_COLUMNS = '''
+    key text NOT NULL,
+    scope text NOT NULL,
+    repo text NOT NULL,
+    checksum varchar(64),
+    creator text NOT NULL,
+    timestamp timestamp NOT NULL,
+    data integer,
+    size bigint,
+    content_type text,
+    PRIMARY KEY (key, scope, repo)
+'''
+
+
+def create_tables(conn: Any, partitions: int):
+    conn.execute(sa.text(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE'))
+    conn.execute(sa.text(f'CREATE SCHEMA {SCHEMA}'))
+    conn.execute(sa.text(f'CREATE TABLE {SCHEMA}.plain ({_COLUMNS})'))
+    conn.execute(
+        sa.text(f'CREATE TABLE {SCHEMA}.hashed ({_COLUMNS}) '
+                'PARTITION BY HASH (repo, scope)'))
+    for i in range(partitions):
+        conn.execute(
+            sa.text(f'CREATE TABLE {SCHEMA}.hashed_p{i:03} '
+                    f'PARTITION OF {SCHEMA}.hashed FOR VALUES WITH '
+                    f'(MODULUS {partitions}, REMAINDER {i})'))
+    for table in ('plain', 'hashed'):
+        conn.execute(
+            sa.text(f'CREATE INDEX ON {SCHEMA}.{table} '
+                    '(repo, scope, key COLLATE "C")'))
+
+
+def fill(conn: Any, table: str, args):
+    conn.execute(
+        sa.text(f'''
+            INSERT INTO {SCHEMA}.{table}
+            SELECT 'dir' || k % 100 || '/file' || k, 's' || s, 'r' || r,
+                md5(r || '/' || s || '/' || k) || md5(k::text), 'bench',
+                now(), NULL, 1024, 'application/octet-stream'
+            FROM generate_series(1, :repos) r,
+                generate_series(1, :scopes) s,
+                generate_series(1, :keys) k
+        '''), dict(repos=args.repos, scopes=args.scopes, keys=args.keys))
+    conn.execute(sa.text(f'ANALYZE {SCHEMA}.{table}'))
+
+
+def timed(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def run_ops(engine: Any, table: str, targets: list[tuple[str, str]],
+            args) -> dict[str, list[float]]:
+    name = f'{SCHEMA}.{table}'
+    times: dict[str, list[float]] = {'list': [], 'patch': [], 'delete': []}
+    listing = sa.text(f'''
+        SELECT key, checksum, creator, timestamp, size, content_type
+        FROM {name} WHERE repo = :repo AND scope = :scope
+    ''')
+    upsert = sa.text(f'''
+        INSERT INTO {name} VALUES
+            (:key, :scope, :repo, :checksum, 'bench', now(), NULL, 1, NULL)
+        ON CONFLICT (key, scope, repo) DO UPDATE
+        SET checksum = excluded.checksum, timestamp = excluded.timestamp
+    ''')
+    delete_keys = sa.text(f'''
+        DELETE FROM {name}
+        WHERE repo = :repo AND scope = :scope AND key = ANY(:keys)
+    ''')
+    delete_scope = sa.text(f'''
+        DELETE FROM {name} WHERE repo = :repo AND scope = :scope
+    ''')
+    rnd = random.Random(args.seed)
+    for repo, scope in targets:
+        params = dict(repo=repo, scope=scope)
+        with engine.connect() as conn:
+            times['list'].append(
+                timed(lambda: conn.execute(listing, params).all()))
+
+        keys = [f'dir{k % 100}/file{k}' for k in
+                rnd.sample(range(1, args.keys + 1), args.patch)]
+
+        def patch():
+            with engine.begin() as conn:
+                conn.execute(upsert, [
+                    dict(params, key=key, checksum=f'{i:064}')
+                    for i, key in enumerate(keys[1:])
+                ])
+                conn.execute(delete_keys, dict(params, keys=keys[:1]))
+
+        times['patch'].append(timed(patch))
+
+    for repo, scope in targets:
+
+        def delete():
+            with engine.begin() as conn:
+                conn.execute(delete_scope, dict(repo=repo, scope=scope))
+
+        times['delete'].append(timed(delete))
+    return times
+
+
+def vacuum(engine: Any, table: str) -> float:
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        return timed(
+            lambda: conn.execute(sa.text(f'VACUUM {SCHEMA}.{table}')))
+
+
+def check_pruning(engine: Any) -> dict[str, int]:
+    '''Number of objects partitions read by each route query'''
+    params = dict(repo='user/repo', scope='scope', key='key',
+                  pattern='key%')
+    queries: dict[str, Any] = {
+        'list_objects': _objects_query,
+        'get_data': _data_query,
+        'head_data': _head_query,
+    }
+    result = {}
+    with engine.connect() as conn:
+        for name, query in queries.items():
+            sql = str(
+                query.params(params).compile(
+                    dialect=postgresql.dialect(),
+                    compile_kwargs={'literal_binds': True},
+                ))
+            plan = conn.execute(sa.text('EXPLAIN ' + sql)).scalars().all()
+            result[name] = len(set(re.findall(r'objects_p\d+',
+                                              '\n'.join(plan))))
+        plan = conn.execute(
+            sa.text('EXPLAIN ' + _walk.text),
+            dict(params, prefix='', delimiter='/', successor='0', length=0,
+                 start=1),
+        ).scalars().all()
+        result['list_tree'] = len(set(re.findall(r'objects_p\d+',
+                                                 '\n'.join(plan))))
+    return result
+
+
+def report(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(len(values) * .95))]
+    return dict(median=statistics.median(values) * 1000, p95=p95 * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--scopes', type=int, default=10)
+    parser.add_argument('--keys', type=int, default=1000,
+                        help='objects in each scope')
+    parser.add_argument('--partitions', type=int, default=16)
+    parser.add_argument('--samples', type=int, default=50,
+                        help='scopes used for timed operations')
+    parser.add_argument('--patch', type=int, default=20,
+                        help='keys changed by one patch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true',
+                        help='do not drop benchmark schema')
+    parser.add_argument('--output', help='save results as JSON')
+    args = parser.parse_args()
+
+    engine = sa.create_engine(settings['database.uri_sync'])
+    rows = args.repos * args.scopes * args.keys
+    print(f'{rows} rows, {args.partitions} partitions')
+    with engine.begin() as conn:
+        create_tables(conn, args.partitions)
+        for table in ('plain', 'hashed'):
+            elapsed = timed(lambda: fill(conn, table, args))
+            print(f'filled {table} in {elapsed:.2f}s')
+
+    rnd = random.Random(args.seed)
+    targets = [(f'r{rnd.randint(1, args.repos)}',
+                f's{rnd.randint(1, args.scopes)}')
+               for _ in range(args.samples)]
+    targets = list(dict.fromkeys(targets))
+    results: dict[str, Any] = dict(rows=rows, partitions=args.partitions)
+    print(f'{"operation":<10} {"table":<8} {"median ms":>10} {"p95 ms":>10}')
+    for table in ('plain', 'hashed'):
+        for op, values in run_ops(engine, table, targets, args).items():
+            stats = report(values)
+            results[f'{op}_{table}'] = stats
+            print(f'{op:<10} {table:<8} {stats["median"]:>10.2f} '
+                  f'{stats["p95"]:>10.2f}')
+    results['vacuum_plain'] = vacuum(engine, 'plain')
+    results['vacuum_partition'] = vacuum(engine, 'hashed_p000')
+    print(f'vacuum of plain table {results["vacuum_plain"]:.3f}s, '
+          f'of one partition {results["vacuum_partition"]:.3f}s')
+
+    with engine.connect() as conn:
+        partitioned = conn.execute(
+            sa.text("SELECT relkind = 'p' FROM pg_class "
+                    "WHERE relname = 'objects'")).scalar()
+    if partitioned:
+        results['pruning'] = check_pruning(engine)
+        for name, count in results['pruning'].items():
+            print(f'{name} reads {count} partition(s) of objects')
+    else:
+        print('objects table of server is not partitioned, '
+              'pruning is not checked')
+
+    if not args.keep:
+        with engine.begin() as conn:
+            conn.execute(sa.text(f'DROP SCHEMA {SCHEMA} CASCADE'))
+    engine.dispose()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
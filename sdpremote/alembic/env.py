@@ -20,6 +20,14 @@ fileConfig(config.config_file_name)
 # target_metadata = mymodel.Base.metadata
 target_metadata = metadata
 
+
+def include_object(object, name, type_, reflected, compare_to):
+    # partitions of objects table and tables of its online migration are
+    # not part of metadata
+    return not (type_ == 'table' and reflected and compare_to is None
+                and name.startswith(('objects_p', 'objects_backfill')))
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -42,6 +50,7 @@ def run_migrations_offline():
     context.configure(  # type: ignore
         url=url,
         target_metadata=target_metadata,
+        include_object=include_object,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         compare_server_default=True,
@@ -64,6 +73,7 @@ def run_migrations_online():
         context.configure(  # type: ignore
             connection=connection,
             target_metadata=target_metadata,
+            include_object=include_object,
             compare_server_default=True,
         )
 
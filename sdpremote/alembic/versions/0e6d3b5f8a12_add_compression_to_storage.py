@@ -0,0 +1,28 @@
+"""add compression to storage table
+
+Revision ID: 0e6d3b5f8a12
+Revises: 9b7272333629
+Create Date: 2026-10-19 13:48:30.205117
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '0e6d3b5f8a12'
+down_revision = '9b7272333629'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('storage', sa.Column('compression', sa.Text(),
+                                       nullable=True))
+    op.add_column('storage',
+                  sa.Column('stored_size', sa.BigInteger(), nullable=True))
+    op.execute('UPDATE storage SET stored_size = size')
+
+
+def downgrade():
+    op.drop_column('storage', 'stored_size')
+    op.drop_column('storage', 'compression')
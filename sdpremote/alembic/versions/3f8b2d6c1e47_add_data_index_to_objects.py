@@ -0,0 +1,66 @@
+"""add data index to objects
+
+Revision ID: 3f8b2d6c1e47
+Revises: ca9cc63c7427
+Create Date: 2026-10-19 13:12:37.105342
+
+Index of objects data is built on each partition concurrently and
+attached to index of partitioned table, so writes of objects are not
+blocked meanwhile. Build runs outside of transaction, so upgrade can be
+run again after it is interrupted: attached partition indexes are kept
+and invalid ones left by interrupted build are rebuilt.
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f8b2d6c1e47'
+down_revision = 'ca9cc63c7427'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # invalid until index of every partition is attached
+    op.execute(  # type: ignore
+        'CREATE INDEX IF NOT EXISTS ix__objects__data ON ONLY objects (data)')
+    bind = op.get_bind()  # type: ignore
+    partitions = bind.execute(
+        sa.text('''
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'objects'::regclass
+            ORDER BY c.relname
+        ''')).scalars().all()
+    with op.get_context().autocommit_block():  # type: ignore
+        for partition in partitions:
+            index = f'ix__{partition}__data'
+            state = bind.execute(
+                sa.text('''
+                    SELECT x.indisvalid, EXISTS (
+                        SELECT FROM pg_inherits i
+                        WHERE i.inhrelid = x.indexrelid
+                    ) FROM pg_index x
+                    WHERE x.indexrelid = to_regclass(:index)
+                ''').bindparams(index=index)).first()
+            if state is not None:
+                valid, attached = state
+                if attached:
+                    continue
+                if not valid:
+                    op.execute(  # type: ignore
+                        f'DROP INDEX CONCURRENTLY {index}')
+            op.execute(  # type: ignore
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {index} '
+                f'ON {partition} (data)')
+            op.execute(  # type: ignore
+                f'ALTER INDEX ix__objects__data ATTACH PARTITION {index}')
+
+
+def downgrade():
+    # drops indexes of partitions as well
+    op.drop_index(  # type: ignore
+        op.f('ix__objects__data'),  # type: ignore
+        table_name='objects',
+    )
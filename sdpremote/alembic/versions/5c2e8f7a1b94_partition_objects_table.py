@@ -0,0 +1,91 @@
+"""partition objects table
+
+Revision ID: 5c2e8f7a1b94
+Revises: 148512b13ae8
+Create Date: 2026-10-19 15:12:27.640193
+
+Creates objects_partitioned, hash partitioned by repo and scope, and
+trigger which mirrors changes of objects into it. Existing rows are copied
+online by `python -m sdpremote.partitioning backfill`. Number of
+partitions is set with `alembic -x partitions=N upgrade`.
+
+"""
+from alembic import context, op
+
+# revision identifiers, used by Alembic.
+revision = '5c2e8f7a1b94'
+down_revision = '148512b13ae8'
+branch_labels = None
+depends_on = None
+
+DEFAULT_PARTITIONS = 16
+
+
+def upgrade():
+    partitions = int(context.get_x_argument(as_dictionary=True).get(
+        'partitions', DEFAULT_PARTITIONS))
+    op.execute('''
+        CREATE TABLE objects_partitioned (
+            LIKE objects INCLUDING DEFAULTS,
+            CONSTRAINT pk__objects_partitioned
+                PRIMARY KEY (key, scope, repo),
+            CONSTRAINT fk__objects__scope_repo__scopes
+                FOREIGN KEY (scope, repo) REFERENCES scopes (name, repo)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            CONSTRAINT fk__objects__data__storage
+                FOREIGN KEY (data) REFERENCES storage (id)
+                ON UPDATE CASCADE ON DELETE RESTRICT
+        ) PARTITION BY HASH (repo, scope)
+    ''')
+    for i in range(partitions):
+        op.execute(f'''
+            CREATE TABLE objects_p{i:03} PARTITION OF objects_partitioned
+            FOR VALUES WITH (MODULUS {partitions}, REMAINDER {i})
+        ''')
+    op.execute('''
+        CREATE INDEX ix__objects_partitioned__repo_scope_key
+        ON objects_partitioned (repo, scope, key COLLATE "C")
+    ''')
+
+    # rows are replaced as a whole, so the copy does not depend on order
+    # in which trigger and backfill see them
+    op.execute('''
+        CREATE FUNCTION mirror_objects() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                DELETE FROM objects_partitioned
+                WHERE key = OLD.key AND scope = OLD.scope
+                    AND repo = OLD.repo;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                DELETE FROM objects_partitioned
+                WHERE key = NEW.key AND scope = NEW.scope
+                    AND repo = NEW.repo;
+                INSERT INTO objects_partitioned SELECT (NEW).*;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER objects_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON objects
+        FOR EACH ROW EXECUTE FUNCTION mirror_objects()
+    ''')
+    op.execute('''
+        CREATE TABLE objects_backfill (
+            key text,
+            scope text,
+            repo text,
+            copied bigint NOT NULL DEFAULT 0,
+            done boolean NOT NULL DEFAULT false
+        )
+    ''')
+    op.execute('INSERT INTO objects_backfill DEFAULT VALUES')
+
+
+def downgrade():
+    op.execute('DROP TABLE objects_backfill')
+    op.execute('DROP TRIGGER objects_mirror ON objects')
+    op.execute('DROP FUNCTION mirror_objects()')
+    op.execute('DROP TABLE objects_partitioned')
@@ -0,0 +1,47 @@
+"""add scope change notifications
+
+Revision ID: 9a4e2c1d7b3f
+Revises: f5dc82bf83d2
+Create Date: 2026-10-19 13:02:41.318270
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '9a4e2c1d7b3f'
+down_revision = 'f5dc82bf83d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # identical notifications are folded by postgres within transaction, so
+    # multi-step scope updates are delivered once on commit
+    op.execute('''
+        CREATE FUNCTION notify_scope_change() RETURNS trigger AS $$
+        DECLARE
+            target scopes;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                target := OLD;
+            ELSE
+                target := NEW;
+            END IF;
+            PERFORM pg_notify(
+                'sdpremote_scopes',
+                json_build_object('repo', target.repo, 'name', target.name)::text
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER scopes_notify
+        AFTER INSERT OR UPDATE OR DELETE ON scopes
+        FOR EACH ROW EXECUTE FUNCTION notify_scope_change()
+    ''')
+
+
+def downgrade():
+    op.execute('DROP TRIGGER scopes_notify ON scopes')
+    op.execute('DROP FUNCTION notify_scope_change()')
@@ -0,0 +1,96 @@
+"""swap partitioned objects table
+
+Revision ID: a7d1c3e9f025
+Revises: 5c2e8f7a1b94
+Create Date: 2026-10-19 15:13:02.118404
+
+Replaces objects with objects_partitioned. Rows, which backfill has not
+copied yet, are copied here under exclusive lock of objects, so large
+tables must be backfilled before this migration.
+
+"""
+from alembic import op
+
+from sdpremote.partitioning import copy_batch
+
+# revision identifiers, used by Alembic.
+revision = 'a7d1c3e9f025'
+down_revision = '5c2e8f7a1b94'
+branch_labels = None
+depends_on = None
+
+_BATCH = 10000
+
+
+def upgrade():
+    conn = op.get_bind()
+    op.execute('LOCK TABLE objects IN EXCLUSIVE MODE')
+    while copy_batch(conn, _BATCH):
+        pass
+    op.execute('DROP TABLE objects_backfill')
+    op.execute('DROP TABLE objects')
+    op.execute('DROP FUNCTION mirror_objects()')
+    op.execute('ALTER TABLE objects_partitioned RENAME TO objects')
+    op.execute('ALTER TABLE objects RENAME CONSTRAINT '
+               'pk__objects_partitioned TO pk__objects')
+    op.execute('ALTER INDEX ix__objects_partitioned__repo_scope_key '
+               'RENAME TO ix__objects__repo_scope_key')
+
+
+def downgrade():
+    # copies all rows back, holding lock on objects
+    op.execute('ALTER TABLE objects RENAME TO objects_partitioned')
+    op.execute('ALTER TABLE objects_partitioned RENAME CONSTRAINT '
+               'pk__objects TO pk__objects_partitioned')
+    op.execute('ALTER INDEX ix__objects__repo_scope_key '
+               'RENAME TO ix__objects_partitioned__repo_scope_key')
+    op.execute('''
+        CREATE TABLE objects (
+            LIKE objects_partitioned INCLUDING DEFAULTS,
+            CONSTRAINT pk__objects PRIMARY KEY (key, scope, repo),
+            CONSTRAINT fk__objects__scope_repo__scopes
+                FOREIGN KEY (scope, repo) REFERENCES scopes (name, repo)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+            CONSTRAINT fk__objects__data__storage
+                FOREIGN KEY (data) REFERENCES storage (id)
+                ON UPDATE CASCADE ON DELETE RESTRICT
+        )
+    ''')
+    op.execute('INSERT INTO objects SELECT * FROM objects_partitioned')
+    op.execute('''
+        CREATE INDEX ix__objects__repo_scope_key
+        ON objects (repo, scope, key COLLATE "C")
+    ''')
+    op.execute('''
+        CREATE FUNCTION mirror_objects() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' THEN
+                DELETE FROM objects_partitioned
+                WHERE key = OLD.key AND scope = OLD.scope
+                    AND repo = OLD.repo;
+            END IF;
+            IF TG_OP <> 'DELETE' THEN
+                DELETE FROM objects_partitioned
+                WHERE key = NEW.key AND scope = NEW.scope
+                    AND repo = NEW.repo;
+                INSERT INTO objects_partitioned SELECT (NEW).*;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute('''
+        CREATE TRIGGER objects_mirror
+        AFTER INSERT OR UPDATE OR DELETE ON objects
+        FOR EACH ROW EXECUTE FUNCTION mirror_objects()
+    ''')
+    op.execute('''
+        CREATE TABLE objects_backfill (
+            key text,
+            scope text,
+            repo text,
+            copied bigint NOT NULL DEFAULT 0,
+            done boolean NOT NULL DEFAULT false
+        )
+    ''')
+    op.execute('INSERT INTO objects_backfill (done) VALUES (true)')
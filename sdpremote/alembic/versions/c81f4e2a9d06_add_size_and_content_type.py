@@ -0,0 +1,45 @@
+"""add size and content type
+
+Revision ID: c81f4e2a9d06
+Revises: 9a4e2c1d7b3f
+Create Date: 2026-10-19 13:21:09.742851
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4e2a9d06'
+down_revision = '9a4e2c1d7b3f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('storage', sa.Column('size', sa.BigInteger(),
+                                       nullable=True))
+    op.add_column('storage',
+                  sa.Column('content_type', sa.Text(), nullable=True))
+    op.add_column('objects', sa.Column('size', sa.BigInteger(),
+                                       nullable=True))
+    op.add_column('objects',
+                  sa.Column('content_type', sa.Text(), nullable=True))
+    op.add_column(
+        'scopes',
+        sa.Column('size', sa.BigInteger(), nullable=False,
+                  server_default='0'))
+    op.add_column(
+        'repos',
+        sa.Column('size', sa.BigInteger(), nullable=False,
+                  server_default='0'))
+    # sizes of already uploaded data are unknown, so existing totals start
+    # from zero and such objects are listed with null size
+
+
+def downgrade():
+    op.drop_column('repos', 'size')
+    op.drop_column('scopes', 'size')
+    op.drop_column('objects', 'content_type')
+    op.drop_column('objects', 'size')
+    op.drop_column('storage', 'content_type')
+    op.drop_column('storage', 'size')
@@ -0,0 +1,31 @@
+"""add repo scope key index to objects table
+
+Revision ID: f5dc82bf83d2
+Revises: d32ee62c4759
+Create Date: 2026-10-19 12:40:12.518203
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'f5dc82bf83d2'
+down_revision = 'd32ee62c4759'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(  # type: ignore
+        'ix__objects__repo_scope_key',
+        'objects',
+        ['repo', 'scope', sa.text('key COLLATE "C"')],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index(  # type: ignore
+        'ix__objects__repo_scope_key',
+        table_name='objects',
+    )
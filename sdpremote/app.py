@@ -4,11 +4,28 @@ from sqlalchemy.sql import text
 from . import __version__
 from .config import settings
 from .database import engine
-from .routes import object, repo, scope, upload
-from .storage import SThread
+from .deletion import worker as deletion_worker
+from .metrics import MetricsMiddleware, instrument_engine
+from .profiling import ProfilingMiddleware
+from .replica import ReadYourWrites, replicas
+from .slowlog import log_slow_statements
+from .routes import deletion, metrics, object, pool, repo, scope, upload
+from .scrub import scrubber
+from .storage import SThread, ensure_bucket
+from .tiering import worker as tiering_worker
+from .utils.admission import UploadAdmission
+from .watch import watcher
 
 settings.validators.validate()  # type: ignore
 app = FastAPI(version=__version__)
+app.add_middleware(UploadAdmission)
+app.add_middleware(ReadYourWrites)
+app.add_middleware(MetricsMiddleware)
+if ProfilingMiddleware.enabled():
+    app.add_middleware(ProfilingMiddleware)
+for _engine in (engine, *replicas):
+    instrument_engine(_engine.sync_engine)
+    log_slow_statements(_engine.sync_engine)
 
 
 @app.get('/')
@@ -25,6 +42,13 @@ async def check_engine():
 @app.on_event('shutdown')
 async def close_engine():
     await engine.dispose()
+    for replica in replicas:
+        await replica.dispose()
+
+
+@app.on_event('startup')
+def create_bucket():
+    ensure_bucket()
 
 
 @app.on_event('startup')
@@ -32,12 +56,54 @@ def start_sthread():
     SThread().start()
 
 
+@app.on_event('shutdown')
+async def close_watcher():
+    await watcher.close()
+
+
 @app.on_event('shutdown')
 def close_sthread():
     SThread.event.set()
 
 
+@app.on_event('startup')
+def start_deletion_worker():
+    deletion_worker.start()
+
+
+@app.on_event('shutdown')
+def stop_deletion_worker():
+    deletion_worker.stop()
+
+
+@app.on_event('startup')
+def start_scrubber():
+    if settings['scrub.enabled']:
+        scrubber.start()
+
+
+@app.on_event('shutdown')
+def stop_scrubber():
+    scrubber.stop()
+
+
+# records accesses of data even when tiering is disabled
+@app.on_event('startup')
+def start_tiering_worker():
+    tiering_worker.start()
+
+
+@app.on_event('shutdown')
+def stop_tiering_worker():
+    tiering_worker.stop()
+
+
+# upload and deletion routes go first, otherwise /.upload/... and
+# /.deletions/... would be taken by user routes
+app.include_router(upload.router)
+app.include_router(deletion.router)
 app.include_router(repo.router)
 app.include_router(scope.router)
 app.include_router(object.router)
-app.include_router(upload.router)
+app.include_router(pool.router)
+app.include_router(metrics.router)
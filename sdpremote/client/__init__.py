@@ -0,0 +1,3 @@
+'''Client of SDP server, requires `client` extra'''
+from .cache import HashCache
+from .client import Client, LocalFile, SyncError, SyncResult, scope_checksum
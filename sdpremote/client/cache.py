@@ -0,0 +1,67 @@
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional
+
+_BLOCK_SIZE = 2**20
+# file modified so recently could be changed again without visible change
+# of mtime, its hash is not cached
+_RACY_NS = 2 * 10**9
+
+
+def default_path() -> Path:
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'sdpremote' / 'hashes.sqlite'
+
+
+def hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(_BLOCK_SIZE):
+            h.update(block)
+    return h.hexdigest()
+
+
+class HashCache:
+    '''Persistent mapping of (path, mtime, size) to SHA-256 of file
+
+    File is hashed again only when its modification time or size changed.
+    Entries are written by one thread, hashing may be done in others.
+    '''
+    def __init__(self, path: Optional[Path] = None):
+        path = path or default_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS hashes (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                checksum TEXT NOT NULL
+            )
+        ''')
+
+    def get(self, path: Path, stat: os.stat_result) -> Optional[str]:
+        row = self.db.execute(
+            'SELECT checksum FROM hashes '
+            'WHERE path = ? AND mtime_ns = ? AND size = ?',
+            (str(path), stat.st_mtime_ns, stat.st_size),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, path: Path, stat: os.stat_result, checksum: str):
+        if time.time_ns() - stat.st_mtime_ns < _RACY_NS:
+            return
+        self.db.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)',
+            (str(path), stat.st_mtime_ns, stat.st_size, checksum),
+        )
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,93 @@
+'''Synchronize local directory with scope of SDP server
+
+    sdpremote push ./build release-1.2 --url http://localhost:8000 \\
+        --user alice --repo artifacts
+    sdpremote pull release-1.2 ./build --delete
+    sdpremote checksum ./build
+
+Connection options default to SDP_URL, SDP_USER, SDP_PASSWORD and SDP_REPO
+environment variables.
+'''
+import argparse
+import os
+import sys
+from pathlib import Path
+
+from .cache import HashCache
+from .client import Client, SyncError, scope_checksum
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='sdpremote',
+        description=__doc__.splitlines()[0],
+    )
+    parser.add_argument('--url', default=os.environ.get('SDP_URL'))
+    parser.add_argument('--user', default=os.environ.get('SDP_USER'))
+    parser.add_argument('--password',
+                        default=os.environ.get('SDP_PASSWORD', ''))
+    parser.add_argument('--repo', default=os.environ.get('SDP_REPO'))
+    parser.add_argument('--workers', type=int, default=8,
+                        help='concurrent transfers')
+    parser.add_argument('--cache', type=Path,
+                        help='hash cache file, ~/.cache/sdpremote by default')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='hash all files')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    push = commands.add_parser('push', help='upload directory to scope')
+    push.add_argument('directory', type=Path)
+    push.add_argument('scope')
+    push.add_argument('--chunked', action='store_true',
+                      help='upload only chunks missing on server')
+    push.add_argument('--part-size', type=int, default=16 * 2**20,
+                      help='larger files are uploaded in parts of this size')
+
+    pull = commands.add_parser('pull', help='download scope to directory')
+    pull.add_argument('scope')
+    pull.add_argument('directory', type=Path)
+    pull.add_argument('--delete', action='store_true',
+                      help='remove files which are not in scope')
+
+    checksum = commands.add_parser('checksum',
+                                   help='print scope checksum of directory')
+    checksum.add_argument('directory', type=Path)
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else HashCache(args.cache)
+    try:
+        if args.command == 'checksum':
+            client = Client('', '', '', workers=args.workers, cache=cache)
+            files = client.scan(args.directory)
+            print(scope_checksum({k: f.checksum for k, f in files.items()}))
+            return
+        for name in ('url', 'user', 'repo'):
+            if not getattr(args, name):
+                parser.error(f'--{name} is required')
+        client = Client(
+            args.url,
+            args.user,
+            args.repo,
+            password=args.password,
+            workers=args.workers,
+            part_size=getattr(args, 'part_size', 16 * 2**20),
+            chunked=getattr(args, 'chunked', False),
+            cache=cache,
+        )
+        if args.command == 'push':
+            result = client.push(args.directory, args.scope)
+            verb = 'uploaded'
+        else:
+            result = client.pull(args.scope, args.directory, args.delete)
+            verb = 'downloaded'
+    except SyncError as e:
+        sys.exit(f'error: {e}')
+    finally:
+        if cache is not None:
+            cache.close()
+    print(f'{verb} {len(result.transferred)}, deleted {len(result.deleted)}, '
+          f'checksum {result.checksum}')
+
+
+if __name__ == '__main__':
+    main()
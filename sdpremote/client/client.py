@@ -0,0 +1,366 @@
+import hashlib
+import mimetypes
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from ..utils.checksum import calc_checksum
+from ..utils.chunking import chunk_checksum, split
+from .cache import HashCache, hash_file
+
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+
+_MIN_PART = 5 * 2**20  # server limit for all parts except last
+_MAX_CHECKSUMS = 10000  # per request for missing chunks
+_MAX_KEYS = 1000  # per request for data urls
+_PART_ATTEMPTS = 5
+
+
+class SyncError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class LocalFile:
+    key: str
+    path: Path
+    size: int
+    checksum: str
+
+
+@dataclass(frozen=True)
+class SyncResult:
+    transferred: list[str]
+    deleted: list[str]
+    checksum: Optional[str]
+
+
+def scope_checksum(checksums: dict[str, Optional[str]]) -> Optional[str]:
+    '''Scope checksum as calculated by server from object checksums'''
+    if not checksums:
+        return None
+    return calc_checksum({
+        key: f'{key} ' + (checksum if checksum else 'null')
+        for key, checksum in checksums.items()
+    })
+
+
+def _local_path(root: Path, key: str) -> Path:
+    '''Path of object key under root, keys pointing outside are rejected'''
+    base = root.resolve()
+    path = (base / key).resolve()
+    if path == base or not path.is_relative_to(base):
+        raise SyncError(f'object key {key!r} is outside of {root}')
+    return path
+
+
+class Client:
+    '''Synchronizes local directories with scopes of one repo
+
+    Transfers run concurrently in `workers` threads over one session, which
+    keeps the same number of connections to server.
+    '''
+    def __init__(
+            self,
+            url: str,
+            user: str,
+            repo: str,
+            password: str = '',
+            workers: int = 8,
+            part_size: int = 16 * 2**20,
+            chunked: bool = False,
+            cache: Optional[HashCache] = None,
+            session: Optional[requests.Session] = None,
+    ):
+        if part_size < _MIN_PART:
+            raise ValueError('part size must be at least 5 MiB')
+        self.url = url.rstrip('/')
+        self.user = user
+        self.repo = repo
+        self.auth = (user, password)
+        self.workers = workers
+        self.part_size = part_size
+        self.chunked = chunked
+        self.cache = cache
+        if session is None:
+            session = requests.Session()
+            # overloaded server rejects uploads with Retry-After before
+            # reading them, so every method is retried
+            retry = Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods=None,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=2,
+                pool_maxsize=workers,
+                max_retries=retry,
+            )
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def _path(self, *parts: str) -> str:
+        return '/'.join([self.url] + [quote(p, safe='') for p in parts])
+
+    def _request(self, method: str, url: str, **kwargs) -> Any:
+        # presigned storage urls must not get server credentials
+        auth = self.auth if url.startswith(self.url) else None
+        resp = self.session.request(method, url, auth=auth, **kwargs)
+        resp.raise_for_status()
+        return resp
+
+    def scope(self, name: str) -> Optional[dict[str, Any]]:
+        scopes = self._request(
+            'GET',
+            self._path(self.user, self.repo),
+            params={'scope': name, 'is_prefix': 'false'},
+        ).json()
+        return scopes[0] if scopes else None
+
+    def objects(self, scope: str) -> dict[str, dict[str, Any]]:
+        objects = self._request(
+            'GET',
+            self._path(self.user, self.repo, scope),
+        ).json()
+        return {o['key']: o for o in objects}
+
+    def scan(self, root: Path) -> dict[str, LocalFile]:
+        '''Lists regular files under root with their checksums'''
+        stats: dict[str, tuple[Path, os.stat_result]] = {}
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = Path(dirpath, filename)
+                if path.is_symlink() or not path.is_file():
+                    continue
+                key = path.relative_to(root).as_posix()
+                stats[key] = (path.resolve(), path.stat())
+
+        checksums: dict[str, str] = {}
+        for key, (path, stat) in stats.items():
+            if self.cache is not None and (c := self.cache.get(path, stat)):
+                checksums[key] = c
+        missing = [key for key in stats if key not in checksums]
+        with ThreadPoolExecutor(self.workers) as pool:
+            hashed = pool.map(hash_file, (stats[k][0] for k in missing))
+            for key, checksum in zip(missing, hashed):
+                checksums[key] = checksum
+                if self.cache is not None:
+                    self.cache.put(*stats[key], checksum)
+        if self.cache is not None:
+            self.cache.commit()
+
+        return {
+            key: LocalFile(
+                key=key,
+                path=path,
+                size=stat.st_size,
+                checksum=checksums[key],
+            )
+            for key, (path, stat) in sorted(stats.items())
+        }
+
+    def upload(self, local: LocalFile) -> int:
+        '''Uploads file, returns its storage id'''
+        content_type = mimetypes.guess_type(local.path.name)[0] \
+            or DEFAULT_CONTENT_TYPE
+        if self.chunked:
+            return self._upload_chunked(local, content_type)
+        if local.size > self.part_size:
+            return self._upload_parts(local, content_type)
+        with open(local.path, 'rb') as f:
+            resp = self._request(
+                'POST',
+                self._path('upload'),
+                files={'obj': (local.path.name, f, content_type)},
+            )
+        return resp.json()['sid']
+
+    def _upload_parts(self, local: LocalFile, content_type: str) -> int:
+        session = self._request(
+            'POST',
+            self._path('.upload', 'sessions'),
+            json={'size': local.size, 'contentType': content_type},
+        ).json()
+        url = self._path('.upload', 'sessions', str(session['sid']))
+        attempts = 0
+        with open(local.path, 'rb') as f:
+            while not session['complete']:
+                f.seek(session['offset'])
+                part = f.read(self.part_size)
+                try:
+                    session = self._request(
+                        'PATCH',
+                        url,
+                        data=part,
+                        headers={'Upload-Offset': str(session['offset'])},
+                    ).json()
+                except requests.RequestException:
+                    attempts += 1
+                    if attempts >= _PART_ATTEMPTS:
+                        raise
+                    # continue from what server has received
+                    session = self._request('GET', url).json()
+        return session['sid']
+
+    def _upload_chunked(self, local: LocalFile, content_type: str) -> int:
+        chunks: list[tuple[str, int, int]] = []
+        offset = 0
+        with open(local.path, 'rb') as f:
+            for chunk in split(f):  # type: ignore
+                chunks.append((chunk_checksum(chunk), offset, len(chunk)))
+                offset += len(chunk)
+        checksums = [checksum for checksum, _, _ in chunks]
+        unique = list(dict.fromkeys(checksums))
+        missing: set[str] = set()
+        for i in range(0, len(unique), _MAX_CHECKSUMS):
+            missing.update(
+                self._request(
+                    'POST',
+                    self._path('.upload', 'chunks', 'missing'),
+                    json={'checksums': unique[i:i + _MAX_CHECKSUMS]},
+                ).json())
+        with open(local.path, 'rb') as f:
+            for checksum, offset, size in chunks:
+                if checksum not in missing:
+                    continue
+                missing.discard(checksum)
+                f.seek(offset)
+                self._request(
+                    'PUT',
+                    self._path('.upload', 'chunks', checksum),
+                    data=f.read(size),
+                )
+        return self._request(
+            'POST',
+            self._path('.upload', 'manifest'),
+            json={
+                'chunks': checksums,
+                'contentType': content_type,
+                'checksum': local.checksum,
+            },
+        ).json()['sid']
+
+    def push(self, root: Path, scope: str) -> SyncResult:
+        '''Makes scope equal to directory, uploads only changed files'''
+        files = self.scan(root)
+        checksum = scope_checksum({k: f.checksum for k, f in files.items()})
+        remote = self.scope(scope)
+        if remote is not None and remote['checksum'] == checksum:
+            return SyncResult([], [], checksum)
+
+        existing = self.objects(scope) if remote is not None else {}
+        changed = [
+            f for key, f in files.items()
+            if key not in existing or existing[key]['checksum'] != f.checksum
+        ]
+        deleted = sorted(key for key in existing if key not in files)
+        with ThreadPoolExecutor(self.workers) as pool:
+            sids = dict(
+                zip((f.key for f in changed), pool.map(self.upload, changed)))
+
+        if remote is None:
+            result = self._request(
+                'POST',
+                self._path(self.user, self.repo, scope),
+                json={'objects': sids},
+            ).json()
+        else:
+            objects: dict[str, Any] = dict(sids)
+            objects.update((key, 'delete') for key in deleted)
+            # fails when scope was changed by someone since it was read
+            result = self._request(
+                'PATCH',
+                self._path(self.user, self.repo, scope),
+                params={'checksum': remote['checksum']},
+                json={'objects': objects},
+            ).json()
+        if result['checksum'] != checksum:
+            raise SyncError(f'scope checksum {result["checksum"]} does not '
+                            f'match local checksum {checksum}')
+        return SyncResult([f.key for f in changed], deleted, checksum)
+
+    def _data_urls(self, scope: str,
+                   keys: list[str]) -> dict[str, Optional[str]]:
+        urls = {}
+        for i in range(0, len(keys), _MAX_KEYS):
+            urls.update(
+                self._request(
+                    'POST',
+                    self._path(self.user, self.repo, scope, 'data'),
+                    json={'keys': keys[i:i + _MAX_KEYS]},
+                ).json())
+        return urls
+
+    def _download(self, url: str, path: Path, checksum: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        h = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        try:
+            with os.fdopen(fd, 'wb') as f, \
+                    self._request('GET', url, stream=True) as resp:
+                for block in resp.iter_content(2**20):
+                    h.update(block)
+                    f.write(block)
+            if h.hexdigest() != checksum:
+                raise SyncError(f'checksum mismatch of {path}')
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def pull(self, scope: str, root: Path, delete: bool = False) -> SyncResult:
+        '''Makes directory equal to scope, downloads only changed objects
+
+        Objects with `null` data are skipped. Local files which are not in
+        scope are removed only with `delete`.
+        '''
+        objects = self.objects(scope)
+        files = self.scan(root) if root.exists() else {}
+        needed = sorted(
+            key for key, o in objects.items() if o['checksum'] and (
+                key not in files or files[key].checksum != o['checksum']))
+        # keys come from server, nothing is written before all are checked
+        paths = {key: _local_path(root, key) for key in needed}
+        urls = self._data_urls(scope, needed)
+
+        def fetch(key: str):
+            url = urls.get(key)
+            if url is None:  # removed since listed
+                raise SyncError(f'object {key} has no data')
+            self._download(url, paths[key], objects[key]['checksum'])
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(fetch, needed))
+        if self.cache is not None:
+            for key in needed:
+                path = paths[key]
+                self.cache.put(path, path.stat(), objects[key]['checksum'])
+            self.cache.commit()
+
+        deleted: list[str] = []
+        if delete:
+            deleted = sorted(key for key in files if key not in objects)
+            for key in deleted:
+                files[key].path.unlink()
+                # directories left empty are removed too
+                parent = (root / key).parent
+                while parent != root and not any(parent.iterdir()):
+                    parent.rmdir()
+                    parent = parent.parent
+        return SyncResult(
+            needed,
+            deleted,
+            scope_checksum({k: o['checksum']
+                            for k, o in objects.items()}),
+        )
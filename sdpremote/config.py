@@ -8,10 +8,85 @@ settings = Dynaconf(
         Validator('debug', default=False, is_type_of=bool),
         Validator('database.uri', must_exist=True, is_type_of=str),
         Validator('database.uri_sync', must_exist=True, is_type_of=str),
+        Validator('database.echo', default=False, is_type_of=bool),
+        Validator('database.pool_size', default=5, is_type_of=int, gte=1),
+        Validator('database.max_overflow', default=10, is_type_of=int),
+        Validator('database.pool_timeout', default=30, is_type_of=(int,
+                                                                   float)),
+        Validator('database.pool_recycle', default=1800, is_type_of=int),
+        Validator('database.pool_pre_ping', default=False, is_type_of=bool),
+        Validator('database.statement_cache_size', default=100,
+                  is_type_of=int, gte=0),
+        Validator('database.query_cache_size', default=500, is_type_of=int,
+                  gte=0),
+        Validator('database.replicas', default=[], is_type_of=list),
+        # seconds reads of client after write need replica which replayed
+        # it, tracked by LSN cookie across workers
+        Validator('database.replica_sticky', default=5, is_type_of=(int,
+                                                                    float)),
+        Validator('database.replica_retry', default=30, is_type_of=(int,
+                                                                    float)),
         Validator('storage.endpoint', must_exist=True, is_type_of=str),
         Validator('storage.secure', default=False, is_type_of=bool),
         Validator('storage.region', must_exist=True, is_type_of=str),
         Validator('storage.access_key', must_exist=True, is_type_of=str),
         Validator('storage.secret_key', must_exist=True, is_type_of=str),
+        Validator('archive.read_ahead', default=8, is_type_of=int, gte=1),
+        Validator('limits.uploads', default=16, is_type_of=int, gte=1),
+        Validator('limits.uploads_per_user', default=4, is_type_of=int,
+                  gte=1),
+        Validator('limits.upload_bytes', default=2**31, is_type_of=int,
+                  gte=1),
+        Validator('limits.upload_bytes_per_user', default=2**30,
+                  is_type_of=int, gte=1),
+        Validator('limits.upload_queue', default=64, is_type_of=int, gte=0),
+        Validator('limits.upload_timeout', default=30, is_type_of=(int,
+                                                                    float)),
+        Validator('limits.upload_part', default=2**26, is_type_of=int,
+                  gte=5 * 2**20),
+        Validator('limits.upload_threads', default=8, is_type_of=int, gte=1),
+        Validator('compression.enabled', default=False, is_type_of=bool),
+        Validator('compression.level', default=3, is_type_of=int),
+        Validator('compression.min_size', default=4096, is_type_of=int),
+        Validator('compression.max_ratio', default=0.9, is_type_of=(int,
+                                                                    float)),
+        Validator('coalesce.enabled', default=True, is_type_of=bool),
+        Validator('slowlog.threshold', default=0.5, is_type_of=(int, float)),
+        Validator('slowlog.explain_rate', default=0.0, is_type_of=(int,
+                                                                   float)),
+        Validator('profiling.token', default='', is_type_of=str),
+        Validator('profiling.sample_rate', default=0.0, is_type_of=(int,
+                                                                    float)),
+        Validator('profiling.keep', default=20, is_type_of=int, gte=1),
+        Validator('profiling.dir', default='profiles', is_type_of=str),
+        Validator('deletion.batch', default=1000, is_type_of=int, gte=1),
+        Validator('deletion.pause', default=0.1, is_type_of=(int, float),
+                  gte=0),
+        Validator('deletion.interval', default=10, is_type_of=(int, float),
+                  gt=0),
+        Validator('scrub.enabled', default=False, is_type_of=bool),
+        Validator('scrub.bandwidth', default=8 * 2**20, is_type_of=(int,
+                                                                    float),
+                  gt=0),
+        Validator('scrub.iops', default=10, is_type_of=(int, float), gt=0),
+        Validator('scrub.period', default=30, is_type_of=(int, float), gt=0),
+        Validator('scrub.batch', default=100, is_type_of=int, gte=1),
+        Validator('tiering.enabled', default=False, is_type_of=bool),
+        # presigned urls of hot data live 6 hours, data must not be moved
+        # while they may be in use
+        Validator('tiering.cold_after', default=90, is_type_of=(int, float),
+                  gte=1),
+        Validator('tiering.bucket', default='sdpremote-cold', is_type_of=str),
+        # same keys as storage, cold bucket is in main storage when empty
+        Validator('tiering.storage', default={}, is_type_of=dict),
+        Validator('tiering.compress', default=True, is_type_of=bool),
+        Validator('tiering.compression_level', default=9, is_type_of=int),
+        Validator('tiering.batch', default=100, is_type_of=int, gte=1),
+        Validator('tiering.interval', default=600, is_type_of=(int, float),
+                  gt=0),
+        Validator('tiering.flush', default=10, is_type_of=(int, float),
+                  gt=0),
+        Validator('watch.max_timeout', default=300, is_type_of=(int, float),
+                  gt=0),
     ],
 )
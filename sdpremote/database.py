@@ -1,12 +1,67 @@
+import time
+from typing import Any
+
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import create_async_engine  # type: ignore
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 from .config import settings
 
-engine = create_async_engine(
-    settings['database.uri'],
-    echo=bool(settings['debug']),
-)
+
+class MeteredPool(AsyncAdaptedQueuePool):
+    """Queue pool which counts waiting for connection"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+
+    def connect(self):
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except sa.exc.TimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            self.waiting -= 1
+            self.checkouts += 1
+            self.wait_time += time.perf_counter() - start
+
+
+def create_engine(uri: str) -> Any:
+    return create_async_engine(
+        uri,
+        echo=bool(settings['database.echo']),
+        poolclass=MeteredPool,
+        pool_size=settings['database.pool_size'],
+        max_overflow=settings['database.max_overflow'],
+        pool_timeout=settings['database.pool_timeout'],
+        pool_recycle=settings['database.pool_recycle'],
+        pool_pre_ping=settings['database.pool_pre_ping'],
+        query_cache_size=settings['database.query_cache_size'],
+        connect_args=dict(prepared_statement_cache_size=settings[
+            'database.statement_cache_size']),
+    )
+
+
+engine = create_engine(settings['database.uri'])
+
+
+def pool_stats() -> dict[str, float]:
+    pool: MeteredPool = engine.sync_engine.pool
+    return dict(
+        size=pool.size(),
+        idle=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=pool.overflow(),
+        waiting=pool.waiting,
+        checkouts=pool.checkouts,
+        timeouts=pool.timeouts,
+        wait_seconds=pool.wait_time,
+    )
 
 convention = {
     'all_column_names':
@@ -29,6 +84,9 @@ repos_table = sa.Table(
     'repos',
     metadata,
     sa.Column('name', sa.Text, primary_key=True),
+    sa.Column('size', sa.BigInteger, nullable=False, server_default='0'),
+    # tombstone, repo is hidden while its objects are deleted in background
+    sa.Column('deleted_at', sa.DateTime, nullable=True),
 )
 
 scopes_table = sa.Table(
@@ -48,6 +106,9 @@ scopes_table = sa.Table(
     sa.Column('checksum', sa.String(64), nullable=True),
     sa.Column('creator', sa.Text, nullable=True),
     sa.Column('timestamp', sa.DateTime, nullable=True),
+    sa.Column('size', sa.BigInteger, nullable=False, server_default='0'),
+    # tombstone, as for repos
+    sa.Column('deleted_at', sa.DateTime, nullable=True),
 )
 
 storage_table = sa.Table(
@@ -63,6 +124,59 @@ storage_table = sa.Table(
     ),
     sa.Column('owner', sa.Text, nullable=False),
     sa.Column('checksum', sa.String(64), nullable=True),
+    sa.Column('size', sa.BigInteger, nullable=True),
+    sa.Column('content_type', sa.Text, nullable=True),
+    # how data is stored, checksum and size are of original data
+    sa.Column('compression', sa.Text, nullable=True),
+    sa.Column('stored_size', sa.BigInteger, nullable=True),
+    # data is stored as chunks listed in manifests
+    sa.Column('chunked', sa.Boolean, nullable=False, server_default='false'),
+    # last time entry was claimed by object, scrubber checks recent first
+    sa.Column('referenced_at', sa.DateTime, nullable=True),
+    # last check of stored data by scrubber and its result, null when fine
+    sa.Column('scrubbed_at', sa.DateTime, nullable=True),
+    sa.Column('scrub_error', sa.Text, nullable=True),
+    # last time data was requested, recorded in batches with hour precision
+    sa.Column('accessed_at', sa.DateTime, nullable=False,
+              server_default=sa.func.now()),
+    # bucket which holds data, rarely accessed data is moved to cold one
+    sa.Column('tier', sa.Text, nullable=False, server_default='hot'),
+    # last move between buckets, copy in the other one is still readable
+    # and is removed when nobody can read it anymore
+    sa.Column('moved_at', sa.DateTime, nullable=True),
+)
+
+# order in which scrubber checks claimed entries with own data
+sa.Index(
+    'ix__storage__scrub_order',
+    storage_table.c.scrubbed_at.nullsfirst(),
+    storage_table.c.referenced_at.desc().nullslast(),
+    storage_table.c.id.desc(),
+    postgresql_where=sa.and_(
+        storage_table.c.checksum.isnot(None),
+        storage_table.c.expire_at.is_(None),
+        sa.not_(storage_table.c.chunked),
+    ),
+)
+
+# entries which tiering moves between buckets, by last access
+sa.Index(
+    'ix__storage__tier_accessed_at',
+    storage_table.c.tier,
+    storage_table.c.accessed_at,
+    postgresql_where=sa.and_(
+        storage_table.c.checksum.isnot(None),
+        storage_table.c.size.isnot(None),
+        storage_table.c.expire_at.is_(None),
+        sa.not_(storage_table.c.chunked),
+    ),
+)
+
+# entries with copy left in previous tier
+sa.Index(
+    'ix__storage__moved_at',
+    storage_table.c.moved_at,
+    postgresql_where=storage_table.c.moved_at.isnot(None),
 )
 
 objects_table = sa.Table(
@@ -89,5 +203,147 @@ objects_table = sa.Table(
             ondelete='RESTRICT',
         ),
         nullable=True,
+        # storage entry is released when no object refers to it
+        index=True,
+    ),
+    # copied from storage like checksum, so listings need no join
+    sa.Column('size', sa.BigInteger, nullable=True),
+    sa.Column('content_type', sa.Text, nullable=True),
+    # every query filters by repo and scope, so it reads one partition.
+    # Partitions objects_pNNN are created by migration
+    postgresql_partition_by='HASH (repo, scope)',
+)
+
+sa.Index(
+    'ix__objects__repo_scope_key',
+    objects_table.c.repo,
+    objects_table.c.scope,
+    objects_table.c.key.collate('C'),
+)
+
+# resumable upload into storage entry, removed when upload is completed
+uploads_table = sa.Table(
+    'uploads',
+    metadata,
+    sa.Column(
+        'sid',
+        sa.ForeignKey(
+            'storage.id',
+            onupdate='CASCADE',
+            ondelete='CASCADE',
+        ),
+        primary_key=True,
+    ),
+    sa.Column('upload_id', sa.Text, nullable=False),
+    sa.Column('length', sa.BigInteger, nullable=False),
+    sa.Column('offset', sa.BigInteger, nullable=False, server_default='0'),
+    sa.Column('next_part', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('content_type', sa.Text, nullable=False),
+)
+
+upload_parts_table = sa.Table(
+    'upload_parts',
+    metadata,
+    sa.Column(
+        'sid',
+        sa.ForeignKey(
+            'uploads.sid',
+            onupdate='CASCADE',
+            ondelete='CASCADE',
+        ),
+        nullable=False,
+    ),
+    sa.Column('number', sa.Integer, nullable=False),
+    sa.PrimaryKeyConstraint('sid', 'number'),
+    sa.Column('offset', sa.BigInteger, nullable=False),
+    sa.Column('size', sa.BigInteger, nullable=False),
+    sa.Column('checksum', sa.String(64), nullable=False),
+    sa.Column('etag', sa.Text, nullable=False),
+)
+
+# deduplicated content of chunked storage entries, stored by checksum
+chunks_table = sa.Table(
+    'chunks',
+    metadata,
+    sa.Column('checksum', sa.String(64), primary_key=True),
+    sa.Column('size', sa.Integer, nullable=False),
+    sa.Column('compression', sa.Text, nullable=True),
+    sa.Column('stored_size', sa.Integer, nullable=False),
+    # unreferenced chunk is removed by reaper when it is not used for a while
+    sa.Column(
+        'used_at',
+        sa.DateTime,
+        nullable=False,
+        index=True,
+        server_default=sa.func.now(),
+    ),
+    sa.Column('scrubbed_at', sa.DateTime, nullable=True),
+    sa.Column('scrub_error', sa.Text, nullable=True),
+)
+
+sa.Index(
+    'ix__chunks__scrub_order',
+    chunks_table.c.scrubbed_at.nullsfirst(),
+    chunks_table.c.used_at.desc(),
+)
+
+manifests_table = sa.Table(
+    'manifests',
+    metadata,
+    sa.Column(
+        'sid',
+        sa.ForeignKey(
+            'storage.id',
+            onupdate='CASCADE',
+            ondelete='CASCADE',
+        ),
+        nullable=False,
     ),
+    sa.Column('number', sa.Integer, nullable=False),
+    sa.PrimaryKeyConstraint('sid', 'number'),
+    sa.Column('offset', sa.BigInteger, nullable=False),
+    sa.Column(
+        'chunk',
+        sa.ForeignKey(
+            'chunks.checksum',
+            onupdate='CASCADE',
+            ondelete='RESTRICT',
+        ),
+        nullable=False,
+        index=True,
+    ),
+)
+
+# users who proved they have chunk data, only they can reference chunk
+chunk_owners_table = sa.Table(
+    'chunk_owners',
+    metadata,
+    sa.Column(
+        'chunk',
+        sa.ForeignKey(
+            'chunks.checksum',
+            onupdate='CASCADE',
+            ondelete='CASCADE',
+        ),
+        nullable=False,
+    ),
+    sa.Column('owner', sa.Text, nullable=False),
+    sa.PrimaryKeyConstraint('chunk', 'owner'),
+)
+
+# background deletion of tombstoned repo (scope is null) or scope
+deletions_table = sa.Table(
+    'deletions',
+    metadata,
+    sa.Column('id', sa.Integer, primary_key=True, autoincrement=True),
+    sa.Column('repo', sa.Text, nullable=False),
+    sa.Column('scope', sa.Text, nullable=True),
+    sa.Column('started', sa.DateTime, nullable=False,
+              server_default=sa.func.now()),
+    sa.Column('finished', sa.DateTime, nullable=True, index=True),
+    # objects in repo or scope when worker took it, null before
+    sa.Column('total', sa.BigInteger, nullable=True),
+    sa.Column('deleted', sa.BigInteger, nullable=False, server_default='0'),
+    sa.Column('released', sa.BigInteger, nullable=False, server_default='0'),
+    sa.Column('error', sa.Text, nullable=True),
 )
@@ -0,0 +1,201 @@
+'''Background deletion of tombstoned repos and scopes
+
+Route only marks repo or scope as deleted and queues deletion, objects are
+removed by worker in batches of `deletion.batch` rows, each in own short
+transaction, with `deletion.pause` seconds between them. Storage entries
+which are no longer referenced after batch get expiration time, so reaper
+removes their data later.
+'''
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import sqlalchemy as sa
+
+from .config import settings
+from .database import (deletions_table, objects_table, repos_table,
+                       scopes_table, storage_table)
+from .metrics import DELETION_OBJECTS, instrument_engine
+from .slowlog import log_slow_statements
+
+logger = logging.getLogger(__name__)
+
+_KEEP = timedelta(days=7)  # finished deletions are visible for status
+
+_next_job = sa.select([deletions_table])\
+    .where(deletions_table.c.finished.is_(None))\
+    .order_by(deletions_table.c.id)\
+    .limit(1)\
+    .with_for_update(skip_locked=True)
+
+_next_scope = sa.select([scopes_table.c.name])\
+    .where(scopes_table.c.repo == sa.bindparam('repo'))\
+    .where(scopes_table.c.deleted_at.isnot(None))\
+    .order_by(scopes_table.c.name)\
+    .limit(1)
+
+_batch_keys = sa.select([objects_table.c.key])\
+    .where(objects_table.c.scope == sa.bindparam('scope'))\
+    .where(objects_table.c.repo == sa.bindparam('repo'))\
+    .limit(sa.bindparam('limit'))
+
+_delete_batch = sa.delete(objects_table)\
+    .where(objects_table.c.scope == sa.bindparam('scope'))\
+    .where(objects_table.c.repo == sa.bindparam('repo'))\
+    .where(objects_table.c.key.in_(_batch_keys))\
+    .returning(objects_table.c.data)
+
+# data may be shared with objects of other scopes, claimed storage is
+# released only when nothing refers to it. Expiration has default delay,
+# so presigned urls given out before deletion keep working for a while
+_release_storage = sa.update(storage_table)\
+    .where(storage_table.c.id.in_(sa.bindparam('sids', expanding=True)))\
+    .where(storage_table.c.expire_at.is_(None))\
+    .where(~sa.exists().where(objects_table.c.data == storage_table.c.id))\
+    .values(expire_at=storage_table.c.expire_at.server_default.arg)
+
+
+def _count(conn: Any, job: Any) -> int:
+    query = sa.select([sa.func.count()])\
+        .where(objects_table.c.repo == job.repo)
+    if job.scope is not None:
+        query = query.where(objects_table.c.scope == job.scope)
+    return conn.execute(query).scalar()
+
+
+def _finish(conn: Any, job: Any):
+    if job.scope is None:
+        conn.execute(
+            sa.delete(repos_table)\
+                .where(repos_table.c.name == job.repo)\
+                .where(repos_table.c.deleted_at.isnot(None))
+        )
+    conn.execute(
+        sa.update(deletions_table)\
+            .where(deletions_table.c.id == job.id)\
+            .values(finished=datetime.utcnow(), error=None)
+    )
+
+
+def run_batch(conn: Any, job: Any, limit: int):
+    '''Deletes next batch of objects of locked deletion row'''
+    values: dict[str, Any] = {}
+    if job.total is None:
+        values['total'] = _count(conn, job)
+
+    scope = job.scope
+    if scope is None:  # scopes of deleted repo are deleted one by one
+        scope = conn.execute(_next_scope, dict(repo=job.repo)).scalar()
+        if scope is None:
+            _finish(conn, job)
+            return
+
+    sids = conn.execute(
+        _delete_batch,
+        dict(scope=scope, repo=job.repo, limit=limit),
+    ).scalars().all()
+    if not sids:
+        # scope row goes last, so its deletion cascades to nothing
+        conn.execute(
+            sa.delete(scopes_table)\
+                .where(scopes_table.c.name == scope)\
+                .where(scopes_table.c.repo == job.repo)\
+                .where(scopes_table.c.deleted_at.isnot(None))
+        )
+        if job.scope is not None:
+            _finish(conn, job)
+    released = 0
+    unique = list({sid for sid in sids if sid is not None})
+    if unique:
+        released = conn.execute(_release_storage,
+                                dict(sids=unique)).rowcount
+    conn.execute(
+        sa.update(deletions_table)\
+            .where(deletions_table.c.id == job.id)\
+            .values(
+                deleted=deletions_table.c.deleted + len(sids),
+                released=deletions_table.c.released + released,
+                **values,
+            )
+    )
+    DELETION_OBJECTS.inc(amount=len(sids))
+
+
+class DeletionWorker:
+    '''Runs queued deletions in thread until there is no work, then waits
+
+    Deletion row is locked while its batch runs, so servers sharing
+    database run different deletions. Deletions queued by other servers
+    are noticed within `deletion.interval` seconds.
+    '''
+    def __init__(self):
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self._run,
+            name='deletion',
+            daemon=True,
+        )
+        self.thread.start()
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        engine = sa.create_engine(
+            settings['database.uri_sync'],
+            echo=settings['database.echo'],
+            pool_size=1,
+        )
+        instrument_engine(engine)
+        log_slow_statements(engine)
+        try:
+            while not self.stopped.is_set():
+                self.wakeup.clear()
+                if self._step(engine):
+                    self.stopped.wait(settings['deletion.pause'])
+                else:
+                    self.wakeup.wait(settings['deletion.interval'])
+        finally:
+            engine.dispose()
+
+    def _step(self, engine: Any) -> bool:
+        '''Runs one batch, returns false when there is no work'''
+        job = None
+        try:
+            with engine.begin() as conn:
+                job = conn.execute(_next_job).first()
+                if job is None:
+                    conn.execute(
+                        sa.delete(deletions_table)\
+                            .where(deletions_table.c.finished <
+                                   datetime.utcnow() - _KEEP)
+                    )
+                    return False
+                run_batch(conn, job, settings['deletion.batch'])
+            return True
+        except Exception as e:
+            logger.exception('deletion batch failed')
+            if job is not None:
+                with engine.begin() as conn:
+                    conn.execute(
+                        sa.update(deletions_table)\
+                            .where(deletions_table.c.id == job.id)\
+                            .values(error=str(e))
+                    )
+            return False
+
+
+worker = DeletionWorker()
@@ -0,0 +1,37 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class DeletionState(str, Enum):
+    queued = 'queued'
+    running = 'running'
+    done = 'done'
+
+
+class Deletion(BaseModel):
+    id: int
+    repo: str
+    scope: Optional[str] = Field(
+        None,
+        description='`null` when whole repo is deleted',
+    )
+    state: DeletionState
+    started: datetime
+    finished: Optional[datetime] = None
+    total: Optional[int] = Field(
+        None,
+        description='Objects to delete, `null` until worker took deletion',
+    )
+    deleted: int = Field(..., description='Objects deleted so far')
+    released: int = Field(
+        ...,
+        description='Storage entries no longer used by any object, their '
+        'data is removed by storage reaper',
+    )
+    error: Optional[str] = Field(
+        None,
+        description='Last error of worker, deletion is retried',
+    )
@@ -12,3 +12,26 @@ class Object(BaseModel):
     )
     creator: str
     timestamp: datetime
+    size: Optional[int] = Field(
+        None,
+        description='Size of data in bytes, `null` when data is `null` or '
+        'size is unknown',
+    )
+    content_type: Optional[str] = Field(
+        None,
+        alias='contentType',
+        description='Media type given on upload, `null` when data is `null` '
+        'or type is unknown',
+    )
+
+
+class Tree(BaseModel):
+    objects: list[Object] = Field(
+        ...,
+        description='Objects which keys have no delimiter after prefix',
+    )
+    prefixes: list[str] = Field(
+        ...,
+        description='Common key prefixes up to and including first '
+        'delimiter after prefix',
+    )
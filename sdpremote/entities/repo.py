@@ -0,0 +1,10 @@
+from pydantic import BaseModel, Field
+
+
+class Repo(BaseModel):
+    name: str
+    size: int = Field(
+        ...,
+        description='Total size of data of all scopes objects in bytes. '
+        'Data shared by objects is counted for each of them',
+    )
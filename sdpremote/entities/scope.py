@@ -27,3 +27,7 @@ class Scope(BaseModel):
         description=
         'Milliseconds since epoch of most recent object, `null` if no objects in scope',
     )
+    size: int = Field(
+        0,
+        description='Total size of data of scope objects in bytes',
+    )
@@ -0,0 +1,312 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, Optional
+
+import sqlalchemy as sa
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .database import pool_stats
+
+Labels = tuple[str, ...]
+
+_registry: list['_Metric'] = []
+
+# name of route being processed, for logs
+current_route: ContextVar[str] = ContextVar('current_route', default='-')
+
+_DEFAULT_BUCKETS = (
+    .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n')\
+        .replace('"', r'\"')
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, doc: str, labels: Labels = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _format(self, values: Labels, extra: Labels = ()) -> str:
+        pairs = [
+            f'{name}="{_escape(str(value))}"'
+            for name, value in zip(self.labels, values)
+        ]
+        pairs.extend(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        head = f'# HELP {self.name} {self.doc}\n' \
+            f'# TYPE {self.name} {self.kind}\n'
+        return head + ''.join(f'{s}\n' for s in self.samples())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, doc: str, labels: Labels = ()):
+        super().__init__(name, doc, labels)
+        self.values: defaultdict[Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in values:
+            yield f'{self.name}{self._format(labels)} {value}'
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def __init__(
+            self,
+            name: str,
+            doc: str,
+            labels: Labels = (),
+            collect: Optional[Callable[[], Iterable[tuple[Labels,
+                                                          float]]]] = None,
+    ):
+        super().__init__(name, doc, labels)
+        self.values: defaultdict[Labels, float] = defaultdict(float)
+        self.collect = collect
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self.lock:
+            self.values[labels] += amount
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self) -> Iterable[str]:
+        if self.collect is not None:
+            values = list(self.collect())
+        else:
+            with self.lock:
+                values = list(self.values.items())
+        for labels, value in values:
+            yield f'{self.name}{self._format(labels)} {value}'
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            doc: str,
+            labels: Labels = (),
+            buckets: tuple[float, ...] = _DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+        # per labels: counts of each bucket (not cumulative), +Inf, sum
+        self.values: dict[Labels, list[float]] = {}
+
+    def observe(self, value: float, *labels: str):
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.values.get(labels)
+            if row is None:
+                row = self.values[labels] = [0.] * (len(self.buckets) + 2)
+            row[idx] += 1
+            row[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self.lock:
+            values = [(k, list(v)) for k, v in self.values.items()]
+        for labels, row in values:
+            total = 0.
+            for bound, count in zip(self.buckets + (float('inf'), ), row):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket = self._format(labels, (f'le="{le}"', ))
+                yield f'{self.name}_bucket{bucket} {total}'
+            yield f'{self.name}_sum{self._format(labels)} {row[-1]}'
+            yield f'{self.name}_count{self._format(labels)} {total}'
+
+
+def render() -> str:
+    return ''.join(metric.render() for metric in _registry)
+
+
+REQUESTS_IN_FLIGHT = Gauge(
+    'sdpremote_http_requests_in_flight',
+    'Requests being processed',
+    ('route', ),
+)
+REQUEST_LATENCY = Histogram(
+    'sdpremote_http_request_duration_seconds',
+    'Time to process request, including sending response body',
+    ('route', 'method'),
+)
+REQUESTS = Counter(
+    'sdpremote_http_requests_total',
+    'Processed requests',
+    ('route', 'method', 'status'),
+)
+QUERY_LATENCY = Histogram(
+    'sdpremote_db_query_duration_seconds',
+    'SQL statement execution time',
+    ('statement', ),
+)
+STORAGE_LATENCY = Histogram(
+    'sdpremote_storage_duration_seconds',
+    'Duration of storage operations',
+    ('operation', ),
+)
+STORAGE_BYTES = Counter(
+    'sdpremote_storage_bytes_total',
+    'Bytes transferred to and from storage',
+    ('operation', ),
+)
+COALESCED_REQUESTS = Counter(
+    'sdpremote_coalesced_requests_total',
+    'Reads served by identical read already in flight',
+    ('route', ),
+)
+SLOW_QUERIES = Counter(
+    'sdpremote_db_slow_queries_total',
+    'SQL statements slower than slowlog.threshold',
+    ('statement', ),
+)
+REAPER_RUNS = Counter(
+    'sdpremote_reaper_runs_total',
+    'Runs of expired storage reaper',
+    ('result', ),
+)
+REAPER_LATENCY = Histogram(
+    'sdpremote_reaper_duration_seconds',
+    'Duration of expired storage reaper run',
+    buckets=(1., 5., 15., 60., 300., 900., 3600.),
+)
+REAPER_DELETED = Counter(
+    'sdpremote_reaper_deleted_total',
+    'Storage objects deleted by reaper',
+)
+DELETION_OBJECTS = Counter(
+    'sdpremote_deletion_objects_total',
+    'Objects removed by background deletion of repos and scopes',
+)
+SCRUB_CHECKS = Counter(
+    'sdpremote_scrub_checks_total',
+    'Stored data checked by scrubber',
+    ('source', 'result'),
+)
+SCRUB_BYTES = Counter(
+    'sdpremote_scrub_bytes_total',
+    'Bytes read from storage by scrubber',
+)
+TIERING_MOVES = Counter(
+    'sdpremote_tiering_moves_total',
+    'Storage entries moved between tiers, by target tier',
+    ('tier', ),
+)
+TIER_BYTES = Gauge(
+    'sdpremote_tier_bytes',
+    'Bytes of stored data in tier, as of last tiering pass',
+    ('tier', ),
+)
+
+
+def _pool_stats() -> Iterable[tuple[Labels, float]]:
+    return [((name, ), value) for name, value in pool_stats().items()]
+
+
+Gauge(
+    'sdpremote_db_pool',
+    'Connection pool statistics, see GET /pool',
+    ('stat', ),
+    collect=_pool_stats,
+)
+
+
+def statement_type(statement: str) -> str:
+    head = statement.lstrip()[:16].split(None, 1)
+    return head[0].upper() if head else ''
+
+
+def instrument_engine(engine: sa.engine.Engine):
+    '''Record execution time of each statement of engine'''
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn: Any, cursor, statement, parameters,
+                              context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn: Any, cursor, statement, parameters,
+                             context, executemany):
+        start = conn.info['query_start'].pop()
+        QUERY_LATENCY.observe(
+            time.perf_counter() - start,
+            statement_type(statement),
+        )
+
+    @sa.event.listens_for(engine, 'handle_error')
+    def handle_error(context: Any):
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+class MetricsMiddleware:
+    '''Tracks in flight requests and latency per route'''
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.routes: Optional[list[Any]] = None
+
+    def _route(self, scope: Scope) -> str:
+        if self.routes is None:
+            self.routes = scope['app'].router.routes
+        for route in self.routes:  # type: ignore
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.name
+        return 'unmatched'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        route = self._route(scope)
+        current_route.set(route)
+        method = scope['method']
+        status = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.observe(time.perf_counter() - start, route,
+                                    method)
+            REQUESTS.inc(route, method, str(status))
+            REQUESTS_IN_FLIGHT.dec(route)
@@ -0,0 +1,154 @@
+'''Online migration of objects table to hash partitioned one
+
+Migration `partition objects table` creates partitioned copy of objects,
+which is kept in sync with objects by trigger. Existing rows are copied by
+this tool in short batches, while server is running:
+
+    python -m sdpremote.partitioning backfill --batch 5000 --pause 0.1
+    python -m sdpremote.partitioning status
+
+Migration `swap partitioned objects table` replaces objects with its copy.
+When backfill is not finished, it copies rest of rows itself, holding lock
+on objects, which is fine only for small tables.
+'''
+import argparse
+import logging
+import time
+from typing import Any, Optional
+
+import sqlalchemy as sa
+
+logger = logging.getLogger(__name__)
+
+SHADOW = 'objects_partitioned'
+PROGRESS = 'objects_backfill'
+
+_lock_batch = sa.text('''
+    SELECT key, scope, repo FROM objects
+    WHERE (key, scope, repo) > (:key, :scope, :repo)
+    ORDER BY key, scope, repo
+    LIMIT :limit
+    FOR SHARE
+''')
+_lock_first_batch = sa.text('''
+    SELECT key, scope, repo FROM objects
+    ORDER BY key, scope, repo
+    LIMIT :limit
+    FOR SHARE
+''')
+# rows changed after trigger was created are copied by trigger already
+_copy_batch = sa.text(f'''
+    INSERT INTO {SHADOW}
+    SELECT * FROM objects
+    WHERE (key, scope, repo) > (:key, :scope, :repo)
+        AND (key, scope, repo) <= (:last_key, :last_scope, :last_repo)
+    ON CONFLICT DO NOTHING
+''')
+_copy_first_batch = sa.text(f'''
+    INSERT INTO {SHADOW}
+    SELECT * FROM objects
+    WHERE (key, scope, repo) <= (:last_key, :last_scope, :last_repo)
+    ON CONFLICT DO NOTHING
+''')
+
+
+def progress(conn: Any) -> Optional[Any]:
+    '''Row with last copied key and state, None without migration'''
+    exists = conn.execute(sa.text('SELECT to_regclass(:name)'),
+                          dict(name=PROGRESS)).scalar()
+    if exists is None:
+        return None
+    return conn.execute(
+        sa.text(f'SELECT key, scope, repo, copied, done FROM {PROGRESS}')
+    ).one()
+
+
+def copy_batch(conn: Any, limit: int) -> int:
+    '''Copies next batch of rows, returns number of copied rows
+
+    Copied rows are locked until commit, so their concurrent changes are
+    applied by trigger after the copy.
+    '''
+    state = progress(conn)
+    if state is None:
+        raise RuntimeError(f'{PROGRESS} table not found, run migrations')
+    if state.done:
+        return 0
+    start = dict(key=state.key, scope=state.scope, repo=state.repo)
+    first = state.key is None
+    rows = conn.execute(
+        _lock_first_batch if first else _lock_batch,
+        dict(start, limit=limit),
+    ).all()
+    if not rows:
+        conn.execute(sa.text(f'UPDATE {PROGRESS} SET done = true'))
+        return 0
+    last_key, last_scope, last_repo = rows[-1]
+    conn.execute(
+        _copy_first_batch if first else _copy_batch,
+        dict(
+            start,
+            last_key=last_key,
+            last_scope=last_scope,
+            last_repo=last_repo,
+        ),
+    )
+    conn.execute(
+        sa.text(f'''
+            UPDATE {PROGRESS}
+            SET key = :key, scope = :scope, repo = :repo,
+                copied = copied + :copied
+        '''),
+        dict(key=last_key, scope=last_scope, repo=last_repo,
+             copied=len(rows)),
+    )
+    return len(rows)
+
+
+def backfill(engine: Any, limit: int, pause: float):
+    '''Copies all rows, each batch in own transaction'''
+    while True:
+        with engine.begin() as conn:
+            copied = copy_batch(conn, limit)
+            state = progress(conn)
+        if state.done:
+            logger.info('backfill is done, %d rows copied', state.copied)
+            return
+        logger.info('copied %d rows, %d total, last key %r', copied,
+                    state.copied, state.key)
+        time.sleep(pause)
+
+
+def main():
+    from .config import settings
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('backfill', help='copy existing rows')
+    run.add_argument('--batch', type=int, default=5000,
+                     help='rows copied in one transaction')
+    run.add_argument('--pause', type=float, default=0.1,
+                     help='seconds between batches')
+    commands.add_parser('status', help='show progress')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    engine = sa.create_engine(settings['database.uri_sync'])
+    try:
+        if args.command == 'backfill':
+            backfill(engine, args.batch, args.pause)
+        else:
+            with engine.connect() as conn:
+                state = progress(conn)
+            if state is None:
+                print('no migration in progress')
+            else:
+                print(f'copied {state.copied} rows, done {state.done}, '
+                      f'last key {state.key!r} {state.scope!r} '
+                      f'{state.repo!r}')
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import cProfile
+import heapq
+import logging
+import os
+import random
+import re
+import time
+import uuid
+from typing import Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+_unsafe = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+class ProfilingMiddleware:
+    '''Runs requests under cProfile and stores profiles to directory
+
+    Request is profiled when it has `X-Profile` header equal to configured
+    token (profile name is returned in `X-Profile` response header) or when
+    it is sampled with `profiling.sample_rate`, then profile is kept only if
+    request is among `profiling.keep` slowest sampled ones.
+
+    Profiler is enabled for event loop thread, so it also sees other
+    requests interleaved with profiled one, and work done in worker
+    threads (storage calls) shows up as waiting. Only one request is
+    profiled at a time.
+    '''
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.token: str = settings['profiling.token']
+        self.sample_rate: float = settings['profiling.sample_rate']
+        self.keep: int = settings['profiling.keep']
+        self.dir: str = settings['profiling.dir']
+        self.slowest: list[tuple[float, str]] = []  # min heap
+        self.active = False
+        os.makedirs(self.dir, exist_ok=True)
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(settings['profiling.token']) or \
+            settings['profiling.sample_rate'] > 0
+
+    def _requested(self, scope: Scope) -> bool:
+        if not self.token:
+            return False
+        return Headers(scope=scope).get('x-profile') == self.token
+
+    def _name(self, scope: Scope) -> str:
+        path = _unsafe.sub('_', scope['path']).strip('_')[:64]
+        return f'{int(time.time())}-{scope["method"]}-{path}-' \
+            f'{uuid.uuid4().hex[:8]}.prof'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or self.active:
+            await self.app(scope, receive, send)
+            return
+        requested = self._requested(scope)
+        if not requested and random.random() >= self.sample_rate:
+            await self.app(scope, receive, send)
+            return
+
+        name = self._name(scope)
+
+        async def send_wrapper(message: Message):
+            if requested and message['type'] == 'http.response.start':
+                # headers list may be shared with response of other request
+                message = {**message,
+                           'headers': list(message.get('headers', []))}
+                MutableHeaders(scope=message).append('X-Profile', name)
+            await send(message)
+
+        profile = cProfile.Profile()
+        self.active = True
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile.disable()
+            self.active = False
+            elapsed = time.perf_counter() - start
+            if requested:
+                self._dump(profile, name)
+            else:
+                self._keep_slowest(profile, name, elapsed)
+
+    def _dump(self, profile: cProfile.Profile, name: str):
+        path = os.path.join(self.dir, name)
+        profile.dump_stats(path)
+        logger.info('stored profile %s', path)
+
+    def _keep_slowest(
+            self,
+            profile: cProfile.Profile,
+            name: str,
+            elapsed: float,
+    ):
+        evicted: Optional[str] = None
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (elapsed, name))
+        elif self.slowest and elapsed > self.slowest[0][0]:
+            _, evicted = heapq.heapreplace(self.slowest, (elapsed, name))
+        else:
+            return
+        self._dump(profile, name)
+        if evicted is not None:
+            try:
+                os.remove(os.path.join(self.dir, evicted))
+            except FileNotFoundError:
+                pass
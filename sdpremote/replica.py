@@ -0,0 +1,171 @@
+import itertools
+import logging
+import math
+import re
+import time
+from http.cookies import SimpleCookie
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+
+import sqlalchemy as sa
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+from .database import create_engine, engine
+from .utils.singleflight import barrier, flights
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+replicas: list[Any] = [
+    create_engine(uri) for uri in settings['database.replicas']
+]
+_next_replica = itertools.cycle(range(len(replicas)))
+# replica index -> time until which it is not used after failure
+_failed: dict[int, float] = {}
+# repo -> time until which its reads go to primary
+_written: dict[str, float] = {}
+_MAX_WRITTEN = 10000  # expired entries are dropped above this size
+
+# WAL position of client's last write, replica is used for its reads only
+# when it has replayed that far. Cookie carries it to any server worker
+LSN_COOKIE = 'sdp-lsn'
+_LSN = re.compile(r'[0-9A-F]{1,8}/[0-9A-F]{1,8}')
+_caught_up = sa.text('SELECT pg_last_wal_replay_lsn() >= '
+                     'CAST(CAST(:lsn AS text) AS pg_lsn)')
+
+
+def mark_written(repo: str):
+    if not replicas:
+        return
+    now = time.monotonic()
+    if len(_written) > _MAX_WRITTEN:
+        for name, until in list(_written.items()):
+            if until <= now:
+                del _written[name]
+    _written[repo] = now + settings['database.replica_sticky']
+
+
+def _pick_replica(repo: str) -> Optional[int]:
+    now = time.monotonic()
+    if _written.get(repo, 0) > now:
+        return None
+    _written.pop(repo, None)
+    for _ in range(len(replicas)):
+        i = next(_next_replica)
+        if _failed.get(i, 0) <= now:
+            return i
+    return None
+
+
+async def run_read(repo: str, fn: Callable[[Any], Awaitable[T]]) -> T:
+    '''Runs read only fn(conn) on replica, falling back to primary
+
+    Repo recently written through this worker is read from primary, so
+    clients see their own changes despite replication lag. Writes made
+    through other workers are known from LSN cookie, replica which has not
+    replayed them yet is not used.
+    '''
+    i = _pick_replica(repo)
+    if i is not None:
+        lsn = barrier.get()
+        try:
+            async with replicas[i].connect() as conn:
+                if lsn is None or (await conn.execute(
+                        _caught_up, dict(lsn=lsn))).scalar():
+                    return await fn(conn)
+        except (OSError, sa.exc.DBAPIError, sa.exc.TimeoutError) as e:
+            logger.warning('replica %d failed, using primary: %s', i, e)
+            _failed[i] = time.monotonic() + settings['database.replica_retry']
+    async with engine.connect() as conn:
+        return await fn(conn)
+
+
+class ReadYourWrites:
+    '''Makes reads of repo sticky to primary after its modification
+
+    Reads of repo which were in flight during modification are not shared
+    with later requests. Response to modification sets cookie with WAL
+    position of primary for `database.replica_sticky` seconds, so reads of
+    the client are consistent on every worker and server.
+    '''
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        repo = _modified_repo(scope)
+        if repo is None:
+            lsn = _client_lsn(scope) if replicas else None
+            if lsn is None:
+                await self.app(scope, receive, send)
+                return
+            token = barrier.set(lsn)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                barrier.reset(token)
+            return
+        # reads racing with modification go to primary too
+        mark_written(repo)
+        await self.app(scope, receive, _committed(repo, send))
+
+
+def _client_lsn(scope: Scope) -> Optional[str]:
+    if scope['type'] != 'http':
+        return None
+    cookie: SimpleCookie = SimpleCookie()
+    try:
+        cookie.load(Headers(scope=scope).get('cookie', ''))
+    except Exception:
+        return None
+    morsel = cookie.get(LSN_COOKIE)
+    if morsel is None or not _LSN.fullmatch(morsel.value):
+        return None
+    return morsel.value
+
+
+async def _current_lsn() -> Optional[str]:
+    try:
+        async with engine.connect() as conn:
+            return (await conn.execute(
+                sa.text('SELECT pg_current_wal_lsn()::text'))).scalar()
+    except (OSError, sa.exc.DBAPIError, sa.exc.TimeoutError) as e:
+        logger.warning('cannot read WAL position: %s', e)
+        return None
+
+
+def _modified_repo(scope: Scope) -> Optional[str]:
+    if scope['type'] != 'http' or scope['method'] in ('GET', 'HEAD',
+                                                      'OPTIONS'):
+        return None
+    parts = scope['path'].split('/', 3)
+    if len(parts) >= 3 and parts[1] and parts[2]:
+        return f'{parts[1]}/{parts[2]}'
+    return None
+
+
+def _sticky_seconds() -> int:
+    return max(1, math.ceil(settings['database.replica_sticky']))
+
+
+def _committed(repo: str, send: Send) -> Send:
+    async def send_wrapper(message: Message):
+        if message['type'] == 'http.response.start':
+            # modification is committed and client may read it right away,
+            # before response body and background tasks are done
+            mark_written(repo)
+            flights.forget(repo)
+            lsn = await _current_lsn() if replicas else None
+            if lsn is not None:
+                # headers list may be shared with other responses
+                message = {**message,
+                           'headers': list(message.get('headers', []))}
+                MutableHeaders(scope=message).append(
+                    'set-cookie',
+                    f'{LSN_COOKIE}={lsn}; Max-Age={_sticky_seconds()}; '
+                    f'Path=/; HttpOnly; SameSite=Lax',
+                )
+        await send(message)
+
+    return send_wrapper
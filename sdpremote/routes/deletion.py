@@ -0,0 +1,78 @@
+from typing import Any, Optional
+
+import sqlalchemy as sa
+from fastapi import APIRouter, Depends, HTTPException, Path, Request, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from ..database import deletions_table, engine
+from ..deletion import worker
+from ..entities.deletion import Deletion, DeletionState
+from ..utils.user import user
+
+router = APIRouter(tags=['deletion'])
+
+accepted_response: dict[str, Any] = {
+    'model': Deletion,
+    'description': 'Deletion is queued (with `async`), see `Location`',
+}
+
+
+def to_deletion(row: Any) -> Deletion:
+    if row.finished is not None:
+        state = DeletionState.done
+    elif row.total is not None:
+        state = DeletionState.running
+    else:
+        state = DeletionState.queued
+    return Deletion(state=state, **row)
+
+
+async def queue_deletion(
+        request: Request,
+        repo: str,
+        scope: Optional[str],
+        conn: Any,  # HACK AsyncConnection
+) -> JSONResponse:
+    '''Queues deletion of tombstoned repo or scope, commits transaction'''
+    result: Any = await conn.execute(
+        sa.insert(deletions_table)\
+            .values(repo=repo, scope=scope)\
+            .returning(deletions_table)
+    )
+    deletion = to_deletion(result.mappings().one())
+    await conn.commit()
+    worker.wake()
+    return JSONResponse(
+        jsonable_encoder(deletion),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={
+            'location': request.url_for('get_deletion', did=deletion.id),
+        },
+    )
+
+
+@router.get(
+    '/.deletions/{did}',
+    response_model=Deletion,
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Deletion not found',
+        },
+    },
+)
+async def get_deletion(
+        did: int = Path(...),
+        username: str = Depends(user),
+) -> Deletion:
+    async with engine.connect() as conn:
+        result: Any = await conn.execute(
+            sa.select([deletions_table])\
+                .where(deletions_table.c.id == did)\
+                .where(deletions_table.c.repo.startswith(f'{username}/',
+                                                         autoescape=True))
+        )
+        row = result.mappings().first()
+    if row is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    return to_deletion(row)
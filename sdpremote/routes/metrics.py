@@ -0,0 +1,18 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from .. import metrics
+
+router = APIRouter(tags=['status'])
+
+
+@router.get(
+    '/metrics',
+    response_class=PlainTextResponse,
+    include_in_schema=False,
+)
+def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        metrics.render(),
+        media_type='text/plain; version=0.0.4',
+    )
@@ -1,53 +1,189 @@
-from datetime import timedelta
-from typing import Optional, Union
+import asyncio
+import json
+from urllib.parse import urlencode
+from typing import Any, AsyncIterator, Optional, Union
 
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException, Path, Query, status
-from fastapi.responses import RedirectResponse, Response
+from fastapi import (APIRouter, Depends, HTTPException, Path, Query, Request,
+                     status)
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy.dialects import postgresql
 
-from ..database import engine, objects_table
-from ..entities.object import Object
-from ..storage import storage
+from ..config import settings
+from ..database import engine, objects_table, scopes_table, storage_table
+from ..entities.object import Object, Tree
+from ..replica import run_read
+from ..storage import (DEFAULT_CONTENT_TYPE, PRESIGNED_TTL, Tier, openObject,
+                       presign_many, stat_stored, storage)
+from ..tiering import accesses
+from ..utils.archive import (Compression, Entry, compress_stream, tar_stream,
+                             zstandard)
+from ..utils.compression import accepts_encoding
+from ..utils.listing import (encode_rows, encoded_response, msgpack_response,
+                             wants_msgpack)
+from ..utils.query import like_prefix
+from ..utils.singleflight import flights
+from ..utils.tree import list_children
 from .repo import repo_name
 
 router = APIRouter(tags=['object'])
 
+_PARTITION_SIZE = 1000
+
+
+# columns labeled by Object field aliases, so rows are encoded as is
+_object_columns = [
+    objects_table.c.key,
+    objects_table.c.checksum,
+    objects_table.c.creator,
+    objects_table.c.timestamp,
+    objects_table.c.size,
+    objects_table.c.content_type.label('contentType'),
+]
+
+# objects of tombstoned scope are hidden until its deletion removes them,
+# condition is one lookup of scope for whole query
+_visible = ~sa.exists()\
+    .where(scopes_table.c.name == objects_table.c.scope)\
+    .where(scopes_table.c.repo == objects_table.c.repo)\
+    .where(scopes_table.c.deleted_at.isnot(None))
+
+_objects_query = sa.select(_object_columns)\
+    .where(objects_table.c.scope == sa.bindparam('scope'))\
+    .where(objects_table.c.repo == sa.bindparam('repo'))\
+    .where(_visible)
+_objects_by_key_query = _objects_query\
+    .where(objects_table.c.key == sa.bindparam('key'))
+_objects_by_prefix_query = _objects_query\
+    .where(objects_table.c.key.like(sa.bindparam('pattern'), escape='/'))
+
+_data_query = sa.select([
+    objects_table.c.data,
+    storage_table.c.compression,
+    storage_table.c.chunked,
+    objects_table.c.size,
+    objects_table.c.content_type,
+    storage_table.c.tier,
+]).select_from(objects_table.outerjoin(storage_table))\
+    .where(objects_table.c.key == sa.bindparam('key'))\
+    .where(objects_table.c.scope == sa.bindparam('scope'))\
+    .where(objects_table.c.repo == sa.bindparam('repo'))\
+    .where(_visible)
+
+_head_query = sa.select([
+    objects_table.c.data,
+    objects_table.c.checksum,
+    # size of object is copied from storage entry, which may know it
+    sa.func.coalesce(objects_table.c.size, storage_table.c.size),
+    objects_table.c.content_type,
+    storage_table.c.tier,
+]).select_from(objects_table.outerjoin(storage_table))\
+    .where(objects_table.c.key == sa.bindparam('key'))\
+    .where(objects_table.c.scope == sa.bindparam('scope'))\
+    .where(objects_table.c.repo == sa.bindparam('repo'))\
+    .where(_visible)
+
+
+class DataRequest(BaseModel):
+    keys: Optional[list[str]] = Field(
+        None,
+        description='Keys to resolve. All objects of scope are resolved '
+        'when both `keys` and `prefix` are `null`',
+    )
+    prefix: Optional[str] = Field(
+        None,
+        description='Resolve all objects which key starts with prefix',
+    )
+
 
 @router.get(
     '/{user}/{repo}/{scope}',
     response_model=list[Object],
     responses={
+        status.HTTP_200_OK: msgpack_response,
         status.HTTP_404_NOT_FOUND: {
             'descrtiption': 'Something not found',
         },
     },
 )
 async def list_objects(
+        request: Request,
         repo: str = Depends(repo_name),
         scope: str = Path(...),
         key: Optional[str] = Query(None),
         is_prefix: bool = Query(True),
-) -> list[Object]:
-    query = sa.select([
-        objects_table.c.key,
-        objects_table.c.checksum,
-        objects_table.c.creator,
-        objects_table.c.timestamp,
-    ]).where(objects_table.c.scope == scope)\
-        .where(objects_table.c.repo == repo)
+) -> Response:
+    query = _objects_query
+    params = dict(scope=scope, repo=repo)
     if key:
         if is_prefix:
-            query = query.where(objects_table.c.key.like(f'{key}%'))
+            query = _objects_by_prefix_query
+            params['pattern'] = like_prefix(key)
 
         else:
-            query = query.where(objects_table.c.key == key)
-    async with engine.connect() as conn:
-        res: list[Object] = list(
-            map(
-                lambda d: Object(**d),
-                (await conn.execute(query)).mappings(),
-            ))
-    return res
+            query = _objects_by_key_query
+            params['key'] = key
+    async def fetch(conn: Any) -> tuple[Any, list[Any]]:
+        result: Any = await conn.execute(query, params)
+        return result.keys(), result.all()
+
+    accept = request.headers.get('accept')
+
+    async def respond() -> tuple[bytes, str]:
+        keys, rows = await run_read(repo, fetch)
+        return encode_rows(keys, rows, accept)
+
+    # identical listings requested at once share query and encoded body
+    body, media_type = await flights.do(
+        repo,
+        ('list_objects', tuple(sorted(params.items())),
+         wants_msgpack(accept)),
+        respond,
+    )
+    # waiters share body only, headers of response are per request
+    return encoded_response(body, media_type)
+
+
+@router.get(
+    '/{user}/{repo}/{scope}/tree',
+    response_model=Tree,
+)
+async def list_tree(
+        repo: str = Depends(repo_name),
+        scope: str = Path(...),
+        prefix: str = Query(''),
+        delimiter: str = Query('/', min_length=1),
+) -> Tree:
+    async def fetch(conn: Any) -> Tree:
+        keys, prefixes = await list_children(
+            repo,
+            scope,
+            prefix,
+            delimiter,
+            conn,
+        )
+        objects: list[Object] = []
+        if keys:
+            query = sa.select(_object_columns)\
+                .where(objects_table.c.scope == scope)\
+                .where(objects_table.c.repo == repo)\
+                .where(_visible)\
+                .where(objects_table.c.key == sa.any_(
+                    sa.bindparam(
+                        'keys',
+                        keys,
+                        type_=postgresql.ARRAY(sa.Text),
+                    )))\
+                .order_by(objects_table.c.key.collate('C'))
+            objects = list(
+                map(
+                    lambda d: Object(**d),
+                    (await conn.execute(query)).mappings(),
+                ))
+        return Tree(objects=objects, prefixes=prefixes)
+
+    return await run_read(repo, fetch)
 
 
 @router.get(
@@ -65,25 +201,311 @@ async def list_objects(
     },
 )
 async def get_data(
+        request: Request,
         repo: str = Depends(repo_name),
         scope: str = Path(...),
         key: str = Path(...),
 ) -> Union[RedirectResponse, Response]:
-    query = sa.select([objects_table.c.data])\
-        .where(objects_table.c.key == key)\
-        .where(objects_table.c.scope == scope)\
-        .where(objects_table.c.repo == repo)
-    async with engine.connect() as conn:
-        result = await conn.execute(query)
-    try:
-        sid = result.scalar_one()
-    except sa.exc.NoResultFound:  # type: ignore
+    '''Redirects to data or streams it when client cannot decode it
+
+    Compressed data is served as is with `Content-Encoding` to clients
+    accepting its encoding, other clients get original data from server.
+    Chunked data is always reassembled by server, data in cold tier is
+    always served by server
+    '''
+    async def fetch(conn: Any) -> Any:
+        result: Any = await conn.execute(
+            _data_query,
+            dict(key=key, scope=scope, repo=repo),
+        )
+        return result.first()
+
+    row = await flights.do(
+        repo,
+        ('get_data', scope, key),
+        lambda: run_read(repo, fetch),
+    )
+    if row is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    sid, compression, chunked, size, content_type, tier = row
+    if not sid:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    accesses.touch(sid)
+    hot = tier == Tier.hot
+    if compression is None and not chunked and hot:
+        url = storage.presigned_get_object(
+            'sdpremote',
+            str(sid),
+            PRESIGNED_TTL,
+        )
+        return RedirectResponse(url)
+    if compression is not None and hot and accepts_encoding(
+            request.headers.get('accept-encoding'), compression):
+        urls = await asyncio.to_thread(presign_many, [(sid, compression)])
+        return RedirectResponse(urls[0])
+
+    stream = await openObject(sid, compression, size, chunked, tier)
+
+    async def body() -> AsyncIterator[bytes]:
+        try:
+            while chunk := await stream.read():
+                yield chunk
+        finally:
+            stream.close()
+
+    return StreamingResponse(
+        body(),
+        media_type=content_type or DEFAULT_CONTENT_TYPE,
+        headers={
+            'content-length': str(stream.size),
+            'vary': 'Accept-Encoding',
+        },
+    )
+
+
+@router.get(
+    '/{user}/{repo}/{scope}/data',
+    responses={
+        status.HTTP_204_NO_CONTENT: {
+            'description': 'Data is null'
+        },
+        status.HTTP_307_TEMPORARY_REDIRECT: {
+            'description': 'Redirect to data'
+        },
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Something not found'
+        }
+    },
+)
+async def get_data_by_key(
+        request: Request,
+        repo: str = Depends(repo_name),
+        scope: str = Path(...),
+        key: str = Query(...),
+) -> Union[RedirectResponse, Response]:
+    '''Same as data of object, for keys which contain slashes'''
+    return await get_data(request, repo, scope, key)
+
+
+@router.head(
+    '/{user}/{repo}/{scope}/{key}/data',
+    response_class=Response,
+    responses={
+        status.HTTP_200_OK: {
+            'description': 'Data exists, `Content-Length`, `Content-Type` '
+            'and `ETag` (checksum) describe it'
+        },
+        status.HTTP_204_NO_CONTENT: {
+            'description': 'Data is null'
+        },
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Something not found'
+        }
+    },
+)
+async def head_data(
+        repo: str = Depends(repo_name),
+        scope: str = Path(...),
+        key: str = Path(...),
+) -> Response:
+    async def fetch(conn: Any) -> Any:
+        result: Any = await conn.execute(
+            _head_query,
+            dict(key=key, scope=scope, repo=repo),
+        )
+        return result.first()
+
+    row = await flights.do(
+        repo,
+        ('head_data', scope, key),
+        lambda: run_read(repo, fetch),
+    )
+    if row is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
+    sid, checksum, size, content_type, tier = row
     if not sid:
         return Response(status_code=status.HTTP_204_NO_CONTENT)
-    url = storage.presigned_get_object(
-        'sdpremote',
-        str(sid),
-        timedelta(hours=6),
+    if size is None:
+        # uploaded before sizes were recorded, so never compressed
+        stat = await asyncio.to_thread(stat_stored, str(sid), Tier(tier))
+        size, content_type = stat.size, content_type or stat.content_type
+    return Response(headers={
+        'content-length': str(size),
+        'content-type': content_type or DEFAULT_CONTENT_TYPE,
+        'etag': f'"{checksum}"',
+    })
+
+
+async def _data_urls(
+        request: Request,
+        query: sa.sql.Select,
+        keys: Optional[list[str]],
+) -> AsyncIterator[bytes]:
+    missing = set(keys) if keys else set()
+    accept_encoding = request.headers.get('accept-encoding')
+    # key may contain slashes, so it is passed in query
+    base = request.url_for(
+        'get_data_by_key',
+        user=request.path_params['user'],
+        repo=request.path_params['repo'],
+        scope=request.path_params['scope'],
+    ) + '?'
+    sep = b'{'
+    async with engine.connect() as conn:
+        result = await conn.stream(query)
+        async for rows in result.partitions(_PARTITION_SIZE):
+            # chunked data, data in cold tier and compressed data, which
+            # encoding client does not accept, are served by server
+            direct = {
+                key: (sid, compression)
+                for key, sid, compression, chunked, tier in rows
+                if sid and not chunked and tier == Tier.hot and (
+                    compression is None
+                    or accepts_encoding(accept_encoding, compression))
+            }
+            for sid, _ in direct.values():
+                accesses.touch(sid)
+            urls = dict(
+                zip(
+                    direct,
+                    await asyncio.to_thread(presign_many, direct.values()),
+                ))
+            chunk = []
+            for key, sid, *_ in rows:
+                missing.discard(key)
+                url = urls.get(key)
+                if sid and url is None:
+                    url = base + urlencode({'key': key})
+                chunk.append(f'{json.dumps(key)}:{json.dumps(url)}')
+            yield sep + ','.join(chunk).encode()
+            sep = b','
+    if missing:
+        yield sep + ','.join(f'{json.dumps(key)}:null'
+                             for key in missing).encode()
+        sep = b','
+    yield b'{}' if sep == b'{' else b'}'
+
+
+@router.post(
+    '/{user}/{repo}/{scope}/data',
+    response_model=dict[str, Optional[str]],
+    response_description='Mapping object key to data url, `null` when '
+    'data is `null` or object is not found',
+)
+async def get_data_batch(
+        request: Request,
+        dataRequest: DataRequest,
+        repo: str = Depends(repo_name),
+        scope: str = Path(...),
+) -> StreamingResponse:
+    query = sa.select([
+        objects_table.c.key,
+        objects_table.c.data,
+        storage_table.c.compression,
+        storage_table.c.chunked,
+        storage_table.c.tier,
+    ]).select_from(objects_table.outerjoin(storage_table))\
+        .where(objects_table.c.scope == scope)\
+        .where(objects_table.c.repo == repo)\
+        .where(_visible)
+    if dataRequest.keys is not None:
+        query = query.where(
+            objects_table.c.key == sa.any_(
+                sa.bindparam(
+                    'keys',
+                    dataRequest.keys,
+                    type_=postgresql.ARRAY(sa.Text),
+                )))
+    if dataRequest.prefix:
+        query = query.where(
+            objects_table.c.key.startswith(
+                dataRequest.prefix,
+                autoescape=True,
+            ))
+    return StreamingResponse(
+        _data_urls(request, query, dataRequest.keys),
+        media_type='application/json',
+    )
+
+
+async def _archive_entries(
+        repo: str,
+        scope: str,
+        prefix: Optional[str],
+) -> AsyncIterator[Entry]:
+    query = sa.select([
+        objects_table.c.key,
+        objects_table.c.data,
+        objects_table.c.timestamp,
+        storage_table.c.compression,
+        storage_table.c.chunked,
+        objects_table.c.size,
+        storage_table.c.tier,
+    ]).select_from(objects_table.join(storage_table))\
+        .where(objects_table.c.scope == scope)\
+        .where(objects_table.c.repo == repo)\
+        .where(_visible)\
+        .order_by(objects_table.c.key)\
+        .limit(_PARTITION_SIZE)
+    if prefix:
+        query = query.where(
+            objects_table.c.key.startswith(prefix, autoescape=True))
+    # keyset pagination, so connection is not held while archive is sent
+    last: Optional[str] = None
+    while True:
+        page = query if last is None else query.where(
+            objects_table.c.key > last)
+        async with engine.connect() as conn:
+            rows = (await conn.execute(page)).all()
+        for key, sid, timestamp, compression, chunked, size, tier in rows:
+            accesses.touch(sid)
+            yield Entry(
+                name=key,
+                sid=sid,
+                mtime=timestamp,
+                compression=compression,
+                chunked=chunked,
+                size=size,
+                tier=tier,
+            )
+        if len(rows) < _PARTITION_SIZE:
+            return
+        last = rows[-1][0]
+
+
+@router.get(
+    '/{user}/{repo}/{scope}/archive',
+    response_class=StreamingResponse,
+    responses={
+        status.HTTP_200_OK: {
+            'content': {
+                'application/x-tar': {},
+                'application/zstd': {},
+            },
+            'description': 'Tar archive with objects data, keys are used '
+            'as paths. Objects with `null` data are skipped',
+        },
+        status.HTTP_501_NOT_IMPLEMENTED: {
+            'description': 'Compression is not supported',
+        },
+    },
+)
+async def get_archive(
+        repo: str = Depends(repo_name),
+        scope: str = Path(...),
+        key: Optional[str] = Query(None, description='Key prefix'),
+        compression: Optional[Compression] = Query(None),
+) -> StreamingResponse:
+    if compression is Compression.zstd and zstandard is None:
+        raise HTTPException(
+            status.HTTP_501_NOT_IMPLEMENTED,
+            'zstd is not available',
+        )
+    stream = tar_stream(
+        _archive_entries(repo, scope, key),
+        int(settings['archive.read_ahead']),
+    )
+    return StreamingResponse(
+        compress_stream(stream, compression),
+        media_type='application/zstd' if compression else 'application/x-tar',
     )
-    return RedirectResponse(url)
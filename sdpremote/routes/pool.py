@@ -0,0 +1,28 @@
+from fastapi import APIRouter
+from pydantic import BaseModel, Field
+
+from ..database import pool_stats
+
+router = APIRouter(tags=['status'])
+
+
+class PoolStats(BaseModel):
+    size: int
+    idle: int
+    checked_out: int
+    overflow: int
+    waiting: int = Field(
+        ...,
+        description='Number of tasks waiting for connection right now',
+    )
+    checkouts: int
+    timeouts: int
+    wait_seconds: float = Field(
+        ...,
+        description='Total time spent waiting for connection',
+    )
+
+
+@router.get('/pool', response_model=PoolStats)
+def get_pool_stats() -> PoolStats:
+    return PoolStats(**pool_stats())
@@ -1,9 +1,15 @@
+from datetime import datetime
+from typing import Any
+
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException, Path, status
+from fastapi import (APIRouter, Depends, HTTPException, Path, Query, Request,
+                     status)
 from fastapi.responses import PlainTextResponse
 
-from ..database import engine, repos_table
+from ..database import engine, repos_table, scopes_table
+from ..entities.repo import Repo
 from ..utils.user import user
+from .deletion import accepted_response, queue_deletion
 
 router = APIRouter(tags=['repo'])
 
@@ -19,7 +25,8 @@ def repo_name(user: str = Depends(user), repo: str = Path(...)) -> str:
     status_code=status.HTTP_201_CREATED,
     responses={
         status.HTTP_409_CONFLICT: {
-            'description': 'Repo with given name already exists',
+            'description': 'Repo with given name already exists or is '
+            'being deleted',
         }
     },
 )
@@ -40,16 +47,68 @@ async def create_repo(repo: str = Depends(repo_name)) -> str:
     response_description='Deleted',
     status_code=status.HTTP_200_OK,
     responses={
+        status.HTTP_202_ACCEPTED: accepted_response,
         status.HTTP_404_NOT_FOUND: {
             'description': 'Repo with given name is not exist',
         }
     },
 )
-async def delete_repo(repo: str = Depends(repo_name)) -> str:
-    query = sa.delete(repos_table).where(repos_table.c.name == repo)
+async def delete_repo(
+        request: Request,
+        repo: str = Depends(repo_name),
+        background: bool = Query(
+            False,
+            alias='async',
+            description='hide repo at once and delete its objects in '
+            'background, for repos too large to delete within request',
+        ),
+) -> Any:
+    if not background:
+        query = sa.delete(repos_table)\
+            .where(repos_table.c.name == repo)\
+            .where(repos_table.c.deleted_at.is_(None))
+        async with engine.begin() as conn:
+            result: int = (await conn.execute(query)).rowcount
+            await conn.commit()
+        if not result:
+            raise HTTPException(status.HTTP_404_NOT_FOUND)
+        return 'deleted'
+
+    now = datetime.utcnow()
     async with engine.begin() as conn:
-        result: int = (await conn.execute(query)).rowcount
-        await conn.commit()
-    if not result:
+        result = (await conn.execute(
+            sa.update(repos_table)\
+                .where(repos_table.c.name == repo)\
+                .where(repos_table.c.deleted_at.is_(None))\
+                .values(deleted_at=now)
+        )).rowcount
+        if not result:
+            raise HTTPException(status.HTTP_404_NOT_FOUND)
+        # objects are hidden by tombstones of their scopes
+        await conn.execute(
+            sa.update(scopes_table)\
+                .where(scopes_table.c.repo == repo)\
+                .where(scopes_table.c.deleted_at.is_(None))\
+                .values(deleted_at=now)
+        )
+        return await queue_deletion(request, repo, None, conn)
+
+
+@router.get(
+    '/{user}/{repo}/.info',
+    response_model=Repo,
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Repo with given name is not exist',
+        }
+    },
+)
+async def get_repo(repo: str = Depends(repo_name)) -> Repo:
+    query = sa.select([repos_table.c.name, repos_table.c.size])\
+        .where(repos_table.c.name == repo)\
+        .where(repos_table.c.deleted_at.is_(None))
+    async with engine.connect() as conn:
+        row = (await conn.execute(query)).first()
+    if row is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND)
-    return 'deleted'
+    return Repo(name=row.name, size=row.size)
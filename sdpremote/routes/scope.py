@@ -3,16 +3,27 @@ from enum import Enum
 from typing import Any, Optional, Union
 
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, HTTPException, Path, Query, status
+from fastapi import (APIRouter, Depends, HTTPException, Path, Query, Request,
+                     status)
+from fastapi.responses import Response
 from pydantic import BaseModel, Field
 from starlette.responses import PlainTextResponse
 
-from ..database import engine, objects_table, scopes_table
+from ..config import settings
+from ..database import engine, objects_table, repos_table, scopes_table
 from ..entities.scope import Scope
+from ..replica import run_read
 from ..utils.checksum import calc_checksum
-from ..utils.object import ObjectData, ObjectExtra, ObjectPath, create_object
-from ..utils.scope import calc_checksum, set_scope
+from ..utils.object import (ObjectData, ObjectExtra, ObjectPath,
+                            create_object, storage_order)
+from ..utils.listing import (encode_rows, encoded_response, msgpack_response,
+                             wants_msgpack)
+from ..utils.query import like_prefix
+from ..utils.scope import add_repo_size, calc_checksum, set_scope
+from ..utils.singleflight import flights
 from ..utils.user import user
+from ..watch import watcher
+from .deletion import accepted_response, queue_deletion
 from .repo import repo_name
 
 router = APIRouter(tags=['scope'])
@@ -45,34 +56,129 @@ class ScopePatch(_ScopeBase):
         description='Mapping object key to SID (for replace/create), `null`'
         '(to set `null`) or to `"delete"` for deleting key',
     )
+    expect: dict[str, Optional[str]] = Field(
+        dict(),
+        description='Preconditions checked against current state: mapping '
+        'object key to its expected checksum (`null` for object with `null` '
+        'data). Object must exist',
+    )
+
+
+_scopes_query = sa.select([
+    scopes_table.c.name, scopes_table.c.checksum, scopes_table.c.creator,
+    scopes_table.c.timestamp, scopes_table.c.size
+]).where(scopes_table.c.repo == sa.bindparam('repo'))\
+    .where(scopes_table.c.deleted_at.is_(None))
+_scopes_by_name_query = _scopes_query\
+    .where(scopes_table.c.name == sa.bindparam('name'))
+_scopes_by_prefix_query = _scopes_query\
+    .where(scopes_table.c.name.like(sa.bindparam('pattern'), escape='/'))
 
 
 @router.get(
     '/{user}/{repo}',
     response_model=list[Scope],
+    responses={
+        status.HTTP_200_OK: msgpack_response,
+    },
 )
 async def list_scopes(
+        request: Request,
         repo: str = Depends(repo_name),
         scope: Optional[str] = Query(None),
         is_prefix: bool = Query(True),
-) -> list[Scope]:
-    query = sa.select([
-        scopes_table.c.name, scopes_table.c.checksum, scopes_table.c.creator,
-        scopes_table.c.timestamp
-    ]).where(scopes_table.c.repo == repo)
+) -> Response:
+    query = _scopes_query
+    params = dict(repo=repo)
     if scope:
         if is_prefix:
-            query = query.where(scopes_table.c.name.like(f'{scope}%'))
+            query = _scopes_by_prefix_query
+            params['pattern'] = like_prefix(scope)
 
         else:
-            query = query.where(scopes_table.c.name == scope)
+            query = _scopes_by_name_query
+            params['name'] = scope
+    async def fetch(conn: Any) -> tuple[Any, list[Any]]:
+        result: Any = await conn.execute(query, params)
+        return result.keys(), result.all()
+
+    accept = request.headers.get('accept')
+
+    async def respond() -> tuple[bytes, str]:
+        keys, rows = await run_read(repo, fetch)
+        return encode_rows(keys, rows, accept)
+
+    body, media_type = await flights.do(
+        repo,
+        ('list_scopes', tuple(sorted(params.items())), wants_msgpack(accept)),
+        respond,
+    )
+    return encoded_response(body, media_type)
+
+
+async def _current_scope(repo: str, name: str) -> Optional[Scope]:
     async with engine.connect() as conn:
-        res: list[Scope] = list(
-            map(
-                lambda d: Scope(**d),
-                (await conn.execute(query)).mappings(),
-            ))
-    return res
+        result: Any = await conn.execute(
+            _scopes_by_name_query,
+            dict(repo=repo, name=name),
+        )
+        row = result.mappings().first()
+    return Scope(**row) if row is not None else None
+
+
+@router.get(
+    '/{user}/{repo}/.watch',
+    response_model=Scope,
+    responses={
+        status.HTTP_204_NO_CONTENT: {
+            'description': 'No changes within timeout, watch again'
+        },
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Scope not found or was deleted'
+        },
+    },
+)
+async def watch_scopes(
+        request: Request,
+        repo: str = Depends(repo_name),
+        scope: str = Query(..., description='scope name or name prefix'),
+        is_prefix: bool = Query(False),
+        checksum: Optional[str] = Query(
+            None,
+            description='checksum of known scope state, empty for `null`. '
+            'Returns immediately when current state differs, so changes '
+            'made before watch started are not missed. Not supported with '
+            '`is_prefix`',
+        ),
+        timeout: float = Query(
+            30,
+            gt=0,
+            le=settings['watch.max_timeout'],
+            description='seconds to wait for change',
+        ),
+) -> Union[Scope, Response]:
+    '''Waits until scope (or any scope matching prefix) is changed
+
+    Returns new state of changed scope
+    '''
+    waiter = await watcher.listen(repo, scope, is_prefix)
+    try:
+        if 'checksum' in request.query_params and not is_prefix:
+            current = await _current_scope(repo, scope)
+            if current is None:
+                raise HTTPException(status.HTTP_404_NOT_FOUND)
+            if current.checksum != (checksum or None):
+                return current
+        name = await watcher.wait(waiter, timeout)
+    finally:
+        watcher.cancel(repo, waiter)
+
+    if name is None:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    current = await _current_scope(repo, name)
+    if current is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'scope deleted')
+    return current
 
 
 @router.post(
@@ -81,7 +187,8 @@ async def list_scopes(
     response_model=Scope,
     responses={
         status.HTTP_409_CONFLICT: {
-            'description': 'Scope with given name already exists'
+            'description': 'Scope with given name already exists or is '
+            'being deleted'
         },
         status.HTTP_404_NOT_FOUND: {
             'description': 'Something not found'
@@ -96,26 +203,30 @@ async def create_scope(
 ) -> Scope:
     timestamp = datetime.utcnow() if scopeInput.objects else None
     creator = scopeInput.use_suffix(username) if scopeInput.objects else None
+    # repo row is locked, so it is not tombstoned until scope is created
+    live_repo = sa.select([
+        sa.literal(scope),
+        repos_table.c.name,
+        sa.literal(timestamp, sa.DateTime),
+        sa.literal(creator, sa.Text),
+    ]).where(repos_table.c.name == repo)\
+        .where(repos_table.c.deleted_at.is_(None))\
+        .with_for_update(read=True)
     async with engine.begin() as conn:
         try:
-            await conn.execute(
-                sa.insert(scopes_table).values(
-                    name=scope,
-                    repo=repo,
-                    timestamp=timestamp,
-                    creator=creator,
+            result: Any = await conn.execute(
+                sa.insert(scopes_table).from_select(
+                    ['name', 'repo', 'timestamp', 'creator'],
+                    live_repo,
                 ))
-        except sa.exc.IntegrityError as e:
-            arg = e.args[0]
-            if 'foreign key' in arg:
-                raise HTTPException(status.HTTP_404_NOT_FOUND,
-                                    'repo not found')
-            else:
-                raise HTTPException(status.HTTP_409_CONFLICT)
+        except sa.exc.IntegrityError:
+            raise HTTPException(status.HTTP_409_CONFLICT)
+        if not result.rowcount:
+            raise HTTPException(status.HTTP_404_NOT_FOUND, 'repo not found')
 
-        checksum = None
+        checksum, size = None, 0
         if scopeInput.objects:
-            checksum = await set_scope(
+            checksum, size = await set_scope(
                 scopeInput.objects,
                 repo,
                 scope,
@@ -126,6 +237,7 @@ async def create_scope(
                 ),
                 conn,
             )
+        await add_repo_size(repo, size, conn)
         await conn.commit()
 
     return Scope(
@@ -133,6 +245,7 @@ async def create_scope(
         checksum=checksum,
         creator=creator,
         timestamp=timestamp,
+        size=size,
     )
 
 
@@ -164,13 +277,16 @@ async def replace_scope(
                 .where(scopes_table.c.name == scope)\
                 .where(scopes_table.c.repo == repo)\
                 .where(scopes_table.c.checksum == checksum)\
+                .where(scopes_table.c.deleted_at.is_(None))\
                 .values(
                     timestamp=timestamp,
                     creator=creator,
                     checksum=None,
-                )
+                )\
+                .returning(scopes_table.c.size)
         )
-        if result.rowcount == 0:
+        old_size: Optional[int] = result.scalar_one_or_none()
+        if old_size is None:
             raise HTTPException(status.HTTP_404_NOT_FOUND)
 
         await conn.execute(
@@ -179,9 +295,9 @@ async def replace_scope(
                 .where(objects_table.c.repo == repo)
         )
 
-        checksum = None
+        checksum, size = None, 0
         if scopeInput.objects:
-            checksum = await set_scope(
+            checksum, size = await set_scope(
                 scopeInput.objects,
                 repo,
                 scope,
@@ -192,6 +308,14 @@ async def replace_scope(
                 ),
                 conn,
             )
+        elif old_size:
+            await conn.execute(
+                sa.update(scopes_table)\
+                    .where(scopes_table.c.name == scope)\
+                    .where(scopes_table.c.repo == repo)\
+                    .values(size=0)
+            )
+        await add_repo_size(repo, size - old_size, conn)
         await conn.commit()
 
     return Scope(
@@ -199,6 +323,7 @@ async def replace_scope(
         checksum=checksum,
         creator=creator,
         timestamp=timestamp,
+        size=size,
     )
 
 
@@ -212,7 +337,10 @@ async def replace_scope(
         },
         status.HTTP_204_NO_CONTENT: {
             'description': 'No changes was provided in requiest'
-        }
+        },
+        status.HTTP_412_PRECONDITION_FAILED: {
+            'description': 'Some of expected object checksums not matched'
+        },
     },
 )
 async def patch_scope(
@@ -221,6 +349,12 @@ async def patch_scope(
             None,
             description='checksum of current scope state',
         ),
+        commutative: bool = Query(
+            False,
+            description='apply changes to latest scope state instead of '
+            'checking `checksum`. Concurrent patches are serialized, so '
+            'use `expect` to guard keys written by others',
+        ),
         repo: str = Depends(repo_name),
         scope: str = Path(...),
         username: str = Depends(user),
@@ -231,33 +365,53 @@ async def patch_scope(
         creator=scopeInput.use_suffix(username),
         timestamp=datetime.utcnow(),
     )
+    # row lock taken by this update serializes concurrent patches of scope
+    query = sa.update(scopes_table)\
+        .where(scopes_table.c.name == scope)\
+        .where(scopes_table.c.repo == repo)\
+        .where(scopes_table.c.deleted_at.is_(None))\
+        .values(
+            timestamp=None,
+            creator=None,
+            checksum=None,
+        )\
+        .returning(scopes_table.c.size)
+    if not commutative:
+        query = query.where(scopes_table.c.checksum == checksum)
     async with engine.begin() as conn:
-        result: Any = await conn.execute(
-            sa.update(scopes_table)\
-                .where(scopes_table.c.name == scope)\
-                .where(scopes_table.c.repo == repo)\
-                .where(scopes_table.c.checksum == checksum)\
-                .values(
-                    timestamp=None,
-                    creator=None,
-                    checksum=None,
-                )
-        )
-        if result.rowcount == 0:
+        result: Any = await conn.execute(query)
+        old_size: Optional[int] = result.scalar_one_or_none()
+        if old_size is None:
             raise HTTPException(status.HTTP_404_NOT_FOUND)
 
         checksums: dict[str, str] = {}
+        sizes: dict[str, int] = {}
+        failed: list[str] = []
 
         result = await conn.execute(
-            sa.select([objects_table.c.key, objects_table.c.checksum])\
-                .where(objects_table.c.scope == scope)\
+            sa.select([
+                objects_table.c.key,
+                objects_table.c.checksum,
+                objects_table.c.size,
+            ]).where(objects_table.c.scope == scope)\
                 .where(objects_table.c.repo == repo)
         )
-        for key, checksum in result:
+        for key, checksum, size in result:
             checksums[key] = f'{key} ' + (checksum if checksum else 'null')
+            sizes[key] = size or 0
+            if key in scopeInput.expect and \
+                    scopeInput.expect[key] != checksum:
+                failed.append(key)
+        failed.extend(key for key in scopeInput.expect if key not in checksums)
+        if failed:
+            raise HTTPException(
+                status.HTTP_412_PRECONDITION_FAILED,
+                f'unexpected state of objects {", ".join(sorted(failed))}',
+            )
 
         to_delete: list[str] = []
-        for key, value in scopeInput.objects.items():
+        for key, value in sorted(scopeInput.objects.items(),
+                                 key=storage_order):
             if value == Action.delete:
                 to_delete.append(key)
                 if key not in checksums:
@@ -266,14 +420,17 @@ async def patch_scope(
                         f'not found object {key}',
                     )
                 del checksums[key]
+                del sizes[key]
                 continue
-            checksums[key] = await create_object(
+            state = await create_object(
                 ObjectPath(key=key, scope=scope, repo=repo),
                 value,
                 extra,
                 username,
                 conn,
             )
+            checksums[key] = state.line
+            sizes[key] = state.size or 0
         if to_delete:
             await conn.execute(
                 sa.delete(objects_table)\
@@ -283,6 +440,7 @@ async def patch_scope(
             )
 
         checksum = None
+        size = sum(sizes.values())
         if checksums:
             checksum = calc_checksum(checksums)
             await conn.execute(
@@ -293,8 +451,17 @@ async def patch_scope(
                         checksum=checksum,
                         creator=extra.creator,
                         timestamp=extra.timestamp,
+                        size=size,
                     )
             )
+        elif old_size:
+            await conn.execute(
+                sa.update(scopes_table)\
+                    .where(scopes_table.c.name == scope)\
+                    .where(scopes_table.c.repo == repo)\
+                    .values(size=0)
+            )
+        await add_repo_size(repo, size - old_size, conn)
 
         await conn.commit()
 
@@ -303,6 +470,7 @@ async def patch_scope(
         checksum=checksum,
         creator=extra.creator,
         timestamp=extra.timestamp,
+        size=size,
     )
 
 
@@ -310,27 +478,43 @@ async def patch_scope(
     '/{user}/{repo}/{scope}',
     response_class=PlainTextResponse,
     responses={
+        status.HTTP_202_ACCEPTED: accepted_response,
         status.HTTP_404_NOT_FOUND: {
             'description': 'Something is not found or invalid checksum',
         },
     },
 )
 async def delete_scope(
+        request: Request,
         checksum: Optional[str] = Query(
             None,
             description='checksum of current scope state',
         ),
+        background: bool = Query(
+            False,
+            alias='async',
+            description='hide scope at once and delete its objects in '
+            'background, for scopes too large to delete within request',
+        ),
         repo: str = Depends(repo_name),
         scope: str = Path(...),
-):
+) -> Any:
+    query: Any = sa.delete(scopes_table)
+    if background:
+        query = sa.update(scopes_table).values(deleted_at=datetime.utcnow())
     async with engine.begin() as conn:
-        result = await conn.execute(
-            sa.delete(scopes_table)\
-                .where(scopes_table.c.name == scope)\
+        result: Any = await conn.execute(
+            query.where(scopes_table.c.name == scope)\
                 .where(scopes_table.c.repo == repo)\
-                .where(scopes_table.c.checksum == checksum)
+                .where(scopes_table.c.checksum == checksum)\
+                .where(scopes_table.c.deleted_at.is_(None))\
+                .returning(scopes_table.c.size)
         )
-        if result.rowcount == 0:
+        size: Optional[int] = result.scalar_one_or_none()
+        if size is None:
             raise HTTPException(status.HTTP_404_NOT_FOUND)
+        await add_repo_size(repo, -size, conn)
+        if background:
+            return await queue_deletion(request, repo, scope, conn)
         await conn.commit()
     return 'deleted'
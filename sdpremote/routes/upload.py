@@ -1,40 +1,701 @@
-from typing import Optional
+import asyncio
+import hashlib
+from typing import Any, Optional
 
 import sqlalchemy as sa
-from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
-from pydantic import BaseModel
+from fastapi import (APIRouter, Depends, File, Header, HTTPException, Path,
+                     Query, Request, UploadFile, status)
+from fastapi.responses import PlainTextResponse
+from minio.error import S3Error
+from pydantic import BaseModel, Field
+from sqlalchemy.dialects import postgresql
 
-from ..database import engine, storage_table
-from ..storage import uploadObject
+from ..config import settings
+from ..database import (chunk_owners_table, chunks_table, engine,
+                        manifests_table, storage_table, upload_parts_table,
+                        uploads_table)
+from ..storage import (DEFAULT_CONTENT_TYPE, ChunkedStream, StoredObject,
+                       abortMultipart, completeMultipart, hashObject,
+                       hashStream, putChunk, splitObject, startMultipart,
+                       uploadObject, uploadPart)
+from ..utils.chunking import MAX_SIZE, chunk_checksum
 from ..utils.user import user
 
 router = APIRouter(tags=['upload'])
 
+_MIN_PART = 5 * 2**20  # storage limit for all parts except last
+
+# running SHA-256 of sessions uploaded through this worker:
+# sid -> (offset, hash). Session continued elsewhere is hashed on completion
+# by reading stored data back
+_hashes: dict[int, tuple[int, Any]] = {}
+_MAX_HASHES = 1024  # oldest, likely abandoned, sessions are dropped above
+
+_CHUNKS_IN_FLIGHT = 8  # chunks of one upload stored concurrently
+_CHUNK_USE_INTERVAL = '1 hour'  # chunk use is recorded not more often
+
 
 class Uploaded(BaseModel):
     sid: int
 
 
+class UploadNew(BaseModel):
+    size: int = Field(..., gt=0, description='Total size of data in bytes')
+    content_type: str = Field(DEFAULT_CONTENT_TYPE, alias='contentType')
+
+
+class ChunkList(BaseModel):
+    checksums: list[str] = Field(..., max_items=10000)
+
+
+class Manifest(BaseModel):
+    chunks: list[str] = Field(
+        ...,
+        min_items=1,
+        description='Checksums of chunks in order of data',
+    )
+    content_type: str = Field(DEFAULT_CONTENT_TYPE, alias='contentType')
+    checksum: Optional[str] = Field(
+        None,
+        description='SHA-256 of whole data, checked when present',
+    )
+
+
+class UploadPart(BaseModel):
+    offset: int
+    size: int
+    checksum: str = Field(..., description='SHA-256 of part data')
+
+
+class UploadSession(BaseModel):
+    sid: int = Field(..., description='Storage id, usable once complete')
+    size: int
+    offset: int = Field(
+        ...,
+        description='Bytes received so far, next part must start here',
+    )
+    parts: list[UploadPart]
+    complete: bool
+
+
 @router.post(
     '/upload',
     response_model=Uploaded,
     status_code=status.HTTP_201_CREATED,
 )
-async def upload(obj: UploadFile = File(...), username: str = Depends(user)):
+async def upload(
+        obj: UploadFile = File(...),
+        chunked: bool = Query(
+            False,
+            description='Store data as deduplicated chunks',
+        ),
+        username: str = Depends(user),
+):
+    if chunked:
+        return await _upload_chunked(obj, username)
     query = sa.insert(storage_table).values(owner=username)\
         .returning(storage_table.c.id)
+    # connection is not held while data is transferred: entry without
+    # checksum is removed by reaper if upload fails
     async with engine.begin() as conn:
         result = await conn.execute(query)
         sid: Optional[int] = result.scalar()
-        if not sid:
-            raise HTTPException(
-                status.HTTP_507_INSUFFICIENT_STORAGE,
-                'Cannot create storage entry',
-            )
-        h = await uploadObject(sid, obj)
-        query = sa.update(storage_table)\
-            .where(storage_table.c.id == sid)\
-            .values(checksum=h)
+        await conn.commit()
+    if not sid:
+        raise HTTPException(
+            status.HTTP_507_INSUFFICIENT_STORAGE,
+            'Cannot create storage entry',
+        )
+    stored = await uploadObject(sid, obj)
+    query = sa.update(storage_table)\
+        .where(storage_table.c.id == sid)\
+        .values(
+            checksum=stored.checksum,
+            size=stored.size,
+            content_type=obj.content_type or DEFAULT_CONTENT_TYPE,
+            compression=stored.compression,
+            stored_size=stored.stored_size,
+        )
+    async with engine.begin() as conn:
         await conn.execute(query)
         await conn.commit()
     return Uploaded(sid=sid)
+
+
+async def _upload_chunked(obj: UploadFile, username: str) -> Uploaded:
+    split = await splitObject(obj)
+    async with engine.begin() as conn:
+        missing = set(await _missing_chunks(
+            list({checksum for checksum, _, _ in split.chunks}),
+            conn,
+        ))
+        await conn.commit()
+
+    # chunk repeated in data is stored once
+    new: dict[str, tuple[int, int]] = {}
+    for checksum, offset, size in split.chunks:
+        if checksum in missing:
+            new.setdefault(checksum, (offset, size))
+    slots = asyncio.Semaphore(_CHUNKS_IN_FLIGHT)
+    file_lock = asyncio.Lock()
+
+    def read(offset: int, size: int) -> bytes:
+        obj.file.seek(offset)
+        return obj.file.read(size)
+
+    async def store(checksum: str, offset: int, size: int) -> StoredObject:
+        async with slots:
+            async with file_lock:
+                data = await asyncio.to_thread(read, offset, size)
+            return await putChunk(checksum, data)
+
+    stored = await asyncio.gather(*(store(checksum, *position)
+                                    for checksum, position in new.items()))
+    async with engine.begin() as conn:
+        for chunk in stored:
+            await _record_chunk(chunk, conn)
+        # data is received, so user owns all of its chunks
+        await _claim_chunks(
+            list({checksum for checksum, _, _ in split.chunks}),
+            username,
+            conn,
+        )
+        sid, _, _ = await _create_manifest(
+            username,
+            [checksum for checksum, _, _ in split.chunks],
+            obj.content_type or DEFAULT_CONTENT_TYPE,
+            conn,
+        )
+        await conn.execute(
+            sa.update(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .values(checksum=split.checksum)
+        )
+        await conn.commit()
+    return Uploaded(sid=sid)
+
+
+def _owned_by(username: str) -> Any:
+    return sa.exists()\
+        .where(chunk_owners_table.c.chunk == chunks_table.c.checksum)\
+        .where(chunk_owners_table.c.owner == username)
+
+
+async def _missing_chunks(
+        checksums: list[str],
+        conn: Any,  # HACK AsyncConnection
+        username: Optional[str] = None,
+) -> list[str]:
+    '''Finds chunks which are not stored
+
+    With username, chunks which user did not upload are also missing, so
+    nobody learns or references content of others by its checksum.
+    '''
+    query = sa.select([chunks_table.c.checksum])\
+        .where(chunks_table.c.checksum == sa.any_(
+            sa.bindparam('checksums', checksums,
+                         type_=postgresql.ARRAY(sa.Text))))
+    if username is not None:
+        query = query.where(_owned_by(username))
+    result: Any = await conn.execute(query)
+    present = set(result.scalars().all())
+    # chunk, which is reported as present, must outlive manifest upload
+    await conn.execute(
+        sa.update(chunks_table)\
+            .where(chunks_table.c.checksum == sa.any_(
+                sa.bindparam('present', list(present),
+                             type_=postgresql.ARRAY(sa.Text))))\
+            .where(chunks_table.c.used_at < sa.func.now() -
+                   sa.text(f"interval '{_CHUNK_USE_INTERVAL}'"))\
+            .values(used_at=sa.func.now())
+    )
+    return [c for c in checksums if c not in present]
+
+
+async def _record_chunk(
+        chunk: StoredObject,
+        conn: Any,  # HACK AsyncConnection
+):
+    query = postgresql.insert(chunks_table).values(
+        checksum=chunk.checksum,
+        size=chunk.size,
+        compression=chunk.compression,
+        stored_size=chunk.stored_size,
+    )
+    await conn.execute(
+        query.on_conflict_do_update(
+            index_elements=[chunks_table.c.checksum],
+            set_=dict(used_at=sa.func.now()),
+        ))
+
+
+async def _claim_chunks(
+        checksums: list[str],
+        username: str,
+        conn: Any,  # HACK AsyncConnection
+):
+    '''Records that user uploaded data of stored chunks'''
+    if not checksums:
+        return
+    query = postgresql.insert(chunk_owners_table).values([
+        dict(chunk=checksum, owner=username) for checksum in checksums
+    ])
+    await conn.execute(query.on_conflict_do_nothing())
+
+
+async def _create_manifest(
+        username: str,
+        checksums: list[str],
+        content_type: str,
+        conn: Any,  # HACK AsyncConnection
+) -> tuple[int, int, list[Any]]:
+    '''Creates chunked storage entry without checksum
+
+    Returns storage id, size and chunks with compression in order of data.
+    Only chunks uploaded by user can be referenced.
+    '''
+    result: Any = await conn.execute(
+        sa.select([
+            chunks_table.c.checksum,
+            chunks_table.c.size,
+            chunks_table.c.compression,
+        ]).where(chunks_table.c.checksum == sa.any_(
+            sa.bindparam(
+                'checksums',
+                list(set(checksums)),
+                type_=postgresql.ARRAY(sa.Text),
+            )))\
+            .where(_owned_by(username))
+    )
+    known = {row.checksum: row for row in result}
+    missing = len(set(checksums) - known.keys())
+    if missing:
+        raise HTTPException(status.HTTP_409_CONFLICT,
+                            f'{missing} chunks are not uploaded')
+    size = sum(known[c].size for c in checksums)
+    result = await conn.execute(
+        sa.insert(storage_table).values(
+            owner=username,
+            size=size,
+            content_type=content_type,
+            chunked=True,
+        ).returning(storage_table.c.id))
+    sid: int = result.scalar_one()
+    offset = 0
+    rows = []
+    for number, checksum in enumerate(checksums):
+        rows.append(dict(sid=sid, number=number, offset=offset,
+                         chunk=checksum))
+        offset += known[checksum].size
+    await conn.execute(sa.insert(manifests_table), rows)
+    return sid, size, [(c, known[c].compression) for c in checksums]
+
+
+@router.post(
+    '/.upload/chunks/missing',
+    response_model=list[str],
+    response_description='Checksums of chunks which must be uploaded',
+)
+async def missing_chunks(
+        chunkList: ChunkList,
+        username: str = Depends(user),
+) -> list[str]:
+    '''Finds chunks which are not stored yet
+
+    Data is split into chunks with `sdpremote.utils.chunking`, chunks
+    reported as present are not uploaded again. Chunks stored for other
+    users are reported as missing, they are uploaded once to prove that
+    data is known, but not stored again.
+    '''
+    async with engine.begin() as conn:
+        missing = await _missing_chunks(chunkList.checksums, conn,
+                                        username)
+        await conn.commit()
+    return missing
+
+
+@router.put(
+    '/.upload/chunks/{checksum}',
+    response_class=PlainTextResponse,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_400_BAD_REQUEST: {
+            'description': 'Checksum does not match data'
+        },
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE: {
+            'description': 'Chunk is larger than maximal chunk size'
+        },
+    },
+)
+async def upload_chunk(
+        request: Request,
+        checksum: str = Path(..., description='SHA-256 of chunk data'),
+        username: str = Depends(user),
+) -> str:
+    '''Stores chunk from raw request body'''
+    if int(request.headers.get('content-length') or 0) > MAX_SIZE:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    data = await request.body()
+    if len(data) > MAX_SIZE:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    if await asyncio.to_thread(chunk_checksum, data) != checksum:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'checksum mismatch')
+    async with engine.begin() as conn:
+        missing = await _missing_chunks([checksum], conn)
+        await conn.commit()
+    stored = await putChunk(checksum, data) if missing else None
+    async with engine.begin() as conn:
+        if stored is not None:
+            await _record_chunk(stored, conn)
+        await _claim_chunks([checksum], username, conn)
+        await conn.commit()
+    return 'stored'
+
+
+@router.post(
+    '/.upload/manifest',
+    response_model=Uploaded,
+    status_code=status.HTTP_201_CREATED,
+    responses={
+        status.HTTP_400_BAD_REQUEST: {
+            'description': 'Checksum does not match data'
+        },
+        status.HTTP_409_CONFLICT: {
+            'description': 'Some chunks are not uploaded'
+        },
+    },
+)
+async def upload_manifest(
+        manifest: Manifest,
+        username: str = Depends(user),
+) -> Uploaded:
+    '''Creates storage entry from uploaded chunks'''
+    async with engine.begin() as conn:
+        sid, size, chunks = await _create_manifest(
+            username,
+            manifest.chunks,
+            manifest.content_type,
+            conn,
+        )
+        await conn.commit()
+    # checksum of whole data is calculated by server, like for any upload
+    checksum = await hashStream(ChunkedStream(chunks, size))
+    async with engine.begin() as conn:
+        if manifest.checksum is not None and manifest.checksum != checksum:
+            await conn.execute(
+                sa.delete(storage_table).where(storage_table.c.id == sid))
+            await conn.commit()
+            raise HTTPException(status.HTTP_400_BAD_REQUEST,
+                                'checksum mismatch')
+        await conn.execute(
+            sa.update(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .values(checksum=checksum)
+        )
+        await conn.commit()
+    return Uploaded(sid=sid)
+
+
+@router.post(
+    '/.upload/sessions',
+    response_model=UploadSession,
+    status_code=status.HTTP_201_CREATED,
+)
+async def create_session(
+        uploadNew: UploadNew,
+        username: str = Depends(user),
+) -> UploadSession:
+    '''Starts resumable upload
+
+    Data is sent with `PATCH` in parts. Unfinished session expires like
+    any unused upload
+    '''
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            sa.insert(storage_table).values(owner=username)\
+                .returning(storage_table.c.id)
+        )
+        sid: Optional[int] = result.scalar()
+        await conn.commit()
+    if not sid:
+        raise HTTPException(
+            status.HTTP_507_INSUFFICIENT_STORAGE,
+            'Cannot create storage entry',
+        )
+    upload_id = await startMultipart(sid, uploadNew.content_type)
+    async with engine.begin() as conn:
+        await conn.execute(
+            sa.insert(uploads_table).values(
+                sid=sid,
+                upload_id=upload_id,
+                length=uploadNew.size,
+                content_type=uploadNew.content_type,
+            ))
+        await conn.commit()
+    _hashes[sid] = (0, hashlib.sha256())
+    return UploadSession(
+        sid=sid,
+        size=uploadNew.size,
+        offset=0,
+        parts=[],
+        complete=False,
+    )
+
+
+async def _get_session(
+        sid: int,
+        username: str,
+        conn: Any,  # HACK AsyncConnection
+) -> Any:
+    result: Any = await conn.execute(
+        sa.select([uploads_table])\
+            .select_from(uploads_table.join(storage_table))\
+            .where(uploads_table.c.sid == sid)\
+            .where(storage_table.c.owner == username)
+    )
+    session = result.first()
+    if session is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'session not found')
+    return session
+
+
+@router.get(
+    '/.upload/sessions/{sid}',
+    response_model=UploadSession,
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Session not found'
+        },
+    },
+)
+async def get_session(
+        sid: int = Path(...),
+        username: str = Depends(user),
+) -> UploadSession:
+    async with engine.connect() as conn:
+        result: Any = await conn.execute(
+            sa.select([storage_table.c.checksum, storage_table.c.size])\
+                .where(storage_table.c.id == sid)\
+                .where(storage_table.c.owner == username)
+        )
+        stored = result.first()
+        if stored is not None and stored.checksum is not None:
+            # completed, but response to last part could be lost
+            return UploadSession(
+                sid=sid,
+                size=stored.size,
+                offset=stored.size,
+                parts=[],
+                complete=True,
+            )
+        session = await _get_session(sid, username, conn)
+        result = await conn.execute(
+            sa.select([
+                upload_parts_table.c.offset,
+                upload_parts_table.c.size,
+                upload_parts_table.c.checksum,
+            ]).where(upload_parts_table.c.sid == sid)\
+                .order_by(upload_parts_table.c.number)
+        )
+        parts = [UploadPart(**d) for d in result.mappings()]
+    return UploadSession(
+        sid=sid,
+        size=session.length,
+        offset=session.offset,
+        parts=parts,
+        complete=False,
+    )
+
+
+@router.patch(
+    '/.upload/sessions/{sid}',
+    response_model=UploadSession,
+    responses={
+        status.HTTP_400_BAD_REQUEST: {
+            'description': 'Part is too small or exceeds declared size'
+        },
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Session not found'
+        },
+        status.HTTP_409_CONFLICT: {
+            'description': 'Offset does not match received data'
+        },
+        status.HTTP_413_REQUEST_ENTITY_TOO_LARGE: {
+            'description': 'Part is larger than limits.upload_part'
+        },
+    },
+)
+async def upload_part(
+        request: Request,
+        sid: int = Path(...),
+        upload_offset: int = Header(
+            ...,
+            description='Offset of part, must be equal to session offset',
+        ),
+        username: str = Depends(user),
+) -> UploadSession:
+    '''Appends raw request body to upload
+
+    Every part except last must be at least 5 MiB. Session is completed
+    when declared size is received. Empty part at the end retries
+    completion which failed before
+    '''
+    limit = settings['limits.upload_part']
+    if int(request.headers.get('content-length') or 0) > limit:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    async with engine.connect() as conn:
+        session = await _get_session(sid, username, conn)
+    if session.offset != upload_offset:
+        raise HTTPException(
+            status.HTTP_409_CONFLICT,
+            f'expected offset {session.offset}',
+        )
+
+    data = await request.body()
+    end = upload_offset + len(data)
+    if len(data) > limit:
+        raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    if end > session.length:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST,
+                            'data exceeds declared size')
+    if upload_offset == session.length:
+        # every part is received, but earlier completion failed
+        await _complete(session)
+        return await get_session(sid, username)
+    if not data or len(data) < _MIN_PART and end != session.length:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST,
+                            'part except last must be at least 5 MiB')
+
+    # part number is taken before upload, so concurrent retries of same
+    # offset never overwrite part which is already accepted
+    async with engine.begin() as conn:
+        result: Any = await conn.execute(
+            sa.update(uploads_table)\
+                .where(uploads_table.c.sid == sid)\
+                .values(next_part=uploads_table.c.next_part + 1)\
+                .returning(uploads_table.c.next_part)
+        )
+        number: int = result.scalar_one()
+        await conn.commit()
+
+    running = _hashes.get(sid)
+
+    def digest() -> tuple[str, Any]:
+        h = None
+        if running is not None and running[0] == upload_offset:
+            h = running[1].copy()
+            h.update(data)
+        return hashlib.sha256(data).hexdigest(), h
+
+    etag, (checksum, h) = await asyncio.gather(
+        uploadPart(sid, session.upload_id, number, data),
+        asyncio.to_thread(digest),
+    )
+
+    async with engine.begin() as conn:
+        result = await conn.execute(
+            sa.update(uploads_table)\
+                .where(uploads_table.c.sid == sid)\
+                .where(uploads_table.c.offset == upload_offset)\
+                .values(offset=end)
+        )
+        if result.rowcount == 0:
+            raise HTTPException(status.HTTP_409_CONFLICT,
+                                'part at this offset is already received')
+        await conn.execute(
+            sa.insert(upload_parts_table).values(
+                sid=sid,
+                number=number,
+                offset=upload_offset,
+                size=len(data),
+                checksum=checksum,
+                etag=etag,
+            ))
+        # active session is not expired by reaper
+        await conn.execute(
+            sa.update(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .values(expire_at=storage_table.c.expire_at.server_default.arg)
+        )
+        await conn.commit()
+    if h is not None:
+        _hashes[sid] = (end, h)
+        if len(_hashes) > _MAX_HASHES:
+            del _hashes[next(iter(_hashes))]
+    else:
+        _hashes.pop(sid, None)
+
+    if end == session.length:
+        await _complete(session)
+    return await get_session(sid, username)
+
+
+async def _complete(session: Any):
+    '''Assembles received parts into data of storage entry
+
+    Safe to run again when earlier run failed at any step.
+    '''
+    sid = session.sid
+    async with engine.connect() as conn:
+        result: Any = await conn.execute(
+            sa.select([
+                upload_parts_table.c.number,
+                upload_parts_table.c.etag,
+            ]).where(upload_parts_table.c.sid == sid)\
+                .order_by(upload_parts_table.c.number)
+        )
+        parts = result.all()
+    try:
+        await completeMultipart(sid, session.upload_id, parts)
+    except S3Error as e:
+        # completed by earlier run
+        if e.code != 'NoSuchUpload':
+            raise
+
+    running = _hashes.pop(sid, None)
+    if running is not None and running[0] == session.length:
+        checksum = running[1].hexdigest()
+    else:
+        checksum = await hashObject(sid)
+
+    async with engine.begin() as conn:
+        await conn.execute(
+            sa.update(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .values(
+                    checksum=checksum,
+                    size=session.length,
+                    content_type=session.content_type,
+                    stored_size=session.length,
+                )
+        )
+        await conn.execute(
+            sa.delete(uploads_table).where(uploads_table.c.sid == sid))
+        await conn.commit()
+
+
+@router.delete(
+    '/.upload/sessions/{sid}',
+    response_class=PlainTextResponse,
+    responses={
+        status.HTTP_404_NOT_FOUND: {
+            'description': 'Session not found'
+        },
+    },
+)
+async def delete_session(
+        sid: int = Path(...),
+        username: str = Depends(user),
+) -> str:
+    async with engine.connect() as conn:
+        session = await _get_session(sid, username, conn)
+    await asyncio.to_thread(abortMultipart, sid, session.upload_id)
+    async with engine.begin() as conn:
+        await conn.execute(
+            sa.delete(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .where(storage_table.c.checksum.is_(None))
+        )
+        await conn.commit()
+    _hashes.pop(sid, None)
+    return 'deleted'
@@ -0,0 +1,302 @@
+'''Background integrity check of stored data
+
+Scrubber reads data of claimed storage entries and of chunks, recomputes
+SHA-256 of original data and records result in `scrubbed_at` and
+`scrub_error` (`missing`, `unreadable` or checksum mismatch) of checked
+row. Rows are checked in priority order: never checked first, recently
+referenced (or used, for chunks) first among them. Each row is checked
+again after `scrub.period` days, unreadable one after an hour. Result is
+written right after check, so restarted scrubber continues where it
+stopped.
+
+Reads are limited to `scrub.bandwidth` bytes and `scrub.iops` requests per
+second. Only one scrubber runs per database, others wait for its lock.
+Server runs scrubber when `scrub.enabled` is set, it also can be run alone:
+
+    python -m sdpremote.scrub run
+    python -m sdpremote.scrub status
+'''
+import argparse
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Optional
+
+import sqlalchemy as sa
+from minio.error import S3Error
+
+from .config import settings
+from .database import chunks_table, storage_table
+from .metrics import SCRUB_BYTES, SCRUB_CHECKS, instrument_engine
+from .slowlog import log_slow_statements
+from .storage import Tier, chunk_key, get_stored
+from .utils.compression import Compression, zstandard
+from .utils.throttle import Pacer
+
+logger = logging.getLogger(__name__)
+
+_LOCK = 0x73647073  # advisory lock held by running scrubber
+_BLOCK_SIZE = 256 * 1024
+_IDLE = 600  # seconds to wait when everything is checked
+_RETRY = 60  # seconds to wait after storage or database failure
+_RECHECK = timedelta(hours=1)  # unreadable row is checked again after
+_DECODE_ERRORS = (zstandard.ZstdError, ) if zstandard is not None else ()
+
+
+@dataclass(frozen=True)
+class _Source:
+    name: str
+    table: sa.Table
+    key: sa.Column
+    # rows of key, checksum, compression and tier in scrub order
+    pending: Any  # Select
+
+    def blob(self, key: Any) -> str:
+        return str(key) if self.name == 'storage' else chunk_key(key)
+
+
+def _due(table: sa.Table) -> Any:
+    return sa.or_(
+        table.c.scrubbed_at.is_(None),
+        table.c.scrubbed_at < sa.bindparam('cutoff'),
+    )
+
+
+# chunked entries have no own data, their chunks are checked instead
+_storage = _Source(
+    'storage',
+    storage_table,
+    storage_table.c.id,
+    sa.select([
+        storage_table.c.id,
+        storage_table.c.checksum,
+        storage_table.c.compression,
+        storage_table.c.tier,
+    ]).where(storage_table.c.checksum.isnot(None))\
+        .where(storage_table.c.expire_at.is_(None))\
+        .where(sa.not_(storage_table.c.chunked))\
+        .where(_due(storage_table))\
+        .order_by(
+            storage_table.c.scrubbed_at.nullsfirst(),
+            storage_table.c.referenced_at.desc().nullslast(),
+            storage_table.c.id.desc(),
+        )\
+        .limit(sa.bindparam('limit')),
+)
+_chunks = _Source(
+    'chunk',
+    chunks_table,
+    chunks_table.c.checksum,
+    sa.select([
+        chunks_table.c.checksum,
+        chunks_table.c.checksum,
+        chunks_table.c.compression,
+        sa.literal(Tier.hot.value),
+    ]).where(_due(chunks_table))\
+        .order_by(
+            chunks_table.c.scrubbed_at.nullsfirst(),
+            chunks_table.c.used_at.desc(),
+        )\
+        .limit(sa.bindparam('limit')),
+)
+SOURCES = (_storage, _chunks)
+
+
+def check(
+        blob: str,
+        checksum: str,
+        compression: Optional[Compression],
+        bandwidth: Pacer,
+        requests: Pacer,
+        tier: Tier = Tier.hot,
+) -> Optional[str]:
+    '''Reads stored data, returns error or None when data is intact'''
+    requests.wait()
+    try:
+        response = get_stored(blob, tier)
+    except S3Error as e:
+        if e.code == 'NoSuchKey':
+            return 'missing'
+        raise
+    h = hashlib.sha256()
+    decompressor = None
+    if compression == Compression.zstd:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    try:
+        while block := response.read(_BLOCK_SIZE):
+            bandwidth.wait(len(block))
+            SCRUB_BYTES.inc(amount=len(block))
+            h.update(decompressor.decompress(block) if decompressor else block)
+    except _DECODE_ERRORS as e:
+        return f'undecodable: {e}'
+    finally:
+        response.close()
+        response.release_conn()
+    digest = h.hexdigest()
+    if digest != checksum:
+        return f'checksum mismatch: {digest}'
+    return None
+
+
+class Scrubber:
+    '''Checks stored data in thread until stopped'''
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='scrub',
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        engine = sa.create_engine(
+            settings['database.uri_sync'],
+            echo=settings['database.echo'],
+            pool_size=2,
+        )
+        instrument_engine(engine)
+        log_slow_statements(engine)
+        # session lock, connection must not stay idle in transaction
+        try:
+            with engine.connect().execution_options(
+                    isolation_level='AUTOCOMMIT') as lock:
+                while not lock.execute(
+                        sa.select([sa.func.pg_try_advisory_lock(_LOCK)
+                                   ])).scalar():
+                    if self.stopped.wait(_IDLE):
+                        return
+                self._scrub(engine)
+        finally:
+            engine.dispose()
+
+    def _scrub(self, engine: Any):
+        bandwidth = Pacer(settings['scrub.bandwidth'],
+                          sleep=self.stopped.wait)
+        requests = Pacer(settings['scrub.iops'], sleep=self.stopped.wait)
+        while not self.stopped.is_set():
+            try:
+                checked = sum(
+                    self._batch(engine, source, bandwidth, requests)
+                    for source in SOURCES)
+            except Exception:
+                logger.exception('scrub failed')
+                self.stopped.wait(_RETRY)
+                continue
+            if not checked:
+                self.stopped.wait(_IDLE)
+
+    def _batch(self, engine: Any, source: _Source, bandwidth: Pacer,
+               requests: Pacer) -> int:
+        '''Checks next batch of rows of source, returns number of checked'''
+        period = timedelta(days=settings['scrub.period'])
+        cutoff = datetime.utcnow() - period
+        with engine.connect() as conn:
+            rows = conn.execute(
+                source.pending,
+                dict(cutoff=cutoff, limit=settings['scrub.batch']),
+            ).all()
+        for key, checksum, compression, tier in rows:
+            if self.stopped.is_set():
+                break
+            scrubbed_at = datetime.utcnow()
+            try:
+                error = check(source.blob(key), checksum, compression,
+                              bandwidth, requests, tier)
+            except Exception as e:
+                # row is due again soon, instead of stopping whole batch
+                # on every pass
+                SCRUB_CHECKS.inc(source.name, 'unreadable')
+                logger.error('%s %s is unreadable: %s', source.name, key, e)
+                error = f'unreadable: {e}'
+                scrubbed_at -= period - min(_RECHECK, period)
+            else:
+                if error is None:
+                    SCRUB_CHECKS.inc(source.name, 'ok')
+                else:
+                    SCRUB_CHECKS.inc(source.name, 'error')
+                    logger.error('%s %s is damaged: %s', source.name, key,
+                                 error)
+            with engine.begin() as conn:
+                conn.execute(
+                    sa.update(source.table)\
+                        .where(source.key == key)\
+                        .values(scrubbed_at=scrubbed_at, scrub_error=error)
+                )
+        return len(rows)
+
+
+scrubber = Scrubber()
+
+
+def status(conn: Any) -> dict[str, dict[str, int]]:
+    '''Numbers of rows checked within period and damaged of each source'''
+    cutoff = datetime.utcnow() - timedelta(days=settings['scrub.period'])
+    result = {}
+    for source in SOURCES:
+        table = source.table
+        query = sa.select([
+            sa.func.count(),
+            sa.func.count().filter(table.c.scrubbed_at >= cutoff),
+            sa.func.count().filter(table.c.scrub_error.isnot(None)),
+        ])
+        if source is _storage:
+            query = query.where(table.c.checksum.isnot(None))\
+                .where(table.c.expire_at.is_(None))\
+                .where(sa.not_(table.c.chunked))
+        total, checked, damaged = conn.execute(query.select_from(table)).one()
+        result[source.name] = dict(
+            total=total,
+            checked=checked,
+            damaged=damaged,
+        )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run', help='check stored data until interrupted')
+    commands.add_parser('status', help='show progress and damaged data')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.command == 'run':
+        try:
+            scrubber.run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    engine = sa.create_engine(settings['database.uri_sync'])
+    try:
+        with engine.connect() as conn:
+            for name, counts in status(conn).items():
+                print(f'{name}: {counts["checked"]} of {counts["total"]} '
+                      f'checked, {counts["damaged"]} damaged')
+            for source in SOURCES:
+                rows = conn.execute(
+                    sa.select([source.key, source.table.c.scrub_error])\
+                        .where(source.table.c.scrub_error.isnot(None))\
+                        .order_by(source.key)
+                ).all()
+                for key, error in rows:
+                    print(f'{source.name} {key}: {error}')
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import logging
+import random
+import time
+from datetime import date, datetime
+from typing import Any
+
+import sqlalchemy as sa
+
+from .config import settings
+from .metrics import SLOW_QUERIES, current_route, statement_type
+
+logger = logging.getLogger(__name__)
+
+
+def _redact(value: Any) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return f'<{type(value).__name__}:{len(value)}>'
+    if isinstance(value, (bool, int, float, date, datetime)):
+        return f'<{type(value).__name__}>'
+    return '<?>'
+
+
+def _redact_parameters(parameters: Any) -> str:
+    if isinstance(parameters, dict):
+        return repr({k: _redact(v) for k, v in parameters.items()})
+    if isinstance(parameters, (list, tuple)):
+        return repr([_redact(v) for v in parameters])
+    return '<?>'
+
+
+def _in_transaction(conn: Any) -> bool:
+    return conn.in_transaction() and conn.get_execution_options().get(
+        'isolation_level') != 'AUTOCOMMIT'
+
+
+def _explain(conn: Any, statement: str, parameters: Any) -> str:
+    # ANALYZE executes statement again, so only for reads. WITH may hold
+    # data modifying statements
+    analyze = statement_type(statement) == 'SELECT'
+    options = '(ANALYZE, BUFFERS)' if analyze else ''
+    # savepoint keeps transaction usable if explain fails, without
+    # transaction there is nothing to keep
+    savepoint = _in_transaction(conn)
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT slowlog_explain')
+        try:
+            cursor.execute(f'EXPLAIN {options} {statement}', parameters)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        except Exception as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT slowlog_explain')
+            return f'explain failed: {e}'
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT slowlog_explain')
+    finally:
+        cursor.close()
+    return plan
+
+
+def log_slow_statements(engine: sa.engine.Engine):
+    '''Log statements of engine running longer than slowlog.threshold
+
+    Plan of slow statement is captured for slowlog.explain_rate share of
+    them. Statement parameters are logged only as types and lengths.
+    '''
+    threshold: float = settings['slowlog.threshold']
+    explain_rate: float = settings['slowlog.explain_rate']
+    if threshold <= 0:
+        return
+
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters,
+                              context: Any, executemany):
+        context.slowlog_start = time.perf_counter()
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn: Any, cursor, statement, parameters,
+                             context: Any, executemany):
+        elapsed = time.perf_counter() - context.slowlog_start
+        if elapsed < threshold:
+            return
+        SLOW_QUERIES.inc(statement_type(statement))
+        plan = ''
+        if not executemany and random.random() < explain_rate:
+            plan = '\n' + _explain(conn, statement, parameters)
+        logger.warning(
+            'slow statement %.3fs route=%s params=%s\n%s%s',
+            elapsed,
+            current_route.get(),
+            _redact_parameters(parameters),
+            statement,
+            plan,
+        )
@@ -1,24 +1,97 @@
 import asyncio
 import hashlib
+import io
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from enum import Enum
 from tempfile import SpooledTemporaryFile
+from typing import Any, Iterable, Optional, Union
 
 import minio
 import schedule
 import sqlalchemy as sa
+import urllib3
 from fastapi.datastructures import UploadFile
+from minio.datatypes import Part
 from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
 
 from .config import settings
-from .database import storage_table
+from .database import (chunks_table, engine, manifests_table, objects_table,
+                       storage_table, uploads_table)
+from .metrics import (REAPER_DELETED, REAPER_LATENCY, REAPER_RUNS,
+                      STORAGE_BYTES, STORAGE_LATENCY, current_route,
+                      instrument_engine)
+from .slowlog import log_slow_statements
+from .utils.chunking import chunk_checksum, split
+from .utils.compression import Compression, choose_compression, zstandard
 
 storage = minio.Minio(**settings['storage'].to_dict())
+# cold bucket may be on other service, both tiers keep data by storage id
+cold_storage = minio.Minio(**settings['tiering.storage'].to_dict()) \
+    if settings['tiering.storage'] else storage
 
-_buckets = storage.list_buckets()
-if not any(b.name == 'sdpremote' for b in _buckets):
-    storage.make_bucket('sdpremote')
+DEFAULT_CONTENT_TYPE = 'application/octet-stream'
+PRESIGNED_TTL = timedelta(hours=6)  # lifetime of presigned urls of data
+
+
+class Tier(str, Enum):
+    hot = 'hot'
+    cold = 'cold'
+
+
+def location(tier: Tier) -> tuple[minio.Minio, str]:
+    '''Client and bucket which hold data of tier'''
+    if tier == Tier.cold:
+        return cold_storage, settings['tiering.bucket']
+    return storage, 'sdpremote'
+
+
+def get_stored(key: str, tier: Tier = Tier.hot) -> urllib3.HTTPResponse:
+    '''Opens stored data in tier
+
+    After data is moved back to hot bucket, cold copy is kept until
+    `moved_at` plus lifetime of presigned urls and `tiering.flush`, then
+    tiering pass removes it. Reader, which saw entry as cold and opens it
+    later than that, e.g. next member of long archive stream, finds no cold
+    copy, so data is looked up in hot bucket.
+    '''
+    client, bucket = location(tier)
+    try:
+        return client.get_object(bucket, key)
+    except S3Error as e:
+        if tier != Tier.cold or e.code != 'NoSuchKey':
+            raise
+    return storage.get_object('sdpremote', key)
+
+
+def stat_stored(key: str, tier: Tier = Tier.hot) -> Any:
+    '''Stats stored data in tier, looked up as by `get_stored`'''
+    client, bucket = location(tier)
+    try:
+        return client.stat_object(bucket, key)
+    except S3Error as e:
+        if tier != Tier.cold or e.code != 'NoSuchKey':
+            raise
+    return storage.stat_object('sdpremote', key)
+
+# uploads use own threads to not starve default executor used by cheap
+# metadata routes
+_upload_executor = ThreadPoolExecutor(
+    settings['limits.upload_threads'],
+    thread_name_prefix='upload',
+)
+
+
+def ensure_bucket():
+    if not storage.bucket_exists('sdpremote'):
+        storage.make_bucket('sdpremote')
+    client, bucket = location(Tier.cold)
+    if settings['tiering.enabled'] and not client.bucket_exists(bucket):
+        client.make_bucket(bucket)
 
 
 class SThread(threading.Thread):
@@ -40,43 +113,419 @@ class SThread(threading.Thread):
 
 
 def delete_expired():
+    current_route.set('delete_expired')
+    start = time.perf_counter()
+    try:
+        deleted = _delete_expired()
+    except Exception:
+        REAPER_RUNS.inc('error')
+        raise
+    finally:
+        REAPER_LATENCY.observe(time.perf_counter() - start)
+    REAPER_RUNS.inc('ok')
+    REAPER_DELETED.inc(amount=deleted)
+
+
+def _delete_expired() -> int:
     # create engine here because this is only use one time pet 6 hours
     _engine = sa.create_engine(
         settings['database.uri_sync'],
-        echo=settings['debug'],
+        echo=settings['database.echo'],
         pool_size=1,
     )
-    query = sa.select([storage_table.c.id])\
-        .where(storage_table.c.expire_at < datetime.utcnow())
+    instrument_engine(_engine)
+    log_slow_statements(_engine)
+    # entry released by deletion may be claimed again meanwhile
+    query = sa.select([storage_table.c.id, storage_table.c.tier])\
+        .where(storage_table.c.expire_at < datetime.utcnow())\
+        .where(~sa.exists().where(objects_table.c.data == storage_table.c.id))
     with _engine.connect() as conn:
-        result = conn.execute(query)
-        ids: set[int] = set(result.scalars().all())
+        tiers: dict[int, str] = dict(conn.execute(query).all())
+        ids: set[int] = set(tiers)
+        result = conn.execute(
+            sa.select([uploads_table.c.sid, uploads_table.c.upload_id])\
+                .where(uploads_table.c.sid.in_(ids))
+        )
+        sessions = result.all()
+    # parts of abandoned resumable uploads are not visible as objects
+    for sid, upload_id in sessions:
+        abortMultipart(sid, upload_id)
     objects = [DeleteObject(str(i)) for i in ids]
+    start = time.perf_counter()
     errors = {
         error.name
         for error in storage.remove_objects('sdpremote', objects)
     }
+    # interrupted move between tiers may leave copy in other bucket
+    if settings['tiering.enabled'] or Tier.cold in tiers.values():
+        client, bucket = location(Tier.cold)
+        errors |= {
+            error.name
+            for error in client.remove_objects(bucket, objects)
+        }
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'delete')
     successful_deleted = ids - errors
     query = sa.delete(storage_table)\
         .where(storage_table.c.id.in_(successful_deleted))
     with _engine.connect() as conn:
         conn.execute(query)
+    deleted = len(successful_deleted) + _delete_unused_chunks(_engine)
     _engine.dispose()
+    return deleted
+
+
+def _delete_unused_chunks(_engine: sa.engine.Engine) -> int:
+    # chunks are referenced by manifests, which are removed with storage
+    # entries. Recently used chunk is kept, manifest may be on its way
+    query = sa.delete(chunks_table)\
+        .where(chunks_table.c.used_at < datetime.utcnow() - _CHUNK_GRACE)\
+        .where(~sa.exists().where(
+            manifests_table.c.chunk == chunks_table.c.checksum))\
+        .returning(chunks_table.c.checksum)
+    with _engine.connect() as conn:
+        checksums = conn.execute(query).scalars().all()
+    if not checksums:
+        return 0
+    objects = [DeleteObject(chunk_key(c)) for c in checksums]
+    start = time.perf_counter()
+    errors = list(storage.remove_objects('sdpremote', objects))
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'delete')
+    # chunk is uploaded again when needed, so failed delete leaves only
+    # orphaned data
+    return len(checksums) - len(errors)
 
 
 schedule.every(6).hours.do(delete_expired)
 
 
-async def uploadObject(sid: int, obj: UploadFile) -> str:
-    reader = ObjectReader(obj.file)
+@dataclass(frozen=True)
+class StoredObject:
+    checksum: str  # of original data
+    size: int
+    compression: Optional[Compression]
+    stored_size: int
+
+
+_SAMPLE_SIZE = 64 * 1024  # data checked for compressibility
+_CHUNK_GRACE = timedelta(hours=6)  # as expiration of unused storage entry
+
+
+def store_file(sid: int, f: SpooledTemporaryFile,
+               content_type: str) -> StoredObject:
+    '''Stores data of storage entry, compressed when it pays off'''
+    sample = f.read(_SAMPLE_SIZE)
+    reader = ObjectReader(f)
+    compression = choose_compression(sample, reader.size, content_type)
+    if compression is None:
+        storage.put_object(
+            'sdpremote',
+            str(sid),
+            reader,
+            reader.size,
+            content_type=content_type,
+        )
+        return StoredObject(reader.hash, reader.size, None, reader.size)
+
+    # not marked with Content-Encoding in storage, so it is returned as is
+    # and encoding is set per request
+    with SpooledTemporaryFile(max_size=1024 * 1024) as out:
+        compressor = zstandard.ZstdCompressor(
+            level=settings['compression.level'])
+        compressor.copy_stream(reader, out)
+        stored_size = out.tell()
+        out.seek(0)
+        storage.put_object(
+            'sdpremote',
+            str(sid),
+            out,
+            stored_size,
+            content_type=content_type,
+        )
+    return StoredObject(reader.hash, reader.size, compression, stored_size)
+
+
+async def uploadObject(sid: int, obj: UploadFile) -> StoredObject:
+    start = time.perf_counter()
+    stored = await asyncio.get_running_loop().run_in_executor(
+        _upload_executor,
+        store_file,
+        sid,
+        obj.file,
+        obj.content_type or DEFAULT_CONTENT_TYPE,
+    )
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'put')
+    STORAGE_BYTES.inc('put', amount=stored.stored_size)
+    return stored
+
+
+@dataclass(frozen=True)
+class SplitObject:
+    checksum: str
+    size: int
+    chunks: list[tuple[str, int, int]]  # checksum, offset and size
+
+
+def _split(f: SpooledTemporaryFile) -> SplitObject:
+    reader = ObjectReader(f)
+    chunks = []
+    offset = 0
+    for chunk in split(reader):  # type: ignore
+        chunks.append((chunk_checksum(chunk), offset, len(chunk)))
+        offset += len(chunk)
+    return SplitObject(reader.hash, reader.size, chunks)
+
+
+async def splitObject(obj: UploadFile) -> SplitObject:
+    return await asyncio.get_running_loop().run_in_executor(
+        _upload_executor,
+        _split,
+        obj.file,
+    )
+
+
+def chunk_key(checksum: str) -> str:
+    return f'chunks/{checksum}'
+
+
+def _put_chunk(checksum: str, data: bytes) -> StoredObject:
+    stored = data
+    compression = choose_compression(data[:_SAMPLE_SIZE], len(data), None)
+    if compression is not None:
+        stored = zstandard.ZstdCompressor(
+            level=settings['compression.level']).compress(data)
+    storage.put_object(
+        'sdpremote',
+        chunk_key(checksum),
+        io.BytesIO(stored),
+        len(stored),
+    )
+    return StoredObject(checksum, len(data), compression, len(stored))
+
+
+async def putChunk(checksum: str, data: bytes) -> StoredObject:
+    start = time.perf_counter()
+    stored = await asyncio.get_running_loop().run_in_executor(
+        _upload_executor,
+        _put_chunk,
+        checksum,
+        data,
+    )
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'put_chunk')
+    STORAGE_BYTES.inc('put', amount=stored.stored_size)
+    return stored
+
+
+async def startMultipart(sid: int, content_type: str) -> str:
+    return await asyncio.to_thread(
+        storage._create_multipart_upload,
+        'sdpremote',
+        str(sid),
+        {'Content-Type': content_type},
+    )
+
+
+async def uploadPart(sid: int, upload_id: str, number: int,
+                     data: bytes) -> str:
+    start = time.perf_counter()
+    etag = await asyncio.get_running_loop().run_in_executor(
+        _upload_executor,
+        storage._upload_part,
+        'sdpremote',
+        str(sid),
+        data,
+        None,
+        upload_id,
+        number,
+    )
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'put_part')
+    STORAGE_BYTES.inc('put', amount=len(data))
+    return etag
+
+
+async def completeMultipart(sid: int, upload_id: str,
+                            parts: list[tuple[int, str]]):
     await asyncio.to_thread(
-        storage.put_object,
+        storage._complete_multipart_upload,
         'sdpremote',
         str(sid),
-        reader,
-        reader.size,
+        upload_id,
+        [Part(number, etag) for number, etag in parts],
+    )
+
+
+def abortMultipart(sid: int, upload_id: str):
+    try:
+        storage._abort_multipart_upload('sdpremote', str(sid), upload_id)
+    except S3Error as e:
+        if e.code != 'NoSuchUpload':
+            raise
+
+
+class ObjectStream:
+    chunk_size = 64 * 1024
+
+    def __init__(
+            self,
+            response: urllib3.HTTPResponse,
+            compression: Optional[Compression] = None,
+            size: Optional[int] = None,
+    ):
+        self.response = response
+        self.decompressor = None
+        if compression == Compression.zstd:
+            self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        if size is None:
+            size = int(response.headers['content-length'])
+        self.size = size
+        self.received = 0
+        self.start = time.perf_counter()
+
+    def _read(self) -> bytes:
+        while chunk := self.response.read(self.chunk_size):
+            self.received += len(chunk)
+            if self.decompressor is None:
+                return chunk
+            data = self.decompressor.decompress(chunk)
+            if data:
+                return data
+        return b''
+
+    async def read(self) -> bytes:
+        '''Reads next chunk of original data, empty at the end'''
+        return await asyncio.to_thread(self._read)
+
+    def close(self):
+        self.response.close()
+        self.response.release_conn()
+        STORAGE_LATENCY.observe(time.perf_counter() - self.start, 'get')
+        STORAGE_BYTES.inc('get', amount=self.received)
+
+
+def get_chunk(checksum: str,
+              compression: Optional[Compression]) -> tuple[bytes, int]:
+    '''Reads chunk, returns original data and stored size'''
+    response = storage.get_object('sdpremote', chunk_key(checksum))
+    try:
+        stored = response.read()
+    finally:
+        response.close()
+        response.release_conn()
+    if compression == Compression.zstd:
+        return zstandard.ZstdDecompressor().decompress(stored), len(stored)
+    return stored, len(stored)
+
+
+class ChunkedStream:
+    '''Reassembles data from chunks, next chunk is fetched while current
+    one is consumed'''
+    def __init__(
+            self,
+            chunks: Iterable[tuple[str, Optional[Compression]]],
+            size: int,
+    ):
+        self.chunks = iter(chunks)
+        self.size = size
+        self.pending: Optional[asyncio.Future] = None
+        self.started = False
+        self.received = 0
+        self.start = time.perf_counter()
+
+    def _fetch_next(self) -> Optional[asyncio.Future]:
+        if (item := next(self.chunks, None)) is None:
+            return None
+        return asyncio.ensure_future(asyncio.to_thread(get_chunk, *item))
+
+    async def read(self) -> bytes:
+        '''Reads next chunk of original data, empty at the end'''
+        if not self.started:
+            self.started = True
+            self.pending = self._fetch_next()
+        if self.pending is None:
+            return b''
+        data, stored_size = await self.pending
+        self.received += stored_size
+        self.pending = self._fetch_next()
+        return data
+
+    def close(self):
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+        STORAGE_LATENCY.observe(time.perf_counter() - self.start, 'get')
+        STORAGE_BYTES.inc('get', amount=self.received)
+
+
+async def openChunked(sid: int) -> ChunkedStream:
+    async with engine.connect() as conn:
+        result: Any = await conn.execute(
+            sa.select([
+                manifests_table.c.chunk,
+                chunks_table.c.compression,
+                chunks_table.c.size,
+            ]).select_from(manifests_table.join(chunks_table))\
+                .where(manifests_table.c.sid == sid)\
+                .order_by(manifests_table.c.number)
+        )
+        rows = result.all()
+    return ChunkedStream(
+        [(checksum, compression) for checksum, compression, _ in rows],
+        sum(size for *_, size in rows),
     )
-    return reader.hash
+
+
+async def openObject(
+        sid: int,
+        compression: Optional[Compression] = None,
+        size: Optional[int] = None,
+        chunked: bool = False,
+        tier: Tier = Tier.hot,
+) -> Union[ObjectStream, ChunkedStream]:
+    '''Opens stored data, size of original data is required if compressed'''
+    if chunked:
+        return await openChunked(sid)
+    response = await asyncio.to_thread(get_stored, str(sid), tier)
+    return ObjectStream(response, compression, size)
+
+
+async def hashObject(sid: int) -> str:
+    return await hashStream(await openObject(sid))
+
+
+async def hashStream(stream: Union[ObjectStream, ChunkedStream]) -> str:
+    h = hashlib.sha256()
+    try:
+        while chunk := await stream.read():
+            h.update(chunk)
+    finally:
+        stream.close()
+    return h.hexdigest()
+
+
+def presign_many(
+        objects: Iterable[tuple[int, Optional[Compression]]]) -> list[str]:
+    # all urls share one request date, so whole batch is signed in one call
+    # and can be moved to worker thread at once
+    date = datetime.now(timezone.utc)
+    start = time.perf_counter()
+    urls = [
+        storage.get_presigned_url(
+            'GET',
+            'sdpremote',
+            str(sid),
+            PRESIGNED_TTL,
+            response_headers=_encoding_headers(compression),
+            request_date=date,
+        ) for sid, compression in objects
+    ]
+    STORAGE_LATENCY.observe(time.perf_counter() - start, 'presign')
+    return urls
+
+
+def _encoding_headers(
+        compression: Optional[Compression]) -> Optional[dict[str, str]]:
+    if compression is None:
+        return None
+    return {'response-content-encoding': Compression(compression).value}
 
 
 class ObjectReader:
@@ -0,0 +1,371 @@
+'''Moving rarely accessed data between hot and cold bucket
+
+Reads of data record storage id in memory, server writes them into
+`accessed_at` every `tiering.flush` seconds, a few statements for all of
+them. Entries accessed within last hour are skipped, so frequently read
+data costs no writes.
+
+When `tiering.enabled` is set, claimed entries which were not accessed for
+`tiering.cold_after` days are moved to `tiering.bucket`, in the main
+storage or in `tiering.storage` when it is configured. Data stored as is
+is compressed on the way, when it pays off. Cold data is served by server
+itself, and data accessed again is moved back to hot bucket on next pass.
+Chunked entries are not moved, their chunks are shared. Copy in previous
+bucket is removed only when presigned urls and readers, which saw entry
+before the move, are done with it. Only one server runs passes at a time,
+they also can be run alone:
+
+    python -m sdpremote.tiering run
+    python -m sdpremote.tiering status
+'''
+import argparse
+import logging
+import shutil
+import threading
+import time
+from datetime import datetime, timedelta
+from tempfile import SpooledTemporaryFile
+from typing import Any, Optional
+
+import sqlalchemy as sa
+from minio.error import S3Error
+
+from .config import settings
+from .database import storage_table
+from .metrics import TIER_BYTES, TIERING_MOVES, instrument_engine
+from .slowlog import log_slow_statements
+from .storage import PRESIGNED_TTL, Tier, ensure_bucket, get_stored, location
+from .utils.compression import COMPRESSED_TYPES, Compression, zstandard
+
+logger = logging.getLogger(__name__)
+
+_LOCK = 0x73647074  # advisory lock held by running pass
+_FLUSH_BATCH = 1000
+_SPOOL_SIZE = 8 * 1024 * 1024
+_RETRY = 60  # seconds to wait after storage or database failure
+
+# hour precision is plenty for policy counted in days
+_record_access = sa.update(storage_table)\
+    .where(storage_table.c.id.in_(sa.bindparam('sids', expanding=True)))\
+    .where(storage_table.c.accessed_at <
+           sa.func.now() - sa.text("interval '1 hour'"))\
+    .values(accessed_at=sa.func.now())
+
+# entries with own data, as in ix__storage__tier_accessed_at
+_tiered = sa.and_(
+    storage_table.c.checksum.isnot(None),
+    storage_table.c.size.isnot(None),
+    storage_table.c.expire_at.is_(None),
+    sa.not_(storage_table.c.chunked),
+)
+_candidates = sa.select([
+    storage_table.c.id,
+    storage_table.c.compression,
+    storage_table.c.content_type,
+    storage_table.c.size,
+]).where(_tiered).limit(sa.bindparam('limit'))
+# least recently accessed go first to cold tier, most recently back
+_to_cold = _candidates\
+    .where(storage_table.c.tier == Tier.hot.value)\
+    .where(storage_table.c.accessed_at < sa.bindparam('cutoff'))\
+    .order_by(storage_table.c.accessed_at)
+_to_hot = _candidates\
+    .where(storage_table.c.tier == Tier.cold.value)\
+    .where(storage_table.c.accessed_at >= sa.bindparam('cutoff'))\
+    .order_by(storage_table.c.accessed_at.desc())
+_moved = sa.select([
+    storage_table.c.id,
+    storage_table.c.tier,
+    storage_table.c.moved_at,
+]).where(storage_table.c.moved_at < sa.bindparam('before'))\
+    .order_by(storage_table.c.moved_at)\
+    .limit(sa.bindparam('limit'))
+
+
+class AccessLog:
+    '''Storage ids of data read since last flush'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sids: set[int] = set()
+
+    def touch(self, sid: int):
+        with self.lock:
+            self.sids.add(sid)
+
+    def flush(self, engine: Any) -> int:
+        '''Writes access time of recorded entries, returns number of rows'''
+        with self.lock:
+            sids, self.sids = self.sids, set()
+        # rows are locked in id order, as claims do
+        ordered = sorted(sids)
+        updated = 0
+        try:
+            for i in range(0, len(ordered), _FLUSH_BATCH):
+                with engine.begin() as conn:
+                    result = conn.execute(
+                        _record_access,
+                        dict(sids=ordered[i:i + _FLUSH_BATCH]),
+                    )
+                    updated += result.rowcount
+        except Exception:
+            with self.lock:
+                self.sids |= sids
+            raise
+        return updated
+
+
+accesses = AccessLog()
+
+
+def _cutoff() -> datetime:
+    return datetime.utcnow() - timedelta(days=settings['tiering.cold_after'])
+
+
+def _other(tier: Tier) -> Tier:
+    return Tier.hot if tier == Tier.cold else Tier.cold
+
+
+def _worth_compressing(content_type: Optional[str]) -> bool:
+    return zstandard is not None and settings['tiering.compress'] and not (
+        content_type and content_type.startswith(COMPRESSED_TYPES))
+
+
+def copy_data(
+        sid: int,
+        compression: Optional[Compression],
+        content_type: Optional[str],
+        target: Tier,
+) -> tuple[Optional[Compression], int]:
+    '''Copies data into target tier, returns how it is stored there'''
+    source = _other(target)
+    client, bucket = location(target)
+    with SpooledTemporaryFile(max_size=_SPOOL_SIZE) as raw:
+        response = get_stored(str(sid), source)
+        try:
+            shutil.copyfileobj(response, raw)
+        finally:
+            response.close()
+            response.release_conn()
+        stored_size = raw.tell()
+        raw.seek(0)
+        if compression is None and target == Tier.cold \
+                and _worth_compressing(content_type):
+            with SpooledTemporaryFile(max_size=_SPOOL_SIZE) as packed:
+                zstandard.ZstdCompressor(
+                    level=settings['tiering.compression_level'],
+                ).copy_stream(raw, packed)
+                packed_size = packed.tell()
+                if packed_size <= stored_size * settings[
+                        'compression.max_ratio']:
+                    packed.seek(0)
+                    client.put_object(bucket, str(sid), packed, packed_size,
+                                      content_type=content_type)
+                    return Compression.zstd, packed_size
+            raw.seek(0)
+        client.put_object(bucket, str(sid), raw, stored_size,
+                          content_type=content_type)
+    return compression, stored_size
+
+
+def move_batch(engine: Any, target: Tier, stopped: threading.Event) -> int:
+    '''Moves next batch of due entries to target, returns number of moved'''
+    cutoff = _cutoff()
+    query = _to_cold if target == Tier.cold else _to_hot
+    source = _other(target)
+    with engine.connect() as conn:
+        rows = conn.execute(
+            query,
+            dict(cutoff=cutoff, limit=settings['tiering.batch']),
+        ).all()
+    moved_count = 0
+    for sid, compression, content_type, size in rows:
+        if stopped.is_set():
+            break
+        try:
+            stored_compression, stored_size = copy_data(
+                sid, compression, content_type, target)
+        except S3Error as e:
+            # damaged entry is reported by scrubber, others still move
+            logger.error('cannot move %d to %s: %s', sid, target.value, e)
+            continue
+        # entry accessed while data was copied stays where it is
+        update = sa.update(storage_table)\
+            .where(storage_table.c.id == sid)\
+            .where(storage_table.c.tier == source.value)\
+            .values(
+                tier=target.value,
+                compression=stored_compression,
+                stored_size=stored_size,
+                moved_at=sa.func.now(),
+            )
+        if target == Tier.cold:
+            update = update.where(storage_table.c.accessed_at < cutoff)
+        with engine.begin() as conn:
+            moved = conn.execute(update).rowcount == 1
+        if not moved:
+            # nobody has seen this copy
+            client, bucket = location(target)
+            client.remove_object(bucket, str(sid))
+        else:
+            moved_count += 1
+            TIERING_MOVES.inc(target.value)
+            logger.debug('moved %d (%d bytes) to %s', sid, size, target.value)
+    return moved_count
+
+
+def remove_moved(engine: Any, stopped: threading.Event) -> int:
+    '''Removes next batch of copies left by moves, returns their number
+
+    Presigned url or reader, which saw entry right before the move, reads
+    previous copy, so it is kept for lifetime of presigned urls and time
+    accesses are not flushed.
+    '''
+    before = datetime.utcnow() - PRESIGNED_TTL - timedelta(
+        seconds=settings['tiering.flush'])
+    with engine.connect() as conn:
+        rows = conn.execute(
+            _moved,
+            dict(before=before, limit=settings['tiering.batch']),
+        ).all()
+    for sid, tier, moved_at in rows:
+        if stopped.is_set():
+            break
+        client, bucket = location(_other(Tier(tier)))
+        client.remove_object(bucket, str(sid))
+        with engine.begin() as conn:
+            conn.execute(
+                sa.update(storage_table)\
+                    .where(storage_table.c.id == sid)\
+                    .where(storage_table.c.moved_at == moved_at)\
+                    .values(moved_at=None)
+            )
+    return len(rows)
+
+
+def report(conn: Any) -> dict[str, dict[str, int]]:
+    '''Number of entries, original and stored bytes in each tier'''
+    rows = conn.execute(
+        sa.select([
+            storage_table.c.tier,
+            sa.func.count(),
+            sa.func.coalesce(sa.func.sum(storage_table.c.size), 0),
+            sa.func.coalesce(sa.func.sum(storage_table.c.stored_size), 0),
+        ]).where(storage_table.c.checksum.isnot(None))\
+            .where(sa.not_(storage_table.c.chunked))\
+            .group_by(storage_table.c.tier)
+    ).all()
+    result = {
+        tier.value: dict(entries=0, size=0, stored=0)
+        for tier in Tier
+    }
+    for tier, entries, size, stored in rows:
+        # sums are numeric in database
+        result[tier] = dict(entries=entries, size=int(size),
+                            stored=int(stored))
+    return result
+
+
+class TieringWorker:
+    '''Flushes recorded accesses and runs tiering passes in thread'''
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            name='tiering',
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        engine = sa.create_engine(
+            settings['database.uri_sync'],
+            echo=settings['database.echo'],
+            pool_size=2,
+        )
+        instrument_engine(engine)
+        log_slow_statements(engine)
+        next_pass = time.monotonic()
+        try:
+            while not self.stopped.wait(settings['tiering.flush']):
+                self._flush(engine)
+                if settings['tiering.enabled'] \
+                        and time.monotonic() >= next_pass:
+                    try:
+                        self._pass(engine)
+                        delay = settings['tiering.interval']
+                    except Exception:
+                        logger.exception('tiering pass failed')
+                        delay = _RETRY
+                    next_pass = time.monotonic() + delay
+            self._flush(engine)
+        finally:
+            engine.dispose()
+
+    def _flush(self, engine: Any):
+        try:
+            accesses.flush(engine)
+        except Exception:
+            logger.exception('cannot record accesses')
+
+    def _pass(self, engine: Any):
+        # session lock, connection must not stay idle in transaction
+        with engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as lock:
+            if not lock.execute(
+                    sa.select([sa.func.pg_try_advisory_lock(_LOCK)])).scalar():
+                return
+            try:
+                while not self.stopped.is_set() and remove_moved(
+                        engine, self.stopped):
+                    pass
+                # data wanted by readers goes first
+                for target in (Tier.hot, Tier.cold):
+                    while not self.stopped.is_set() and move_batch(
+                            engine, target, self.stopped):
+                        self._flush(engine)
+                for tier, counts in report(lock).items():
+                    TIER_BYTES.set(tier, value=counts['stored'])
+            finally:
+                lock.execute(sa.select([sa.func.pg_advisory_unlock(_LOCK)]))
+
+
+worker = TieringWorker()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('run', help='move data between tiers once')
+    commands.add_parser('status', help='show bytes stored in each tier')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    engine = sa.create_engine(settings['database.uri_sync'])
+    try:
+        if args.command == 'run':
+            if not settings['tiering.enabled']:
+                parser.exit(1, 'tiering.enabled is not set\n')
+            ensure_bucket()
+            worker._pass(engine)
+            return
+        with engine.connect() as conn:
+            for tier, counts in report(conn).items():
+                print(f'{tier}: {counts["entries"]} entries, '
+                      f'{counts["stored"]} bytes stored '
+                      f'({counts["size"]} bytes of data)')
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
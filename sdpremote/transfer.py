@@ -0,0 +1,615 @@
+'''Streaming export and import of whole repo
+
+Export writes tar archive of live scopes, objects and their data, as seen
+by one snapshot of database:
+
+    manifest.json   format, repo and counts
+    blobs.copy      checksum, size and content type of each distinct data
+    scopes.copy     scopes, in text format of COPY
+    objects.copy    objects, data is referenced by checksum
+    blobs/CHECKSUM  original data, one member per distinct checksum
+
+Metadata is read by COPY, data is read from storage by --workers threads
+ahead of the member being written, so archive is written at storage speed
+and memory usage does not depend on its size. Import reads the same
+archive in one pass into new repo, which must not exist. Data already
+stored (by any repo) is not uploaded again, the rest is uploaded by
+--workers threads and gets new storage ids. Repo appears at once, when
+everything is uploaded:
+
+    python -m sdpremote.transfer export user/repo -o repo.tar
+    python -m sdpremote.transfer import repo.tar --repo user/copy
+
+Use - for stdout or stdin, so archive can be piped between servers.
+'''
+import argparse
+import hashlib
+import io
+import json
+import logging
+import sys
+import tarfile
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from tempfile import SpooledTemporaryFile
+from typing import IO, Any, Iterator, Optional
+
+import sqlalchemy as sa
+from minio.error import S3Error
+from sqlalchemy.dialects import postgresql
+
+from .config import settings
+from .database import (chunks_table, manifests_table, objects_table,
+                       repos_table, scopes_table, storage_table)
+from .metrics import instrument_engine
+from .slowlog import log_slow_statements
+from .storage import (DEFAULT_CONTENT_TYPE, Tier, get_chunk, get_stored,
+                      store_file)
+from .utils.compression import Compression, zstandard
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 1
+_BLOCK_SIZE = 1024 * 1024
+_SPOOL_SIZE = 8 * 1024 * 1024  # larger data is buffered in temporary file
+# uploaded data is not referenced until whole archive is imported
+_GRACE = timedelta(days=7)
+_PROGRESS = 30  # seconds between progress messages
+
+_temp = sa.MetaData()
+_import_blobs = sa.Table(
+    'import_blobs',
+    _temp,
+    sa.Column('checksum', sa.String(64), primary_key=True),
+    sa.Column('size', sa.BigInteger),
+    sa.Column('content_type', sa.Text),
+    # existing or uploaded storage entry with the data
+    sa.Column('sid', sa.Integer),
+    prefixes=['TEMPORARY'],
+)
+_import_scopes = sa.Table(
+    'import_scopes',
+    _temp,
+    sa.Column('name', sa.Text),
+    sa.Column('checksum', sa.String(64)),
+    sa.Column('creator', sa.Text),
+    sa.Column('timestamp', sa.DateTime),
+    sa.Column('size', sa.BigInteger),
+    prefixes=['TEMPORARY'],
+)
+_import_objects = sa.Table(
+    'import_objects',
+    _temp,
+    sa.Column('scope', sa.Text),
+    sa.Column('key', sa.Text),
+    sa.Column('checksum', sa.String(64)),
+    sa.Column('creator', sa.Text),
+    sa.Column('timestamp', sa.DateTime),
+    sa.Column('size', sa.BigInteger),
+    sa.Column('content_type', sa.Text),
+    prefixes=['TEMPORARY'],
+)
+_COPIED = {
+    'blobs.copy': _import_blobs,
+    'scopes.copy': _import_scopes,
+    'objects.copy': _import_objects,
+}
+
+
+def _live_objects(repo: str) -> Any:
+    return sa.select([objects_table]).select_from(
+        objects_table.join(
+            scopes_table,
+            sa.and_(
+                objects_table.c.scope == scopes_table.c.name,
+                objects_table.c.repo == scopes_table.c.repo,
+            ),
+        )
+    ).where(objects_table.c.repo == repo)\
+        .where(scopes_table.c.deleted_at.is_(None))
+
+
+def _blobs(repo: str, *columns: sa.Column) -> Any:
+    '''One storage entry of each distinct data referenced by repo'''
+    live = _live_objects(repo).subquery()
+    return sa.select(columns)\
+        .distinct(storage_table.c.checksum)\
+        .where(storage_table.c.id.in_(sa.select([live.c.data])))\
+        .order_by(storage_table.c.checksum, storage_table.c.id)
+
+
+def _sql(query: Any) -> str:
+    return str(
+        query.compile(
+            dialect=postgresql.dialect(),
+            compile_kwargs={'literal_binds': True},
+        ))
+
+
+def _copy_out(conn: Any, query: Any) -> tuple[SpooledTemporaryFile, int]:
+    '''Runs COPY of query, returns its output and number of rows'''
+    f = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f'COPY ({_sql(query)}) TO STDOUT', f)
+    f.seek(0)
+    return f, cursor.rowcount
+
+
+def parse_row(line: bytes) -> list[Optional[str]]:
+    '''Fields of line written by COPY, without escapes'''
+    return [
+        None if field == '\\N' else field
+        for field in line.decode().rstrip('\n').split('\t')
+    ]
+
+
+class _Progress:
+    def __init__(self, action: str, total: int):
+        self.action = action
+        self.total = total
+        self.done = 0
+        self.bytes = 0
+        self.start = self.last = time.monotonic()
+
+    def add(self, size: int):
+        self.done += 1
+        self.bytes += size
+        if time.monotonic() - self.last >= _PROGRESS:
+            self.report()
+
+    def report(self):
+        self.last = time.monotonic()
+        logger.info('%s %d of %d blobs, %.1f MiB/s', self.action, self.done,
+                    self.total,
+                    self.bytes / (self.last - self.start or 1) / 2**20)
+
+
+def _fetch(engine: Any, checksum: str, sid: int,
+           compression: Optional[Compression], chunked: bool,
+           tier: Tier) -> SpooledTemporaryFile:
+    '''Reads original data of storage entry and checks it'''
+    out = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    h = hashlib.sha256()
+    if chunked:
+        with engine.connect() as conn:
+            chunks = conn.execute(
+                sa.select([
+                    manifests_table.c.chunk,
+                    chunks_table.c.compression,
+                ]).select_from(manifests_table.join(chunks_table))\
+                    .where(manifests_table.c.sid == sid)\
+                    .order_by(manifests_table.c.number)
+            ).all()
+        for chunk, chunk_compression in chunks:
+            data, _ = get_chunk(chunk, chunk_compression)
+            h.update(data)
+            out.write(data)
+    else:
+        try:
+            response = get_stored(str(sid), tier)
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                raise
+            # moved to other tier after snapshot, maybe compressed on the way
+            with engine.connect() as conn:
+                row = conn.execute(
+                    sa.select([
+                        storage_table.c.compression,
+                        storage_table.c.tier,
+                    ]).where(storage_table.c.id == sid)
+                ).first()
+            if row is None or row.tier == tier:
+                raise
+            compression, tier = row.compression, Tier(row.tier)
+            response = get_stored(str(sid), tier)
+        decompressor = None
+        if compression == Compression.zstd:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        try:
+            while block := response.read(_BLOCK_SIZE):
+                if decompressor is not None:
+                    block = decompressor.decompress(block)
+                h.update(block)
+                out.write(block)
+        finally:
+            response.close()
+            response.release_conn()
+    if h.hexdigest() != checksum:
+        out.close()
+        raise RuntimeError(f'data of storage entry {sid} is damaged')
+    return out
+
+
+def _add(tar: tarfile.TarFile, name: str, f: IO[bytes], mtime: float):
+    info = tarfile.TarInfo(name)
+    info.size = f.seek(0, io.SEEK_END)
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    f.seek(0)
+    tar.addfile(info, f)
+    f.close()
+
+
+def export_repo(engine: Any, repo: str, out: IO[bytes], workers: int):
+    '''Writes archive of repo into out'''
+    exported = datetime.utcnow()
+    mtime = time.time()
+    metadata: dict[str, tuple[SpooledTemporaryFile, int]] = {}
+    # every COPY sees the same state of repo
+    with engine.connect().execution_options(
+            isolation_level='REPEATABLE READ',
+            postgresql_readonly=True,
+    ) as conn:
+        with conn.begin():
+            exists = conn.execute(
+                sa.select([repos_table.c.name])\
+                    .where(repos_table.c.name == repo)\
+                    .where(repos_table.c.deleted_at.is_(None))
+            ).scalar()
+            if exists is None:
+                raise RuntimeError(f'repo {repo} not found')
+            metadata['blobs.copy'] = _copy_out(
+                conn,
+                _blobs(repo, storage_table.c.checksum, storage_table.c.size,
+                       storage_table.c.content_type),
+            )
+            metadata['scopes.copy'] = _copy_out(
+                conn,
+                sa.select([
+                    scopes_table.c.name,
+                    scopes_table.c.checksum,
+                    scopes_table.c.creator,
+                    scopes_table.c.timestamp,
+                    scopes_table.c.size,
+                ]).where(scopes_table.c.repo == repo)\
+                    .where(scopes_table.c.deleted_at.is_(None)),
+            )
+            live = _live_objects(repo).subquery()
+            metadata['objects.copy'] = _copy_out(
+                conn,
+                sa.select([
+                    live.c.scope,
+                    live.c.key,
+                    live.c.checksum,
+                    live.c.creator,
+                    live.c.timestamp,
+                    live.c.size,
+                    live.c.content_type,
+                ]),
+            )
+            # same order as blobs.copy
+            sources, _ = _copy_out(
+                conn,
+                _blobs(repo, storage_table.c.checksum, storage_table.c.id,
+                       storage_table.c.compression, storage_table.c.chunked,
+                       storage_table.c.tier),
+            )
+
+    manifest = dict(
+        format=FORMAT,
+        repo=repo,
+        exported=exported.isoformat(),
+        **{
+            name.split('.')[0]: rows
+            for name, (_, rows) in metadata.items()
+        },
+    )
+    progress = _Progress('exported', manifest['blobs'])
+    with tarfile.open(fileobj=out, mode='w|',
+                      format=tarfile.PAX_FORMAT) as tar, \
+            ThreadPoolExecutor(workers, thread_name_prefix='export') as pool:
+        _add(tar, 'manifest.json', io.BytesIO(json.dumps(manifest).encode()),
+             mtime)
+        for name, (f, _) in metadata.items():
+            _add(tar, name, f, mtime)
+
+        window: deque[tuple[str, Future]] = deque()
+
+        def write_next():
+            checksum, future = window.popleft()
+            f = future.result()
+            size = f.seek(0, io.SEEK_END)
+            _add(tar, f'blobs/{checksum}', f, mtime)
+            progress.add(size)
+
+        try:
+            for line in sources:
+                checksum, sid, compression, chunked, tier = parse_row(line)
+                window.append((checksum, pool.submit(
+                    _fetch,
+                    engine,
+                    checksum,
+                    int(sid),
+                    compression,
+                    chunked == 't',
+                    Tier(tier),
+                )))
+                if len(window) >= 2 * workers:
+                    write_next()
+            while window:
+                write_next()
+        finally:
+            sources.close()
+            for _, future in window:
+                future.cancel()
+    progress.report()
+
+
+def _upload(engine: Any, owner: str, checksum: str, content_type: str,
+            f: SpooledTemporaryFile) -> int:
+    '''Stores data in new unclaimed storage entry, returns its id'''
+    with engine.begin() as conn:
+        sid = conn.execute(
+            sa.insert(storage_table)\
+                .values(
+                    owner=owner,
+                    content_type=content_type,
+                    expire_at=datetime.utcnow() + _GRACE,
+                )\
+                .returning(storage_table.c.id)
+        ).scalar()
+    try:
+        stored = store_file(sid, f, content_type)
+    finally:
+        f.close()
+    if stored.checksum != checksum:
+        raise RuntimeError(f'data of {checksum} is damaged in archive')
+    with engine.begin() as conn:
+        conn.execute(
+            sa.update(storage_table)\
+                .where(storage_table.c.id == sid)\
+                .values(
+                    checksum=stored.checksum,
+                    size=stored.size,
+                    compression=stored.compression,
+                    stored_size=stored.stored_size,
+                )
+        )
+    return sid
+
+
+def _members(tar: tarfile.TarFile) -> Iterator[tarfile.TarInfo]:
+    for member in tar:
+        if member.isfile():
+            yield member
+
+
+def _expect(member: Optional[tarfile.TarInfo], name: str) -> tarfile.TarInfo:
+    if member is None or member.name != name:
+        found = 'end' if member is None else member.name
+        raise RuntimeError(f'{name} expected in archive, found {found}')
+    return member
+
+
+def import_repo(engine: Any, source: IO[bytes], repo: str, workers: int):
+    '''Creates repo from archive read from source'''
+    owner = repo.split('/', 1)[0]
+    tar = tarfile.open(fileobj=source, mode='r|')
+    members = _members(tar)
+    member = _expect(next(members, None), 'manifest.json')
+    manifest = json.load(tar.extractfile(member))  # type: ignore
+    if manifest.get('format') != FORMAT:
+        raise RuntimeError(f'unknown archive format {manifest.get("format")}')
+    logger.info('importing %s exported at %s as %s', manifest['repo'],
+                manifest['exported'], repo)
+
+    # temporary tables belong to this connection
+    with engine.connect() as conn:
+        with conn.begin():
+            exists = conn.execute(
+                sa.select([repos_table.c.name])\
+                    .where(repos_table.c.name == repo)
+            ).scalar()
+            if exists is not None:
+                raise RuntimeError(f'repo {repo} already exists')
+            _temp.create_all(conn)
+            cursor = conn.connection.cursor()
+            for name, table in _COPIED.items():
+                member = _expect(next(members, None), name)
+                columns = ', '.join(
+                    c.name for c in table.columns if c.name != 'sid')
+                cursor.copy_expert(
+                    f'COPY {table.name} ({columns}) FROM STDIN',
+                    tar.extractfile(member),
+                )
+            # any claimed copy of data will do, it is claimed again at once
+            # in case it was released since. Released during import, it is
+            # reaped after usual delay, which import checks in the end
+            stored = sa.select([storage_table.c.id])\
+                .distinct(storage_table.c.checksum)\
+                .where(storage_table.c.checksum.in_(
+                    sa.select([_import_blobs.c.checksum])))\
+                .where(storage_table.c.expire_at.is_(None))\
+                .order_by(storage_table.c.checksum, storage_table.c.id)
+            claimed = conn.execute(
+                sa.update(storage_table)\
+                    .where(storage_table.c.id.in_(stored))\
+                    .values(expire_at=None, referenced_at=sa.func.now())\
+                    .returning(storage_table.c.id, storage_table.c.checksum)
+            ).all()
+            if claimed:
+                conn.execute(
+                    sa.update(_import_blobs)\
+                        .where(_import_blobs.c.checksum ==
+                               sa.bindparam('blob'))\
+                        .values(sid=sa.bindparam('sid')),
+                    [dict(blob=checksum, sid=sid)
+                     for sid, checksum in claimed],
+                )
+            missing = dict(
+                conn.execute(
+                    sa.select([
+                        _import_blobs.c.checksum,
+                        _import_blobs.c.content_type,
+                    ]).where(_import_blobs.c.sid.is_(None))
+                ).all())
+        logger.info('%d of %d blobs are stored already',
+                    manifest['blobs'] - len(missing), manifest['blobs'])
+
+        progress = _Progress('uploaded', len(missing))
+        uploaded: list[dict[str, Any]] = []
+
+        def save_uploaded():
+            if uploaded:
+                with conn.begin():
+                    conn.execute(
+                        sa.update(_import_blobs)\
+                            .where(_import_blobs.c.checksum ==
+                                   sa.bindparam('blob'))\
+                            .values(sid=sa.bindparam('sid')),
+                        uploaded,
+                    )
+                uploaded.clear()
+
+        window: deque[tuple[str, int, Future]] = deque()
+
+        def finish_next():
+            checksum, size, future = window.popleft()
+            uploaded.append(dict(blob=checksum, sid=future.result()))
+            progress.add(size)
+            if len(uploaded) >= 1000:
+                save_uploaded()
+
+        with ThreadPoolExecutor(workers,
+                                thread_name_prefix='import') as pool:
+            try:
+                for member in members:
+                    if not member.name.startswith('blobs/'):
+                        raise RuntimeError(
+                            f'unexpected {member.name} in archive')
+                    checksum = member.name[len('blobs/'):]
+                    if checksum not in missing:
+                        continue
+                    content_type = missing.pop(checksum)
+                    # archive is read in one pass, data is buffered for
+                    # upload while next members are read
+                    f = SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+                    data = tar.extractfile(member)
+                    while block := data.read(_BLOCK_SIZE):  # type: ignore
+                        f.write(block)
+                    f.seek(0)
+                    window.append((checksum, member.size, pool.submit(
+                        _upload,
+                        engine,
+                        owner,
+                        checksum,
+                        content_type or DEFAULT_CONTENT_TYPE,
+                        f,
+                    )))
+                    if len(window) >= 2 * workers:
+                        finish_next()
+                while window:
+                    finish_next()
+            finally:
+                for _, _, future in window:
+                    future.cancel()
+        save_uploaded()
+        progress.report()
+        if missing:
+            raise RuntimeError(f'{len(missing)} blobs are missing in archive')
+
+        with conn.begin():
+            lost = conn.execute(
+                sa.select([sa.func.count()])\
+                    .where(~sa.exists().where(
+                        storage_table.c.id == _import_blobs.c.sid))
+            ).scalar()
+            if lost:
+                raise RuntimeError(f'{lost} stored blobs were removed during '
+                                   f'import, run it again')
+            conn.execute(sa.insert(repos_table).values(name=repo))
+            conn.execute(
+                sa.insert(scopes_table).from_select(
+                    ['name', 'repo', 'checksum', 'creator', 'timestamp',
+                     'size'],
+                    sa.select([
+                        _import_scopes.c.name,
+                        sa.literal(repo),
+                        _import_scopes.c.checksum,
+                        _import_scopes.c.creator,
+                        _import_scopes.c.timestamp,
+                        _import_scopes.c.size,
+                    ]),
+                ))
+            conn.execute(
+                sa.insert(objects_table).from_select(
+                    ['key', 'scope', 'repo', 'checksum', 'creator',
+                     'timestamp', 'data', 'size', 'content_type'],
+                    sa.select([
+                        _import_objects.c.key,
+                        _import_objects.c.scope,
+                        sa.literal(repo),
+                        _import_objects.c.checksum,
+                        _import_objects.c.creator,
+                        _import_objects.c.timestamp,
+                        _import_blobs.c.sid,
+                        _import_objects.c.size,
+                        _import_objects.c.content_type,
+                    ]).select_from(
+                        _import_objects.outerjoin(
+                            _import_blobs,
+                            _import_objects.c.checksum ==
+                            _import_blobs.c.checksum,
+                        )),
+                ))
+            conn.execute(
+                sa.update(storage_table)\
+                    .where(storage_table.c.id.in_(
+                        sa.select([_import_blobs.c.sid])))\
+                    .values(expire_at=None, referenced_at=sa.func.now())
+            )
+            conn.execute(
+                sa.update(repos_table)\
+                    .where(repos_table.c.name == repo)\
+                    .values(size=sa.select([
+                        sa.func.coalesce(sa.func.sum(_import_scopes.c.size),
+                                         0)
+                    ]).scalar_subquery())
+            )
+    logger.info('imported %d scopes and %d objects into %s',
+                manifest['scopes'], manifest['objects'], repo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write archive of repo')
+    export.add_argument('repo')
+    export.add_argument('-o', '--output', default='-')
+    export.add_argument('--workers', type=int, default=8)
+    load = commands.add_parser('import', help='create repo from archive')
+    load.add_argument('archive')
+    load.add_argument('--repo', required=True)
+    load.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    engine = sa.create_engine(
+        settings['database.uri_sync'],
+        echo=settings['database.echo'],
+        pool_size=args.workers + 1,
+    )
+    instrument_engine(engine)
+    log_slow_statements(engine)
+    try:
+        if args.command == 'export':
+            if args.output == '-':
+                export_repo(engine, args.repo, sys.stdout.buffer, args.workers)
+            else:
+                with open(args.output, 'wb') as out:
+                    export_repo(engine, args.repo, out, args.workers)
+        elif args.archive == '-':
+            import_repo(engine, sys.stdin.buffer, args.repo, args.workers)
+        else:
+            with open(args.archive, 'rb') as source:
+                import_repo(engine, source, args.repo, args.workers)
+    except RuntimeError as e:
+        parser.exit(1, f'{e}\n')
+    finally:
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+import asyncio
+import math
+from collections import defaultdict
+from typing import Optional
+
+from fastapi import HTTPException, status
+from starlette.datastructures import Headers
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from ..config import settings
+from .user import _user_header
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, retry_after: int):
+        super().__init__(status_code, retry_after)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _Usage:
+    __slots__ = ('uploads', 'bytes')
+
+    def __init__(self):
+        self.uploads = 0
+        self.bytes = 0
+
+
+class UploadLimiter:
+    '''Limits concurrent uploads and bytes in flight, globally and per user
+
+    Requests that do not fit wait in queue of `queue` requests up to
+    `timeout` seconds and are rejected with 429 when per user limit blocks
+    them or with 503 otherwise. Single request bigger than bytes limit is admitted when nothing else is
+    in flight, so it can not wait forever.
+    '''
+    def __init__(
+            self,
+            uploads: int,
+            uploads_per_user: int,
+            max_bytes: int,
+            max_bytes_per_user: int,
+            queue: int,
+            timeout: float,
+    ):
+        self.uploads = uploads
+        self.uploads_per_user = uploads_per_user
+        self.max_bytes = max_bytes
+        self.max_bytes_per_user = max_bytes_per_user
+        self.queue = queue
+        self.timeout = timeout
+        self.total = _Usage()
+        self.users: defaultdict[str, _Usage] = defaultdict(_Usage)
+        self.waiting = 0
+        self._cond: Optional[asyncio.Condition] = None
+
+    @classmethod
+    def from_settings(cls) -> 'UploadLimiter':
+        return cls(
+            uploads=settings['limits.uploads'],
+            uploads_per_user=settings['limits.uploads_per_user'],
+            max_bytes=settings['limits.upload_bytes'],
+            max_bytes_per_user=settings['limits.upload_bytes_per_user'],
+            queue=settings['limits.upload_queue'],
+            timeout=settings['limits.upload_timeout'],
+        )
+
+    @property
+    def cond(self) -> asyncio.Condition:
+        # created lazily to bind to running loop
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @staticmethod
+    def _fits(usage: _Usage, uploads: int, max_bytes: int, size: int):
+        if usage.uploads >= uploads:
+            return False
+        return usage.bytes == 0 or usage.bytes + size <= max_bytes
+
+    def _user_fits(self, user: str, size: int) -> bool:
+        return self._fits(
+            self.users.get(user) or _Usage(),
+            self.uploads_per_user,
+            self.max_bytes_per_user,
+            size,
+        )
+
+    def _total_fits(self, size: int) -> bool:
+        return self._fits(self.total, self.uploads, self.max_bytes, size)
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.timeout))
+
+    def _rejected(self, user: str, size: int) -> Rejected:
+        return Rejected(
+            status.HTTP_429_TOO_MANY_REQUESTS
+            if not self._user_fits(user, size) else
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            self._retry_after(),
+        )
+
+    async def acquire(self, user: str, size: int):
+        async with self.cond:
+            if self._user_fits(user, size) and self._total_fits(size):
+                self._admit(user, size)
+                return
+            # queue limits only uploads which must wait
+            if self.waiting >= self.queue:
+                raise self._rejected(user, size)
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(
+                    self.cond.wait_for(lambda: self._user_fits(
+                        user, size) and self._total_fits(size)),
+                    self.timeout,
+                )
+            except asyncio.TimeoutError:
+                raise self._rejected(user, size)
+            finally:
+                self.waiting -= 1
+            self._admit(user, size)
+
+    def _admit(self, user: str, size: int):
+        for usage in (self.total, self.users[user]):
+            usage.uploads += 1
+            usage.bytes += size
+
+    async def release(self, user: str, size: int):
+        async with self.cond:
+            for usage in (self.total, self.users[user]):
+                usage.uploads -= 1
+                usage.bytes -= size
+            if not self.users[user].uploads:
+                del self.users[user]
+            self.cond.notify_all()
+
+
+class UploadAdmission:
+    '''Admission control for upload routes
+
+    Works before request body is read, so rejected uploads do not spool
+    anything to disk.
+    '''
+    def __init__(self, app: ASGIApp, paths: tuple[str, ...] = ('/upload', '/.upload')):
+        self.app = app
+        self.paths = paths
+        self.limiter = UploadLimiter.from_settings()
+
+    def gated(self, path: str) -> bool:
+        '''Checks whether path is one of upload routes, /uploadbot is not'''
+        return any(
+            path == prefix or path.startswith(prefix + '/')
+            for prefix in self.paths)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['method'] not in (
+                'POST', 'PUT', 'PATCH') or not self.gated(scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        try:
+            user = _user_header(headers.get('authorization'))
+        except HTTPException:
+            # route rejects it by itself
+            await self.app(scope, receive, send)
+            return
+        try:
+            size = int(headers.get('content-length', 0))
+        except ValueError:
+            size = 0
+
+        try:
+            await self.limiter.acquire(user, size)
+        except Rejected as e:
+            response = PlainTextResponse(
+                'too many uploads in flight',
+                status_code=e.status_code,
+                headers={'Retry-After': str(e.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await self.limiter.release(user, size)
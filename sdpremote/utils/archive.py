@@ -0,0 +1,128 @@
+import asyncio
+import tarfile
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, Optional, Union
+
+from ..storage import Tier, openObject
+from .compression import Compression, zstandard
+
+_QUEUE_SIZE = 4  # chunks buffered per object
+
+
+@dataclass(frozen=True)
+class Entry:
+    name: str
+    sid: int
+    mtime: datetime
+    compression: Optional[Compression] = None
+    chunked: bool = False
+    size: Optional[int] = None  # required for compressed data
+    tier: Tier = Tier.hot
+
+
+_Chunk = Union[int, bytes, Exception, None]
+
+
+async def _prefetch(
+        entry: Entry,
+        queue: 'asyncio.Queue[_Chunk]',
+        slots: asyncio.Semaphore,
+):
+    try:
+        stream = await openObject(entry.sid, entry.compression, entry.size,
+                                  entry.chunked, entry.tier)
+        try:
+            await queue.put(stream.size)
+            while chunk := await stream.read():
+                await queue.put(chunk)
+        finally:
+            stream.close()
+        await queue.put(None)
+    except Exception as e:
+        await queue.put(e)
+    finally:
+        slots.release()
+
+
+async def _schedule(
+        entries: AsyncIterator[Entry],
+        pending: asyncio.Queue,
+        tasks: set[asyncio.Task],
+        read_ahead: int,
+):
+    slots = asyncio.Semaphore(read_ahead)
+    try:
+        async for entry in entries:
+            await slots.acquire()
+            queue: 'asyncio.Queue[_Chunk]' = asyncio.Queue(_QUEUE_SIZE)
+            task = asyncio.create_task(_prefetch(entry, queue, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            await pending.put((entry, queue))
+        await pending.put(None)
+    except Exception as e:
+        await pending.put(e)
+
+
+def _unwrap(chunk: _Chunk) -> _Chunk:
+    if isinstance(chunk, Exception):
+        raise chunk
+    return chunk
+
+
+async def tar_stream(
+        entries: AsyncIterator[Entry],
+        read_ahead: int,
+) -> AsyncIterator[bytes]:
+    '''Build tar archive of entries on the fly
+
+    Up to `read_ahead` objects are fetched from storage concurrently ahead
+    of the one being written, each of them buffering at most a few chunks,
+    so memory usage does not depend on archive size.
+    '''
+    pending: asyncio.Queue = asyncio.Queue(read_ahead)
+    tasks: set[asyncio.Task] = set()
+    scheduler = asyncio.create_task(
+        _schedule(entries, pending, tasks, read_ahead))
+    written = 0
+    try:
+        while (item := _unwrap(await pending.get())) is not None:
+            entry, queue = item
+            size: int = _unwrap(await queue.get())  # type: ignore
+            info = tarfile.TarInfo(entry.name)
+            info.size = size
+            info.mode = 0o644
+            info.mtime = int(
+                entry.mtime.replace(tzinfo=timezone.utc).timestamp())
+            header = info.tobuf(tarfile.PAX_FORMAT)
+            yield header
+            while (chunk := _unwrap(await queue.get())) is not None:
+                yield chunk  # type: ignore
+            padding = -size % tarfile.BLOCKSIZE
+            if padding:
+                yield tarfile.NUL * padding
+            written += len(header) + size + padding
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        written += len(end)
+        yield end + tarfile.NUL * (-written % tarfile.RECORDSIZE)
+    finally:
+        scheduler.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+async def compress_stream(
+        stream: AsyncIterator[bytes],
+        compression: Optional[Compression],
+) -> AsyncIterator[bytes]:
+    if compression is None:
+        async for chunk in stream:
+            yield chunk
+        return
+    compressor = zstandard.ZstdCompressor().compressobj()
+    async for chunk in stream:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,67 @@
+'''Content-defined chunking of data for deduplication
+
+Boundaries are found with gear rolling hash as in FastCDC, so they depend
+only on nearby content and small change of data changes only chunks around
+it. Parameters are part of protocol: clients must split data the same way
+to find chunks which are stored already.
+'''
+import hashlib
+from typing import BinaryIO, Iterator
+
+MIN_SIZE = 64 * 1024
+AVG_SIZE = 256 * 1024
+MAX_SIZE = 1024 * 1024
+
+_HASH_MASK = 0xFFFFFFFF
+# normalized chunking: boundary is harder to find before average size and
+# easier after it, which narrows distribution of chunk sizes
+_MASK_S = ((1 << 20) - 1) << 12
+_MASK_L = ((1 << 16) - 1) << 16
+
+_GEAR = tuple(
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], 'big')
+    for i in range(256))
+
+
+def cut(data: bytes) -> int:
+    '''Length of first chunk of data
+
+    Data must contain at least MAX_SIZE bytes unless it is end of stream.
+    '''
+    n = len(data)
+    if n <= MIN_SIZE:
+        return n
+    gear = _GEAR
+    h = 0
+    i = MIN_SIZE
+    for b in data[MIN_SIZE:min(n, AVG_SIZE)]:
+        h = ((h << 1) + gear[b]) & _HASH_MASK
+        i += 1
+        if not h & _MASK_S:
+            return i
+    for b in data[i:min(n, MAX_SIZE)]:
+        h = ((h << 1) + gear[b]) & _HASH_MASK
+        i += 1
+        if not h & _MASK_L:
+            return i
+    return i
+
+
+def split(f: BinaryIO) -> Iterator[bytes]:
+    '''Splits rest of file into chunks'''
+    buf = b''
+    eof = False
+    while True:
+        while not eof and len(buf) < MAX_SIZE:
+            data = f.read(MAX_SIZE)
+            eof = not data
+            buf += data
+        if not buf:
+            return
+        n = cut(buf)
+        yield buf[:n]
+        buf = buf[n:]
+
+
+def chunk_checksum(chunk: bytes) -> str:
+    return hashlib.sha256(chunk).hexdigest()
@@ -0,0 +1,63 @@
+from enum import Enum
+from typing import Optional
+
+from ..config import settings
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# media which is compressed already and is not worth a try
+COMPRESSED_TYPES = (
+    'image/',
+    'video/',
+    'audio/',
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/zstd',
+    'application/x-xz',
+    'application/x-bzip2',
+    'application/x-7z-compressed',
+)
+
+
+class Compression(str, Enum):
+    zstd = 'zstd'
+
+
+def choose_compression(
+        sample: bytes,
+        size: int,
+        content_type: Optional[str],
+) -> Optional[Compression]:
+    '''Decides how to store data by its type and leading sample'''
+    if zstandard is None or not settings['compression.enabled']:
+        return None
+    if size < settings['compression.min_size']:
+        return None
+    if content_type and content_type.startswith(COMPRESSED_TYPES):
+        return None
+    compressed = zstandard.ZstdCompressor(
+        level=settings['compression.level']).compress(sample)
+    if len(compressed) > len(sample) * settings['compression.max_ratio']:
+        return None
+    return Compression.zstd
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    '''Checks Accept-Encoding header for encoding with non zero quality'''
+    for part in (accept_encoding or '').split(','):
+        name, *params = part.split(';')
+        if name.strip().lower() not in (encoding, '*'):
+            continue
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
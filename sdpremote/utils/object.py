@@ -1,9 +1,10 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Union
+from typing import Any, Optional, Union
 
 import sqlalchemy as sa
 from fastapi import HTTPException, status
+from sqlalchemy.dialects import postgresql
 
 from ..database import objects_table, storage_table
 
@@ -21,8 +22,58 @@ class ObjectExtra:
     timestamp: datetime
 
 
+@dataclass(frozen=True)
+class ObjectState:
+    key: str
+    checksum: Optional[str]
+    size: Optional[int]
+
+    @property
+    def line(self) -> str:
+        '''Line of object in scope checksum'''
+        return f'{self.key} ' + (self.checksum if self.checksum else 'null')
+
+
 ObjectData = Union[int, None]
 
+_claim_storage = sa.update(storage_table)\
+    .where(storage_table.c.id == sa.bindparam('sid'))\
+    .where(storage_table.c.checksum.isnot(None))\
+    .values(expire_at=None, referenced_at=sa.func.now())\
+    .returning(
+        storage_table.c.checksum,
+        storage_table.c.owner,
+        storage_table.c.size,
+        storage_table.c.content_type,
+    )
+
+_insert_object = postgresql.insert(objects_table)
+_upsert_object = _insert_object.on_conflict_do_update(
+    index_elements=[
+        objects_table.c.key,
+        objects_table.c.scope,
+        objects_table.c.repo,
+    ],
+    set_=dict(
+        checksum=_insert_object.excluded.checksum,
+        creator=_insert_object.excluded.creator,
+        timestamp=_insert_object.excluded.timestamp,
+        data=_insert_object.excluded.data,
+        size=_insert_object.excluded.size,
+        content_type=_insert_object.excluded.content_type,
+    ),
+)
+
+
+def storage_order(item: tuple[str, Any]) -> int:
+    '''Sort key for (key, data) pairs which claims storage in id order
+
+    Scopes often share storage objects, so claiming them in arbitrary order
+    from concurrent transactions deadlocks on storage rows.
+    '''
+    _, data = item
+    return data if isinstance(data, int) else -1
+
 
 async def create_object(
         path: ObjectPath,
@@ -30,49 +81,37 @@ async def create_object(
         extra: ObjectExtra,
         user: str,
         conn: Any,  # HACK AsyncConnection
-) -> str:
+) -> ObjectState:
     trx = await conn.begin_nested()
 
-    checksum = None
+    checksum = size = content_type = None
 
     if data is not None:
-        result: Any = await conn.execute(
-            sa.update(storage_table).where(storage_table.c.id == data)\
-                .values(expire_at=None)\
-                .returning(storage_table.c.checksum, storage_table.c.owner)
-        )
+        result: Any = await conn.execute(_claim_storage, dict(sid=data))
         if result.rowcount != 1:
             raise HTTPException(
                 status.HTTP_404_NOT_FOUND,
                 'storage object not found',
             )
-        checksum, owner = result.one()
+        checksum, owner, size, content_type = result.one()
         if owner != user:
             raise HTTPException(status.HTTP_403_FORBIDDEN)
 
-    query = sa.dialects.postgresql.insert(objects_table).values(
-        key=path.key,
-        scope=path.scope,
-        repo=path.repo,
-        checksum=checksum,
-        creator=extra.creator,
-        timestamp=extra.timestamp,
-        data=data,
-    ).on_conflict_do_update(
-        index_elements=[
-            objects_table.c.key,
-            objects_table.c.scope,
-            objects_table.c.repo,
-        ],
-        set_=dict(
+    await conn.execute(
+        _upsert_object,
+        dict(
+            key=path.key,
+            scope=path.scope,
+            repo=path.repo,
             checksum=checksum,
             creator=extra.creator,
             timestamp=extra.timestamp,
             data=data,
+            size=size,
+            content_type=content_type,
         ),
     )
-    await conn.execute(query)
 
     await trx.commit()
 
-    return f'{path.key} ' + (checksum if checksum else 'null')
+    return ObjectState(key=path.key, checksum=checksum, size=size)
@@ -0,0 +1,4 @@
+def like_prefix(prefix: str) -> str:
+    '''LIKE pattern for strings starting with prefix, escape char is `/`'''
+    escaped = prefix.replace('/', '//').replace('%', '/%').replace('_', '/_')
+    return f'{escaped}%'
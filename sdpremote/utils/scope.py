@@ -2,9 +2,10 @@ from typing import Any, Optional
 
 import sqlalchemy as sa
 
-from ..database import scopes_table
+from ..database import repos_table, scopes_table
 from .checksum import calc_checksum
-from .object import ObjectData, ObjectExtra, ObjectPath, create_object
+from .object import (ObjectData, ObjectExtra, ObjectPath, ObjectState,
+                     create_object, storage_order)
 
 
 async def set_scope(
@@ -14,8 +15,9 @@ async def set_scope(
         user: str,
         extra: ObjectExtra,
         conn: Any,  # HACK AsyncConnection
-) -> Optional[str]:
-    checksums: dict[str, str] = {
+) -> tuple[Optional[str], int]:
+    '''Creates objects in scope, returns new scope checksum and size'''
+    states: dict[str, ObjectState] = {
         key: await create_object(
             ObjectPath(key=key, scope=scope, repo=repo),
             data,
@@ -23,17 +25,33 @@ async def set_scope(
             user,
             conn,
         )
-        for key, data in objects.items()
+        for key, data in sorted(objects.items(), key=storage_order)
     }
 
     checksum = None
-    if checksums:
-        checksum = calc_checksum(checksums)
+    size = sum(state.size or 0 for state in states.values())
+    if states:
+        checksum = calc_checksum(
+            {key: state.line
+             for key, state in states.items()})
         await conn.execute(
             sa.update(scopes_table)\
                 .where(scopes_table.c.name == scope)\
                 .where(scopes_table.c.repo == repo)\
-                .values(checksum=checksum)
+                .values(checksum=checksum, size=size)
         )
 
-    return checksum
+    return checksum, size
+
+
+async def add_repo_size(
+        repo: str,
+        delta: int,
+        conn: Any,  # HACK AsyncConnection
+):
+    if delta:
+        await conn.execute(
+            sa.update(repos_table)\
+                .where(repos_table.c.name == repo)\
+                .values(size=repos_table.c.size + delta)
+        )
@@ -0,0 +1,59 @@
+import asyncio
+import functools
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
+
+from ..config import settings
+from ..metrics import COALESCED_REQUESTS
+
+T = TypeVar('T')
+
+# position of change made elsewhere, which read must see. Read started
+# before the change is not shared with reads which require it
+barrier: ContextVar[Optional[str]] = ContextVar('barrier', default=None)
+
+
+class SingleFlight:
+    '''Runs identical concurrent reads once and shares their result
+
+    Read is identified by repo and key, which starts with route name and
+    holds normalized parameters of route. Repo name includes owner, who is
+    the only user with access, so results are never shared across users.
+    Changes of repo made through this worker are visible to reads started
+    after them: `forget` detaches in-flight reads of repo, later requests
+    start own read. Changes made through other workers are known only from
+    `barrier` of the read, so reads are shared only within equal barriers.
+    '''
+    def __init__(self):
+        self.calls: dict[str, dict[Hashable, asyncio.Future]] = {}
+
+    async def do(self, repo: str, key: tuple,
+                 fn: Callable[[], Awaitable[T]]) -> T:
+        if not settings['coalesce.enabled']:
+            return await fn()
+        key = (*key, barrier.get())
+        calls = self.calls.setdefault(repo, {})
+        task = calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            calls[key] = task
+            task.add_done_callback(functools.partial(self._done, repo, key))
+        else:
+            COALESCED_REQUESTS.inc(key[0])
+        # disconnect of one client does not cancel read shared with others
+        return await asyncio.shield(task)
+
+    def _done(self, repo: str, key: tuple, task: asyncio.Future):
+        calls = self.calls.get(repo)
+        if calls is not None and calls.get(key) is task:
+            del calls[key]
+            if not calls:
+                del self.calls[repo]
+        if not task.cancelled():
+            task.exception()  # retrieved, when every waiter has gone
+
+    def forget(self, repo: str):
+        self.calls.pop(repo, None)
+
+
+flights = SingleFlight()
@@ -0,0 +1,32 @@
+import time
+from typing import Callable
+
+
+class Pacer:
+    '''Keeps average rate of consumed amount (bytes, requests) per second
+
+    Token bucket which holds up to one second worth of rate, so short
+    bursts pass at once and longer ones are spread out by sleeping.
+    '''
+    def __init__(
+            self,
+            rate: float,
+            clock: Callable[[], float] = time.monotonic,
+            sleep: Callable[[float], object] = time.sleep,
+    ):
+        self.rate = rate
+        self.clock = clock
+        self.sleep = sleep
+        self.allowance = rate
+        self.last = clock()
+
+    def wait(self, amount: float = 1):
+        now = self.clock()
+        self.allowance = min(
+            self.rate,
+            self.allowance + (now - self.last) * self.rate,
+        )
+        self.last = now
+        self.allowance -= amount
+        if self.allowance < 0:
+            self.sleep(-self.allowance / self.rate)
@@ -0,0 +1,93 @@
+from typing import Any, Optional
+
+import sqlalchemy as sa
+from fastapi import HTTPException, status
+
+# Walks over direct children of prefix with one index probe per child: when
+# found key has delimiter after prefix, whole common prefix is skipped by
+# jumping to its successor. Keys are compared bytewise (COLLATE "C") to
+# match ix__objects__repo_scope_key and to make successor bound valid.
+# Keys of tombstoned scope are hidden, as other object listings.
+_walk = sa.text('''
+WITH RECURSIVE walk(key) AS (
+    (
+        SELECT key FROM objects
+        WHERE repo = :repo AND scope = :scope
+            AND key COLLATE "C" >= :prefix
+        ORDER BY key COLLATE "C"
+        LIMIT 1
+    )
+    UNION ALL
+    SELECT (
+        SELECT o.key FROM objects o
+        WHERE o.repo = :repo AND o.scope = :scope
+            AND o.key COLLATE "C" >= CASE
+                WHEN strpos(substr(w.key, :start), :delimiter) > 0
+                THEN left(
+                    w.key,
+                    :length + strpos(substr(w.key, :start), :delimiter) - 1
+                ) || :successor
+                ELSE w.key || chr(1)
+            END
+        ORDER BY o.key COLLATE "C"
+        LIMIT 1
+    )
+    FROM walk w
+    WHERE w.key IS NOT NULL AND left(w.key, :length) = :prefix
+)
+SELECT key FROM walk
+WHERE key IS NOT NULL AND left(key, :length) = :prefix
+    AND NOT EXISTS (
+        SELECT FROM scopes
+        WHERE name = :scope AND repo = :repo AND deleted_at IS NOT NULL
+    )
+''')
+
+
+def _successor(delimiter: str) -> Optional[str]:
+    # smallest string which is greater than any string starting with
+    # delimiter, surrogates are not valid in keys and are skipped. None
+    # when delimiter consists of the last code point only
+    chars = list(delimiter)
+    while chars:
+        code = ord(chars.pop()) + 1
+        if code == 0xD800:
+            code = 0xE000
+        if code <= 0x10FFFF:
+            return ''.join(chars) + chr(code)
+    return None
+
+
+async def list_children(
+        repo: str,
+        scope: str,
+        prefix: str,
+        delimiter: str,
+        conn: Any,  # HACK AsyncConnection
+) -> tuple[list[str], list[str]]:
+    '''Split direct children of prefix to keys and common prefixes'''
+    successor = _successor(delimiter)
+    if successor is None:
+        raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            'unsupported delimiter')
+    result = await conn.execute(
+        _walk,
+        dict(
+            repo=repo,
+            scope=scope,
+            prefix=prefix,
+            delimiter=delimiter,
+            successor=successor,
+            length=len(prefix),
+            start=len(prefix) + 1,
+        ),
+    )
+    keys: list[str] = []
+    prefixes: list[str] = []
+    for key in result.scalars():
+        idx = key.find(delimiter, len(prefix))
+        if idx < 0:
+            keys.append(key)
+        else:
+            prefixes.append(key[:idx + len(delimiter)])
+    return keys, prefixes
@@ -39,6 +39,9 @@ def _user_header(authorization: Optional[str] = Header(None)) -> str:
     user = splitted[0]
     if not user:
         raise HTTPException(status.HTTP_401_UNAUTHORIZED, 'invalid value')
+    # paths like /.upload/... are reserved for service routes
+    if user.startswith('.'):
+        raise HTTPException(status.HTTP_401_UNAUTHORIZED, 'reserved user name')
 
     return user
 
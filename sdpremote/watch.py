@@ -0,0 +1,108 @@
+import asyncio
+import json
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+import asyncpg
+import sqlalchemy as sa
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'sdpremote_scopes'
+
+
+@dataclass(eq=False)
+class Waiter:
+    name: str
+    is_prefix: bool
+    future: asyncio.Future = field(repr=False)
+
+    def matches(self, name: str) -> bool:
+        if self.is_prefix:
+            return name.startswith(self.name)
+        return name == self.name
+
+
+class ScopeWatcher:
+    '''Fans out scope change notifications to waiting requests
+
+    Worker keeps one LISTEN connection, opened on first wait and reopened
+    after it was lost. Notifications come from trigger on scopes table.
+    '''
+    def __init__(self):
+        self.conn: Optional[Any] = None  # asyncpg.Connection
+        self.waiters: dict[str, set[Waiter]] = {}
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def _connect(self) -> Any:
+        url = sa.engine.make_url(settings['database.uri'])
+        conn = await asyncpg.connect(
+            user=url.username,
+            password=url.password,
+            host=url.host or url.query.get('host'),
+            port=url.port,
+            database=url.database,
+        )
+        await conn.add_listener(CHANNEL, self._notify)
+        conn.add_termination_listener(self._terminated)
+        return conn
+
+    async def _ensure_connection(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.conn is None or self.conn.is_closed():
+                self.conn = await self._connect()
+
+    def _terminated(self, conn: Any):
+        logger.warning('scope watch connection lost')
+        self.conn = None
+        # changes may be missed until reconnect, so let clients recheck
+        for waiters in self.waiters.values():
+            for waiter in waiters:
+                if not waiter.future.done():
+                    waiter.future.set_result(None)
+
+    def _notify(self, conn: Any, pid: int, channel: str, payload: str):
+        change = json.loads(payload)
+        for waiter in self.waiters.get(change['repo'], ()):
+            if not waiter.future.done() and waiter.matches(change['name']):
+                waiter.future.set_result(change['name'])
+
+    async def listen(self, repo: str, name: str, is_prefix: bool) -> Waiter:
+        '''Registers waiter, which must be cancelled after use'''
+        await self._ensure_connection()
+        waiter = Waiter(
+            name=name,
+            is_prefix=is_prefix,
+            future=asyncio.get_running_loop().create_future(),
+        )
+        self.waiters.setdefault(repo, set()).add(waiter)
+        return waiter
+
+    def cancel(self, repo: str, waiter: Waiter):
+        waiters = self.waiters.get(repo)
+        if waiters is None:
+            return
+        waiters.discard(waiter)
+        if not waiters:
+            del self.waiters[repo]
+
+    async def wait(self, waiter: Waiter, timeout: float) -> Optional[str]:
+        '''Name of changed scope or None on timeout or lost connection'''
+        try:
+            return await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            conn.remove_termination_listener(self._terminated)
+            await conn.close()
+
+
+watcher = ScopeWatcher()
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from sdpremote.utils.admission import (Rejected, UploadAdmission,
+                                        UploadLimiter)
+
+
+def limiter() -> UploadLimiter:
+    return UploadLimiter(
+        uploads=2,
+        uploads_per_user=1,
+        max_bytes=100,
+        max_bytes_per_user=100,
+        queue=1,
+        timeout=0.05,
+    )
+
+
+def test_429_when_user_limit_reached():
+    async def run():
+        lim = limiter()
+        await lim.acquire('user', 10)
+        with pytest.raises(Rejected) as e:
+            await lim.acquire('user', 10)
+        assert e.value.status_code == 429
+        await lim.acquire('another', 10)
+
+    asyncio.run(run())
+
+
+def test_503_when_total_limit_reached():
+    async def run():
+        lim = limiter()
+        await lim.acquire('user', 60)
+        with pytest.raises(Rejected) as e:
+            await lim.acquire('another', 60)
+        assert e.value.status_code == 503
+
+    asyncio.run(run())
+
+
+def test_waiting_upload_admitted_after_release():
+    async def run():
+        lim = limiter()
+        await lim.acquire('user', 10)
+        asyncio.get_running_loop().call_later(
+            0.01,
+            lambda: asyncio.create_task(lim.release('user', 10)),
+        )
+        await lim.acquire('user', 10)
+        assert lim.total.uploads == 1
+
+    asyncio.run(run())
+
+
+def test_oversized_upload_admitted_when_idle():
+    async def run():
+        lim = limiter()
+        await lim.acquire('user', 1000)
+        assert lim.total.bytes == 1000
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize('path, gated', [
+    ('/upload', True),
+    ('/.upload/sessions/1', True),
+    ('/uploadbot/repo/scope', False),
+    ('/user/upload', False),
+])
+def test_gated_paths(path, gated):
+    assert UploadAdmission(None).gated(path) is gated
+
+
+def test_fitting_upload_admitted_without_queue():
+    async def run():
+        lim = limiter()
+        lim.queue = 0
+        await lim.acquire('user', 10)
+        with pytest.raises(Rejected) as e:
+            await lim.acquire('user', 10)
+        assert e.value.status_code == 429
+
+    asyncio.run(run())
+
+
+def test_fitting_upload_admitted_when_queue_is_full():
+    async def run():
+        lim = limiter()
+        await lim.acquire('user', 10)
+        waiter = asyncio.create_task(lim.acquire('user', 10))
+        await asyncio.sleep(0)
+        assert lim.waiting == lim.queue
+        await lim.acquire('another', 10)
+        assert lim.total.uploads == 2
+        with pytest.raises(Rejected):
+            await waiter
+
+    asyncio.run(run())
@@ -0,0 +1,21 @@
+import io
+import random
+
+from sdpremote.utils.chunking import MAX_SIZE, MIN_SIZE, split
+
+data = random.Random(0).randbytes(3 * 2**20)
+
+
+def test_split_bounds():
+    chunks = list(split(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert all(MIN_SIZE <= len(c) <= MAX_SIZE for c in chunks[:-1])
+    assert list(split(io.BytesIO(b''))) == []
+
+
+def test_edit_changes_nearby_chunks():
+    chunks = list(split(io.BytesIO(data)))
+    edited = data[:100000] + b'inserted' + data[100000:]
+    new = [c for c in split(io.BytesIO(edited)) if c not in chunks]
+    assert sum(map(len, new)) <= 2 * MAX_SIZE
+    assert len(new) < len(chunks) // 2
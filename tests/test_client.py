@@ -0,0 +1,71 @@
+import os
+import time
+
+import pytest
+
+from sdpremote.client import Client, HashCache, SyncError, scope_checksum
+from sdpremote.client import client as client_module
+from sdpremote.utils.checksum import calc_checksum
+from sdpremote.utils.object import ObjectState
+
+
+def test_scope_checksum_matches_server():
+    checksums = {'a/b': 'abc', 'c': None}
+    expected = calc_checksum({
+        key: ObjectState(key, checksum, None).line
+        for key, checksum in checksums.items()
+    })
+    assert scope_checksum(checksums) == expected
+    assert scope_checksum({}) is None
+
+
+def test_scan_uses_cache(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    (root / 'sub').mkdir(parents=True)
+    (root / 'a.txt').write_bytes(b'a')
+    (root / 'sub' / 'b.txt').write_bytes(b'b')
+    old = time.time_ns() - 10**10
+    for path in root.rglob('*.txt'):
+        os.utime(path, ns=(old, old))
+
+    hashed = []
+    hash_file = client_module.hash_file
+
+    def counting(path):
+        hashed.append(path)
+        return hash_file(path)
+
+    monkeypatch.setattr(client_module, 'hash_file', counting)
+    cache = HashCache(tmp_path / 'cache.sqlite')
+    client = Client('http://server', 'user', 'repo', cache=cache)
+    first = client.scan(root)
+    assert sorted(first) == ['a.txt', 'sub/b.txt']
+    assert len(hashed) == 2
+
+    assert client.scan(root) == first
+    assert len(hashed) == 2
+
+    (root / 'a.txt').write_bytes(b'changed')
+    assert client.scan(root)['a.txt'].checksum != first['a.txt'].checksum
+    assert len(hashed) == 3
+    cache.close()
+
+
+def test_pull_rejects_keys_outside_root(tmp_path, monkeypatch):
+    root = tmp_path / 'root'
+    client = Client('http://server', 'user', 'repo')
+    monkeypatch.setattr(client, 'objects', lambda scope: {
+        'a.txt': {'checksum': 'abc'},
+        '../escaped': {'checksum': 'abc'},
+    })
+    monkeypatch.setattr(client, '_data_urls', lambda scope, keys: {
+        key: 'http://server/data' for key in keys
+    })
+    monkeypatch.setattr(client, '_download', lambda *args: pytest.fail())
+    with pytest.raises(SyncError):
+        client.pull('scope', root)
+    for key in ('/etc/passwd', 'a/../..', '.'):
+        with pytest.raises(SyncError):
+            client_module._local_path(root, key)
+    assert client_module._local_path(root, 'a/../b') == \
+        root.resolve() / 'b'
@@ -0,0 +1,31 @@
+import json
+import os
+
+import pytest
+
+from sdpremote.config import settings
+from sdpremote.utils.compression import (Compression, accepts_encoding,
+                                         choose_compression)
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, False),
+    ('gzip, deflate', False),
+    ('gzip, zstd', True),
+    ('ZSTD;q=0.5', True),
+    ('zstd;q=0', False),
+    ('*', True),
+])
+def test_accepts_encoding(header, expected):
+    assert accepts_encoding(header, 'zstd') is expected
+
+
+def test_choose_compression(monkeypatch):
+    monkeypatch.setitem(settings, 'compression.enabled', True)
+    text = json.dumps([{'key': i} for i in range(1000)]).encode()
+    assert choose_compression(text, len(text), 'application/json') \
+        is Compression.zstd
+    assert choose_compression(text, len(text), 'image/png') is None
+    assert choose_compression(text[:100], 100, None) is None
+    noise = os.urandom(8192)
+    assert choose_compression(noise, len(noise), None) is None
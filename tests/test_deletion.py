@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import pytest
+
+from sdpremote.entities.deletion import DeletionState
+from sdpremote.routes.deletion import to_deletion
+
+
+class Row(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+@pytest.mark.parametrize('total, finished, expected', [
+    (None, None, DeletionState.queued),
+    (10, None, DeletionState.running),
+    (10, datetime(2021, 1, 1), DeletionState.done),
+])
+def test_deletion_state(total, finished, expected):
+    row = Row(
+        id=1,
+        repo='user/repo',
+        scope=None,
+        started=datetime(2021, 1, 1),
+        finished=finished,
+        total=total,
+        deleted=0,
+        released=0,
+        error=None,
+    )
+    assert to_deletion(row).state is expected
@@ -0,0 +1,44 @@
+import json
+from datetime import datetime
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from sdpremote.entities.object import Object
+from sdpremote.utils.listing import (MSGPACK, encode_rows, encoded_response,
+                                     rows_response)
+
+keys = ('key', 'checksum', 'creator', 'timestamp', 'size', 'contentType')
+rows = [
+    ('a/b', 'abc', 'user', datetime(2021, 7, 1, 12, 30, 0, 123456), 3,
+     'text/plain'),
+    ('ключ', None, 'user@host', datetime(2021, 7, 2), None, None),
+]
+
+
+def test_json_matches_models():
+    expected = jsonable_encoder(
+        [Object(**dict(zip(keys, r))) for r in rows],
+        by_alias=True,
+    )
+    resp = rows_response(keys, rows)
+    assert resp.media_type == 'application/json'
+    assert resp.headers['vary'] == 'Accept'
+    assert json.loads(resp.body) == expected
+
+
+def test_msgpack_by_accept():
+    msgpack = pytest.importorskip('msgpack')
+    resp = rows_response(keys, rows, f'text/html, {MSGPACK};q=0.9')
+    assert resp.media_type == MSGPACK
+    assert resp.headers['vary'] == 'Accept'
+    assert msgpack.unpackb(resp.body) == json.loads(
+        rows_response(keys, rows).body)
+
+
+def test_encoded_rows_get_own_response():
+    encoded = encode_rows(keys, rows)
+    first, second = encoded_response(*encoded), encoded_response(*encoded)
+    first.raw_headers.append((b'x-profile', b'1'))
+    assert b'x-profile' not in dict(second.raw_headers)
+    assert second.body == first.body
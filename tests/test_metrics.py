@@ -0,0 +1,38 @@
+import pytest
+
+from sdpremote import metrics
+from sdpremote.metrics import Counter, Histogram
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    '''Keeps test metrics out of /metrics of the process'''
+    monkeypatch.setattr(metrics, '_registry', [])
+
+
+def test_counter_render():
+    counter = Counter('test_counter_total', 'Test counter', ('label', ))
+    counter.inc('a')
+    counter.inc('a', amount=2)
+    counter.inc('b"')
+    text = counter.render()
+    assert '# TYPE test_counter_total counter' in text
+    assert 'test_counter_total{label="a"} 3' in text
+    assert 'test_counter_total{label="b\\""} 1' in text
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('test_seconds', 'Test histogram', buckets=(1., 2.))
+    for value in (.5, 1.5, 1.7, 3.):
+        histogram.observe(value)
+    text = histogram.render()
+    assert 'test_seconds_bucket{le="1.0"} 1.0' in text
+    assert 'test_seconds_bucket{le="2.0"} 3.0' in text
+    assert 'test_seconds_bucket{le="+Inf"} 4.0' in text
+    assert 'test_seconds_sum 6.7' in text
+    assert 'test_seconds_count 4.0' in text
+
+
+def test_metrics_are_registered_privately():
+    Counter('test_private_total', 'Test counter').inc()
+    assert [m.name for m in metrics._registry] == ['test_private_total']
@@ -0,0 +1,86 @@
+import asyncio
+
+from sdpremote import replica
+from sdpremote.replica import ReadYourWrites
+from sdpremote.utils.singleflight import barrier
+
+
+def test_repo_is_marked_before_response_is_finished(monkeypatch):
+    marked = []
+    forgotten = []
+    monkeypatch.setattr(replica, 'mark_written', marked.append)
+    monkeypatch.setattr(replica.flights, 'forget', forgotten.append)
+
+    async def app(scope, receive, send):
+        assert marked == ['u/r']
+        await send({'type': 'http.response.start', 'status': 200})
+        # background task after response start runs with repo marked
+        assert marked == ['u/r', 'u/r'] and forgotten == ['u/r']
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send(message):
+        pass
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/u/r/scope'}
+    asyncio.run(ReadYourWrites(app)(scope, None, send))
+    assert marked == ['u/r', 'u/r']
+
+
+def test_reads_are_not_marked(monkeypatch):
+    marked = []
+    monkeypatch.setattr(replica, 'mark_written', marked.append)
+
+    async def app(scope, receive, send):
+        pass
+
+    scope = {'type': 'http', 'method': 'GET', 'path': '/u/r/scope'}
+    asyncio.run(ReadYourWrites(app)(scope, None, None))
+    assert marked == []
+
+
+def test_write_sets_lsn_cookie(monkeypatch):
+    monkeypatch.setattr(replica, 'replicas', [None])
+    monkeypatch.setattr(replica, 'mark_written', lambda repo: None)
+
+    async def current_lsn():
+        return '0/16B3748'
+
+    monkeypatch.setattr(replica, '_current_lsn', current_lsn)
+    shared = [(b'content-type', b'text/plain')]
+
+    async def app(scope, receive, send):
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': shared,
+        })
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'PUT', 'path': '/u/r/scope'}
+    asyncio.run(ReadYourWrites(app)(scope, None, send))
+    assert (b'set-cookie', b'sdp-lsn=0/16B3748; Max-Age=5; Path=/; '
+            b'HttpOnly; SameSite=Lax') in sent[0]['headers']
+    assert len(shared) == 1
+
+
+def test_read_carries_lsn_of_client(monkeypatch):
+    monkeypatch.setattr(replica, 'replicas', [None])
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(barrier.get())
+
+    for cookie in (b'a=1; sdp-lsn=0/16B3748', b'sdp-lsn=x; DROP', b''):
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/u/r/scope',
+            'headers': [(b'cookie', cookie)],
+        }
+        asyncio.run(ReadYourWrites(app)(scope, None, None))
+    assert seen == ['0/16B3748', None, None]
+    assert barrier.get() is None
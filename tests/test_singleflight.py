@@ -0,0 +1,64 @@
+import asyncio
+
+from sdpremote.utils.singleflight import SingleFlight
+
+
+def test_concurrent_identical_reads_run_once():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def read():
+            nonlocal calls
+            calls += 1
+            n = calls
+            await asyncio.sleep(.01)
+            return n
+
+        results = await asyncio.gather(
+            *(flights.do('u/r', ('list', 's'), read) for _ in range(10)),
+            flights.do('u/r', ('list', 't'), read),
+        )
+        assert results[:10] == [1] * 10
+        assert calls == 2
+        assert flights.calls == {}
+
+    asyncio.run(main())
+
+
+def test_forget_starts_new_read_after_write():
+    async def main():
+        flights = SingleFlight()
+        calls = 0
+
+        async def read():
+            nonlocal calls
+            calls += 1
+            n = calls
+            await asyncio.sleep(.01)
+            return n
+
+        first = asyncio.ensure_future(flights.do('u/r', ('list', ), read))
+        await asyncio.sleep(0)
+        flights.forget('u/r')
+        second = await flights.do('u/r', ('list', ), read)
+        assert (await first, second) == (1, 2)
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_read():
+    async def main():
+        flights = SingleFlight()
+
+        async def read():
+            await asyncio.sleep(.01)
+            return 'done'
+
+        first = asyncio.ensure_future(flights.do('u/r', ('list', ), read))
+        second = asyncio.ensure_future(flights.do('u/r', ('list', ), read))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 'done'
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+from sdpremote.utils.throttle import Pacer
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.slept += seconds
+        self.now += seconds
+
+
+def test_pacer_allows_burst_of_one_second():
+    clock = Clock()
+    pacer = Pacer(100, clock=clock, sleep=clock.sleep)
+    pacer.wait(100)
+    assert clock.slept == 0
+
+
+def test_pacer_keeps_rate():
+    clock = Clock()
+    pacer = Pacer(100, clock=clock, sleep=clock.sleep)
+    for _ in range(50):
+        pacer.wait(10)
+    # 500 units at 100 per second, first 100 are allowed at once
+    assert abs(clock.now - 4) < 1e-9
+
+
+def test_pacer_does_not_save_idle_time():
+    clock = Clock()
+    pacer = Pacer(100, clock=clock, sleep=clock.sleep)
+    clock.now += 60
+    pacer.wait(300)
+    assert abs(clock.slept - 2) < 1e-9
@@ -0,0 +1,42 @@
+from contextlib import contextmanager
+
+import pytest
+
+from sdpremote.tiering import AccessLog
+
+
+class Engine:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.batches: list[list[int]] = []
+
+    @contextmanager
+    def begin(self):
+        if self.fail:
+            raise ConnectionError
+        yield self
+
+    def execute(self, query, params):
+        self.batches.append(params['sids'])
+        return type('Result', (), {'rowcount': len(params['sids'])})
+
+
+def test_flush_writes_sorted_ids_once():
+    log = AccessLog()
+    for sid in (3, 1, 2, 1):
+        log.touch(sid)
+    engine = Engine()
+    assert log.flush(engine) == 3
+    assert engine.batches == [[1, 2, 3]]
+    assert log.flush(engine) == 0
+
+
+def test_failed_flush_keeps_ids():
+    log = AccessLog()
+    log.touch(1)
+    with pytest.raises(ConnectionError):
+        log.flush(Engine(fail=True))
+    log.touch(2)
+    engine = Engine()
+    log.flush(engine)
+    assert engine.batches == [[1, 2]]
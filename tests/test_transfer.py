@@ -0,0 +1,6 @@
+from sdpremote.transfer import parse_row
+
+
+def test_parse_row():
+    line = b'abc\t42\t\\N\tt\n'
+    assert parse_row(line) == ['abc', '42', None, 't']
@@ -0,0 +1,18 @@
+import pytest
+
+from sdpremote.utils.tree import _successor
+
+
+@pytest.mark.parametrize('delimiter, successor', [
+    ('/', '0'),
+    ('ab', 'ac'),
+    ('\ud7ff', '\ue000'),
+    ('a\U0010ffff', 'b'),
+    ('\U0010ffff', None),
+])
+def test_successor(delimiter, successor):
+    assert _successor(delimiter) == successor
+    if successor is not None:
+        successor.encode()
+        assert delimiter < successor
+        assert delimiter + '\U0010ffff' < successor
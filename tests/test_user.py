@@ -47,6 +47,10 @@ def test_401_when_invalid_header(client: TestClient):
     resp = client.get('/', headers={'Authorization': 'Basic blabla'})
     assert resp.status_code == 401
 
+    value = b64encode(b'.upload:pass').decode()
+    resp = client.get('/', headers={'Authorization': f'Basic {value}'})
+    assert resp.status_code == 401
+
 
 def test_match_user_and_path(client: TestClient, headers: dict[str, str]):
     resp = client.get('/user', headers=headers)
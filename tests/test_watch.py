@@ -0,0 +1,29 @@
+import asyncio
+import json
+
+from sdpremote.watch import ScopeWatcher, Waiter
+
+
+def test_notification_fans_out_to_matching_waiters():
+    async def main():
+        watcher = ScopeWatcher()
+        loop = asyncio.get_running_loop()
+        exact = Waiter('s1', False, loop.create_future())
+        prefix = Waiter('s', True, loop.create_future())
+        other = Waiter('t', True, loop.create_future())
+        watcher.waiters['u/r'] = {exact, prefix, other}
+        watcher.waiters['u/q'] = {Waiter('s1', False, loop.create_future())}
+
+        watcher._notify(None, 0, 'sdpremote_scopes',
+                        json.dumps(dict(repo='u/r', name='s1')))
+
+        assert exact.future.result() == 's1'
+        assert prefix.future.result() == 's1'
+        assert not other.future.done()
+        assert await watcher.wait(other, .01) is None
+        for repo, waiters in list(watcher.waiters.items()):
+            for waiter in list(waiters):
+                watcher.cancel(repo, waiter)
+        assert watcher.waiters == {}
+
+    asyncio.run(main())